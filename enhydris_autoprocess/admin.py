@@ -1,7 +1,5 @@
-from io import StringIO
-
 from django import forms
-from django.db import models
+from django.db import IntegrityError, models
 from django.utils.translation import gettext_lazy as _
 
 import nested_admin
@@ -18,9 +16,12 @@ from .models import (
     Checks,
     CurveInterpolation,
     CurvePeriod,
+    FlatLineCheck,
     RangeCheck,
+    RangeCheckBound,
     RateOfChangeCheck,
     RateOfChangeThreshold,
+    SpikeCheck,
 )
 
 # We override StationAdmin's render_change_form method in order to specify a custom
@@ -41,6 +42,19 @@ class TimeseriesGroupForm(forms.ModelForm):
     soft_lower_bound = forms.FloatField(required=False, label=_("Soft lower bound"))
     soft_upper_bound = forms.FloatField(required=False, label=_("Soft upper bound"))
     upper_bound = forms.FloatField(required=False, label=_("Upper bound"))
+    seasonal_bounds = forms.CharField(
+        required=False,
+        widget=forms.Textarea,
+        label=_("Seasonal bounds"),
+        help_text=_(
+            'Bounds for specific months, one per line, like "7 -5 0 40 45" (without '
+            "the quotes), meaning lower bound -5, soft lower bound 0, soft upper "
+            "bound 40 and upper bound 45 in July. Use a month and an hour, like "
+            '"7:14", for bounds that apply to a specific hour of the day in that '
+            'month. Use "-" for a bound that is the same as above (or as for the '
+            "whole month)."
+        ),
+    )
     rocc_thresholds = forms.CharField(
         required=False,
         widget=forms.Textarea,
@@ -59,6 +73,24 @@ class TimeseriesGroupForm(forms.ModelForm):
         label=_("Symmetric"),
         help_text=RateOfChangeCheck._meta.get_field("symmetric").help_text,
     )
+    flatline_duration = forms.CharField(
+        required=False,
+        max_length=6,
+        label=_("Duration"),
+        help_text=FlatLineCheck._meta.get_field("duration").help_text,
+    )
+    spike_window = forms.IntegerField(
+        required=False,
+        min_value=1,
+        max_value=1000,
+        label=_("Window"),
+        help_text=SpikeCheck._meta.get_field("window").help_text,
+    )
+    spike_allowed_diff = forms.FloatField(
+        required=False,
+        label=_("Allowed difference"),
+        help_text=SpikeCheck._meta.get_field("allowed_diff").help_text,
+    )
 
     class Meta:
         model = TimeseriesGroup
@@ -68,18 +100,29 @@ class TimeseriesGroupForm(forms.ModelForm):
         super().__init__(*args, **kwargs)
         self.range_check_subform = _RangeCheckSubform(self)
         self.roc_check_subform = _RocCheckSubform(self)
+        self.flatline_check_subform = _FlatLineCheckSubform(self)
+        self.spike_check_subform = _SpikeCheckSubform(self)
 
     def clean(self):
         self.range_check_subform.check_that_bounds_are_present_or_absent()
+        self.spike_check_subform.check_that_parameters_are_present_or_absent()
         return super().clean()
 
+    def clean_seasonal_bounds(self):
+        return self.range_check_subform.clean_seasonal_bounds()
+
     def clean_rocc_thresholds(self):
         return self.roc_check_subform.clean_rocc_thresholds()
 
+    def clean_flatline_duration(self):
+        return self.flatline_check_subform.clean_flatline_duration()
+
     def save(self, *args, **kwargs):
         result = super().save(*args, **kwargs)
         self.range_check_subform.save()
         self.roc_check_subform.save()
+        self.flatline_check_subform.save()
+        self.spike_check_subform.save()
         return result
 
 
@@ -98,6 +141,8 @@ class _RangeCheckSubform:
             pf.fields["soft_lower_bound"].initial = range_check.soft_lower_bound
             pf.fields["soft_upper_bound"].initial = range_check.soft_upper_bound
             pf.fields["upper_bound"].initial = range_check.upper_bound
+            seasonal_bounds = range_check.get_seasonal_bounds_as_text()
+            pf.fields["seasonal_bounds"].initial = seasonal_bounds
         except RangeCheck.DoesNotExist:
             pass
 
@@ -109,15 +154,37 @@ class _RangeCheckSubform:
         soft_bounds = [
             pf.cleaned_data[f"soft_{x}_bound"] is not None for x in ("lower", "upper")
         ]
-        if all(hard_bounds) or (not any(hard_bounds) and not any(soft_bounds)):
+        seasonal_bounds = bool(pf.cleaned_data.get("seasonal_bounds"))
+        if all(hard_bounds) or (
+            not any(hard_bounds) and not any(soft_bounds) and not seasonal_bounds
+        ):
             return
         raise forms.ValidationError(
             _(
                 "To perform a range check, lower and upper bound must be specified; "
-                "otherwise, all four bounds must be empty."
+                "otherwise, all four bounds and the seasonal bounds must be empty."
             )
         )
 
+    def clean_seasonal_bounds(self):
+        data = self.parent_form.cleaned_data["seasonal_bounds"]
+        months_and_hours = set()
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            try:
+                values = RangeCheckBound.parse_text(line)
+            except ValueError:
+                raise forms.ValidationError(
+                    _('"{}" is not a valid line of seasonal bounds').format(line)
+                )
+            month_and_hour = (values["month"], values["hour"])
+            if month_and_hour in months_and_hours:
+                message = _('"{}" has the same month and hour as an earlier line')
+                raise forms.ValidationError(message.format(line))
+            months_and_hours.add(month_and_hour)
+        return data
+
     def save(self):
         if self.parent_form.cleaned_data["lower_bound"] is None:
             self._delete_range_check()
@@ -137,9 +204,12 @@ class _RangeCheckSubform:
             timeseries_group=self.parent_form.instance
         )
         try:
-            self._save_existing_range_check(checks)
+            range_check = self._save_existing_range_check(checks)
         except RangeCheck.DoesNotExist:
-            self._save_new_range_check(checks)
+            range_check = self._save_new_range_check(checks)
+        range_check.set_seasonal_bounds(
+            self.parent_form.cleaned_data["seasonal_bounds"]
+        )
 
     def _save_existing_range_check(self, checks):
         range_check = RangeCheck.objects.get(checks=checks)
@@ -148,9 +218,10 @@ class _RangeCheckSubform:
         range_check.soft_upper_bound = self.parent_form.cleaned_data["soft_upper_bound"]
         range_check.upper_bound = self.parent_form.cleaned_data["upper_bound"]
         range_check.save()
+        return range_check
 
     def _save_new_range_check(self, checks):
-        RangeCheck.objects.create(
+        return RangeCheck.objects.create(
             checks=checks,
             lower_bound=self.parent_form.cleaned_data["lower_bound"],
             soft_lower_bound=self.parent_form.cleaned_data["soft_lower_bound"],
@@ -178,21 +249,12 @@ class _RocCheckSubform:
             pass
 
     def clean_rocc_thresholds(self):
+        # Returns the parsed thresholds, so that save() does not parse them again
         data = self.parent_form.cleaned_data["rocc_thresholds"]
-        for line in data.splitlines():
-            self._check_thresholds_line(line)
-        return data
-
-    def _check_thresholds_line(self, line):
         try:
-            delta_t, allowed_diff = line.split()
-            float(allowed_diff)  # Raise ValueError if problem
-            if not RateOfChangeThreshold.is_delta_t_valid(delta_t):
-                raise ValueError()
-        except ValueError:
-            raise forms.ValidationError(
-                _(f'"{line}" is not a valid (delta_t, allowed_diff) pair')
-            )
+            return RateOfChangeCheck.parse_thresholds(data)
+        except ValueError as e:
+            raise forms.ValidationError(str(e))
 
     def save(self):
         if not self.parent_form.cleaned_data["rocc_thresholds"]:
@@ -216,7 +278,9 @@ class _RocCheckSubform:
             rocc_check = self._save_existing_roc_check(checks)
         except RateOfChangeCheck.DoesNotExist:
             rocc_check = self._save_new_roc_check(checks)
-        rocc_check.set_thresholds(self.parent_form.cleaned_data["rocc_thresholds"])
+        rocc_check.set_parsed_thresholds(
+            self.parent_form.cleaned_data["rocc_thresholds"]
+        )
 
     def _save_existing_roc_check(self, checks):
         rocc_check = RateOfChangeCheck.objects.get(checks=checks)
@@ -230,6 +294,111 @@ class _RocCheckSubform:
         )
 
 
+class _FlatLineCheckSubform:
+    def __init__(self, parent_form):
+        self.parent_form = parent_form
+        self._populate_fields()
+
+    def _populate_fields(self):
+        if not getattr(self.parent_form, "instance", None):
+            return
+        try:
+            pf = self.parent_form
+            flatline_check = FlatLineCheck.objects.get(
+                checks__timeseries_group=pf.instance
+            )
+            pf.fields["flatline_duration"].initial = flatline_check.duration
+        except FlatLineCheck.DoesNotExist:
+            pass
+
+    def clean_flatline_duration(self):
+        data = self.parent_form.cleaned_data["flatline_duration"].strip()
+        if data and not RateOfChangeThreshold.is_delta_t_valid(data):
+            raise forms.ValidationError(_('"{}" is not a valid duration').format(data))
+        return data
+
+    def save(self):
+        if not self.parent_form.cleaned_data["flatline_duration"]:
+            self._delete_flatline_check()
+        else:
+            self._create_or_update_flatline_check()
+
+    def _delete_flatline_check(self):
+        try:
+            checks = Checks.objects.get(timeseries_group=self.parent_form.instance)
+            flatline_check = FlatLineCheck.objects.get(checks=checks)
+            flatline_check.delete()
+        except (Checks.DoesNotExist, FlatLineCheck.DoesNotExist):
+            pass
+
+    def _create_or_update_flatline_check(self):
+        checks, created = Checks.objects.get_or_create(
+            timeseries_group=self.parent_form.instance
+        )
+        FlatLineCheck.objects.update_or_create(
+            checks=checks,
+            defaults={"duration": self.parent_form.cleaned_data["flatline_duration"]},
+        )
+
+
+class _SpikeCheckSubform:
+    def __init__(self, parent_form):
+        self.parent_form = parent_form
+        self._populate_fields()
+
+    def _populate_fields(self):
+        if not getattr(self.parent_form, "instance", None):
+            return
+        try:
+            pf = self.parent_form
+            spike_check = SpikeCheck.objects.get(checks__timeseries_group=pf.instance)
+            pf.fields["spike_window"].initial = spike_check.window
+            pf.fields["spike_allowed_diff"].initial = spike_check.allowed_diff
+        except SpikeCheck.DoesNotExist:
+            pass
+
+    def check_that_parameters_are_present_or_absent(self):
+        pf = self.parent_form
+        parameters = [
+            pf.cleaned_data.get(x) is not None
+            for x in ("spike_window", "spike_allowed_diff")
+        ]
+        if all(parameters) or not any(parameters):
+            return
+        raise forms.ValidationError(
+            _(
+                "To perform a spike check, both the window and the allowed difference "
+                "must be specified; otherwise, both must be empty."
+            )
+        )
+
+    def save(self):
+        if self.parent_form.cleaned_data["spike_window"] is None:
+            self._delete_spike_check()
+        else:
+            self._create_or_update_spike_check()
+
+    def _delete_spike_check(self):
+        try:
+            checks = Checks.objects.get(timeseries_group=self.parent_form.instance)
+            spike_check = SpikeCheck.objects.get(checks=checks)
+            spike_check.delete()
+        except (Checks.DoesNotExist, SpikeCheck.DoesNotExist):
+            pass
+
+    def _create_or_update_spike_check(self):
+        checks, created = Checks.objects.get_or_create(
+            timeseries_group=self.parent_form.instance
+        )
+        SpikeCheck.objects.update_or_create(
+            checks=checks,
+            defaults={
+                "window": self.parent_form.cleaned_data["spike_window"],
+                "allowed_diff": self.parent_form.cleaned_data["spike_allowed_diff"],
+            },
+        )
+
+
 TimeseriesGroupInline.form = TimeseriesGroupForm
 TimeseriesGroupInline.fieldsets.append(
     (
@@ -240,6 +409,7 @@ TimeseriesGroupInline.fieldsets.append(
                 "soft_lower_bound",
                 "soft_upper_bound",
                 "upper_bound",
+                "seasonal_bounds",
             ),
             "classes": ("collapse",),
         },
@@ -254,6 +424,21 @@ TimeseriesGroupInline.fieldsets.append(
         },
     ),
 )
+TimeseriesGroupInline.fieldsets.append(
+    (
+        _("Flat line check"),
+        {"fields": ("flatline_duration",), "classes": ("collapse",)},
+    ),
+)
+TimeseriesGroupInline.fieldsets.append(
+    (
+        _("Spike check"),
+        {
+            "fields": (("spike_window", "spike_allowed_diff"),),
+            "classes": ("collapse",),
+        },
+    ),
+)
 
 
 class CurvePeriodForm(forms.ModelForm):
@@ -275,27 +460,19 @@ class CurvePeriodForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if self.instance.pk:
-            point_queryset = self.instance.curvepoint_set.order_by("x")
-            lines = ["{}\t{}".format(p.x, p.y) for p in point_queryset]
+            lines = ["{}\t{}".format(x, y) for x, y in zip(*self.instance._get_curve())]
             self.initial["points"] = "\n".join(lines)
 
     def clean_points(self):
-        data = self.cleaned_data["points"]
-        for i, row in enumerate(StringIO(data)):
-            row = row.replace("\t", ",")
-            try:
-                x, y = [float(item) for item in row.split(",")]
-            except ValueError:
-                raise forms.ValidationError(
-                    'Error in line {}: "{}" is not a valid pair of numbers'.format(
-                        i + 1, row
-                    )
-                )
-        return data
+        # Returns the parsed points, so that save() does not parse them again
+        try:
+            return CurvePeriod.parse_curve(self.cleaned_data["points"])
+        except ValueError as e:
+            raise forms.ValidationError(str(e))
 
     def save(self, *args, **kwargs):
         result = super().save(*args, **kwargs)
-        self.instance.set_curve(self.cleaned_data["points"])
+        self.instance.set_parsed_curve(self.cleaned_data["points"])
         return result
 
 
@@ -343,9 +520,18 @@ class AggregationForm(forms.ModelForm):
             "method",
             "max_missing",
             "resulting_timestamp_offset",
+            "source_aggregation",
         )
         widgets = {"resulting_timestamp_offset": forms.TextInput(attrs={"size": 7})}
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields[
+            "source_aggregation"
+        ].label_from_instance = lambda aggregation: "{} {}".format(
+            aggregation.target_time_step, aggregation.get_method_display()
+        )
+
     def clean_target_time_step(self):
         try:
             result = self.cleaned_data.get("target_time_step", "")
@@ -354,6 +540,23 @@ class AggregationForm(forms.ModelForm):
         except ValueError as e:
             raise forms.ValidationError(str(e))
 
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get("source_aggregation") is None:
+            return cleaned_data
+        aggregation = Aggregation(
+            pk=self.instance.pk,
+            timeseries_group_id=self.instance.timeseries_group_id,
+            target_time_step=cleaned_data.get("target_time_step", ""),
+            method=cleaned_data.get("method", ""),
+            source_aggregation=cleaned_data["source_aggregation"],
+        )
+        try:
+            aggregation.check_source_aggregation()
+        except IntegrityError as e:
+            raise forms.ValidationError(str(e))
+        return cleaned_data
+
 
 class AggregationInline(InlinePermissionsMixin, nested_admin.NestedTabularInline):
     model = Aggregation
@@ -363,5 +566,17 @@ class AggregationInline(InlinePermissionsMixin, nested_admin.NestedTabularInline
     verbose_name_plural = _("Aggregations")
     extra = 1
 
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == "source_aggregation":
+            # On the add page there's no station and therefore no aggregations yet
+            station_id = request.resolver_match.kwargs.get("object_id")
+            if station_id is None:
+                kwargs["queryset"] = Aggregation.objects.none()
+            else:
+                kwargs["queryset"] = Aggregation.objects.filter(
+                    timeseries_group__gentity_id=station_id
+                )
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
 
 TimeseriesGroupInline.inlines.append(AggregationInline)
@@ -0,0 +1,81 @@
+from io import StringIO
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+
+import pandas as pd
+from htimeseries import HTimeseries
+
+from enhydris.models import TimeseriesRecord
+
+# Appending the results of auto processes to their target time series
+#
+# By default we use Timeseries.append_data(), which inserts the records. When there
+# are many records to append (e.g. when an auto process processes a large backlog),
+# it is much faster to stream them to the database with PostgreSQL's COPY. This is
+# used if the ENHYDRIS_AUTOPROCESS_APPEND_METHOD setting is "copy" (the default is
+# "append_data"). Use "manage.py autoprocess_benchmark append" to compare the two
+# methods.
+
+
+def append_data(timeseries, data):
+    """Append data (a DataFrame or HTimeseries) to the time series."""
+    method = getattr(settings, "ENHYDRIS_AUTOPROCESS_APPEND_METHOD", "append_data")
+    if method == "copy" and connection.vendor == "postgresql":
+        copy_append_data(timeseries, data)
+    else:
+        timeseries.append_data(data)
+
+
+def copy_append_data(timeseries, data):
+    """Append data to the time series using COPY.
+
+    The data must have a timezone-aware index and it must start after the end of
+    the time series. The records are copied in the same transaction as the saving of
+    the time series, which (like Timeseries.append_data()) updates its last
+    modification date and triggers post_save.
+    """
+    if isinstance(data, HTimeseries):
+        data = data.data
+    if data.empty:
+        return
+    if data.index.tz is None:
+        raise ValueError("Cannot COPY records with naive timestamps")
+    end_date = timeseries.end_date
+    if end_date is not None and data.index[0] <= end_date:
+        raise IntegrityError(
+            "Cannot append data starting on {} to a time series that ends on {}".format(
+                data.index[0], end_date
+            )
+        )
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.copy_expert(_get_copy_statement(), _get_csv(timeseries, data))
+        timeseries.save()
+
+
+def _get_copy_statement():
+    opts = TimeseriesRecord._meta
+    columns = [
+        opts.get_field(name).column
+        for name in ("timeseries", "timestamp", "value", "flags")
+    ]
+    # The empty string means NULL in CSV, except for the flags, which are never NULL
+    return "COPY {} ({}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL ({}))".format(
+        opts.db_table, ", ".join(columns), columns[3]
+    )
+
+
+def _get_csv(timeseries, data):
+    records = pd.DataFrame(
+        {
+            "timeseries": timeseries.id,
+            "timestamp": data.index.tz_convert("UTC").strftime("%Y-%m-%d %H:%M:%S+00"),
+            "value": data["value"].values,
+            "flags": data["flags"].values,
+        }
+    )
+    result = StringIO()
+    records.to_csv(result, header=False, index=False, na_rep="")
+    result.seek(0)
+    return result
@@ -1,22 +1,30 @@
 from django.apps import AppConfig
 from django.db import transaction
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_save
 
-from .tasks import execute_auto_process
+from . import dependencies, pipeline, tasks
 
 
 def enqueue_auto_process(sender, *, instance, **kwargs):
-    auto_processes = [
-        auto_process
-        for auto_process in instance.timeseries_group.autoprocess_set.all()
-        if auto_process.as_specific_instance.source_timeseries == instance
-    ]
-    for auto_process in auto_processes:
-        transaction.on_commit(lambda: execute_auto_process.delay(auto_process.id))
+    for auto_process_id in dependencies.get_consumer_ids(instance):
+        if not pipeline.is_scheduled(auto_process_id):
+            transaction.on_commit(
+                lambda id=auto_process_id: tasks.enqueue_auto_process(id)
+            )
 
 
 class AutoprocessConfig(AppConfig):
     name = "enhydris_autoprocess"
 
     def ready(self):
+        post_save.connect(
+            dependencies.invalidate_on_timeseries_creation,
+            sender="enhydris.Timeseries",
+        )
+        pre_save.connect(
+            dependencies.invalidate_on_timeseries_change, sender="enhydris.Timeseries"
+        )
+        post_delete.connect(
+            dependencies.invalidate_on_deletion, sender="enhydris.Timeseries"
+        )
         post_save.connect(enqueue_auto_process, sender="enhydris.Timeseries")
@@ -0,0 +1,40 @@
+import threading
+from contextlib import contextmanager
+
+# Computations shared by the auto processes of a batch
+#
+# A time series group often has several aggregations of the same source, such as
+# hourly sum, mean, max and min; they differ only in the method and, as a result, in
+# the regularization mode (instantaneous for the mean, interval for the others).
+# While a pipeline executes its auto processes (see pipeline.py), results of
+# expensive computations are kept in a dictionary that lasts until the pipeline
+# ends, so that the regularized source is computed once per regularization mode,
+# and the partial aggregates of each target time step (see buckets.py), from which
+# the sum, max and min of that time step are all derived, once per regularized
+# source. Outside a batch nothing is kept.
+
+_local = threading.local()
+
+
+@contextmanager
+def batch():
+    """Share computations (see memoize()) until the end of the "with" block."""
+    _local.results = {}
+    try:
+        yield
+    finally:
+        _local.results = None
+
+
+def memoize(key, func):
+    """Return func(), computing it only once for each key in the current batch.
+
+    The key must identify the input of func completely. The result is shared, so it
+    must not be modified.
+    """
+    results = getattr(_local, "results", None)
+    if results is None:
+        return func()
+    if key not in results:
+        results[key] = func()
+    return results[key]
@@ -0,0 +1,129 @@
+import datetime as dt
+import time
+from collections import OrderedDict
+
+from django.db import transaction
+
+import numpy as np
+import pandas as pd
+
+from enhydris.models import Timeseries, TimeseriesGroup
+
+from .append import copy_append_data
+from .curves import CompiledCurves
+from .kernels import get_timestamps, run_kernels
+
+# Benchmarks
+#
+# A benchmark is a function that receives a DataFrame with test data (ten-minute
+# records with a "value" and a "flags" column) and returns the number of seconds an
+# operation took. It is registered with the "register" decorator under a name such
+# as "append/copy"; "manage.py autoprocess_benchmark append" runs all benchmarks
+# whose name starts with "append/". Every run is performed inside a transaction that
+# is rolled back, so benchmarks can write to the database.
+
+benchmarks = OrderedDict()
+
+
+def register(name):
+    def decorator(func):
+        benchmarks[name] = func
+        return func
+
+    return decorator
+
+
+def get_test_data(records):
+    index = pd.date_range("2000-01-01", periods=records, freq="10min", tz="UTC")
+    values = np.random.default_rng(42).normal(20, 5, records).round(1)
+    return pd.DataFrame({"value": values, "flags": ""}, index=index)
+
+
+def run(prefix="", records=100000, repeat=3):
+    """Run the benchmarks whose name starts with prefix.
+
+    Returns a list of (name, seconds) tuples, where seconds is the minimum of the
+    repeated runs.
+    """
+    data = get_test_data(records)
+    result = []
+    for name, benchmark in benchmarks.items():
+        if not name.startswith(prefix):
+            continue
+        times = [_run_once(benchmark, data) for i in range(repeat)]
+        result.append((name, min(times)))
+    return result
+
+
+def _run_once(benchmark, data):
+    with transaction.atomic():
+        seconds = benchmark(data.copy())
+        transaction.set_rollback(True)
+    return seconds
+
+
+def _create_timeseries():
+    timeseries_group = TimeseriesGroup.objects.first()
+    if timeseries_group is None:
+        raise ValueError("The benchmark needs at least one time series group")
+    return Timeseries.objects.create(
+        timeseries_group=timeseries_group,
+        type=Timeseries.AGGREGATED,
+        time_step="10min",
+        name="Benchmark",
+    )
+
+
+def register_check(name, get_kernel):
+    """Register a "checks/<name>" benchmark for a check.
+
+    "get_kernel" is a function that returns the kernel (see kernels.py) to run on the
+    test data.
+    """
+
+    def benchmark(data):
+        kernel = get_kernel()
+        start = time.perf_counter()
+        run_kernels([kernel], data)
+        return time.perf_counter() - start
+
+    register(f"checks/{name}")(benchmark)
+
+
+@register("append/append_data")
+def append_with_append_data(data):
+    timeseries = _create_timeseries()
+    start = time.perf_counter()
+    timeseries.append_data(data)
+    return time.perf_counter() - start
+
+
+@register("append/copy")
+def append_with_copy(data):
+    timeseries = _create_timeseries()
+    start = time.perf_counter()
+    copy_append_data(timeseries, data)
+    return time.perf_counter() - start
+
+
+@register("curves/interpolate")
+def interpolate_curves(data, periods=500):
+    first_date = data.index[0].date()
+    days = (data.index[-1].date() - first_date).days + 1
+    x = np.linspace(0, 50, 20)
+    y = x**1.5
+    compiled_curves = CompiledCurves(
+        [
+            (
+                i,
+                first_date + dt.timedelta(days=days * i // periods),
+                first_date + dt.timedelta(days=max(days * (i + 1) // periods - 1, 0)),
+                x,
+                y,
+            )
+            for i in range(periods)
+        ]
+    )
+    start = time.perf_counter()
+    compiled_curves.interpolate(get_timestamps(data.index), data["value"].values)
+    return time.perf_counter() - start
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+# Incremental aggregation
+#
+# An Aggregation keeps the partial aggregates (count of non-null values, sum, min and
+# max) of its last, incomplete target interval (the "open bucket") in an
+# AggregationState, so that the next execution needs only the source records that
+# follow, instead of re-reading and recomputing the whole interval. The buckets
+# follow the convention of haggregate: a target record is labelled with the end of
+# its interval and is derived from the source records after the start and up to
+# and including the end of the interval. This is only supported for target time
+# steps of a fixed length that divides the day (e.g. "10min", "H", "3H", "D"), for
+# which the bucket of a record is found by rounding its timestamp up to the time
+# step (in the time zone of the time series); other aggregations always read and
+# aggregate their incomplete target interval again.
+
+AGGREGATES = {"count": "sum", "sum": "sum", "min": "min", "max": "max"}
+
+
+def get_bucket_step(number, unit):
+    """Return the time step as a Timedelta, or None if buckets don't support it."""
+    if unit not in ("min", "H", "D"):
+        return None
+    step = pd.Timedelta(number, unit={"min": "min", "H": "h", "D": "D"}[unit])
+    if not step or pd.Timedelta(days=1) % step:
+        return None
+    return step
+
+
+def get_buckets(values, step):
+    """Return the partial aggregates of a series for each bucket.
+
+    The result is a DataFrame with columns "count", "sum", "min" and "max", indexed
+    by the end of the bucket.
+    """
+    grouped = values.groupby(values.index.ceil(step))
+    return pd.DataFrame(
+        {
+            "count": grouped.count(),
+            "sum": grouped.sum(),
+            "min": grouped.min(),
+            "max": grouped.max(),
+        },
+        columns=list(AGGREGATES),
+    )
+
+
+def merge_buckets(*buckets):
+    """Combine the partial aggregates of buckets with the same end."""
+    nonempty = [b for b in buckets if not b.empty]
+    if not nonempty:
+        return buckets[-1]
+    return pd.concat(nonempty).groupby(level=0).agg(AGGREGATES)
+
+
+def aggregate_buckets(buckets, method, expected_count, max_missing, offset):
+    """Return the target records (a DataFrame with "value" and "flags") of buckets.
+
+    Buckets with more than max_missing (but at least one) missing values are
+    omitted; the others get the MISS flag if any value is missing. The timestamps
+    are the ends of the buckets minus the offset (a Timedelta).
+    """
+    min_count = max(expected_count - max_missing, 1)
+    buckets = buckets[buckets["count"] >= min_count]
+    if method == "mean":
+        values = buckets["sum"] / buckets["count"]
+    else:
+        values = buckets[method]
+    flags = np.where(buckets["count"] < expected_count, "MISS", "")
+    return pd.DataFrame(
+        {"value": values.values.astype(float), "flags": flags},
+        columns=["value", "flags"],
+        index=buckets.index - offset,
+    )
@@ -0,0 +1,167 @@
+import datetime as dt
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+import numpy as np
+
+# Worker-local cache of compiled curves
+#
+# The curves of a CurveInterpolation (the points of all its CurvePeriod objects) are
+# read from the database and compiled into a CompiledCurves object, which holds them
+# in a few contiguous numpy arrays. The compiled curves are kept in memory in each
+# worker, identified by the id of the curve interpolation and its curves_version,
+# which is increased whenever any of its periods or points changes; so repeated
+# executions of a curve interpolation make no curve queries at all, and changed
+# curves are never served. The least recently used entries are evicted when there
+# are more than MAX_ENTRIES.
+#
+# When periods overlap, the one with the latest start date wins (as if the periods
+# were applied in order of start date, each overwriting the previous ones). The
+# periods are therefore also compiled into non-overlapping "segments", each of which
+# uses the curve of one period, so that interpolate() can find the records of each
+# segment with a binary search instead of slicing the time series once per period.
+#
+# The points of a period are normally stored as CurvePoint rows. If the
+# ENHYDRIS_AUTOPROCESS_CURVE_STORAGE setting is "binary", CurvePeriod.set_curve()
+# instead stores them in CurvePeriod.curve_data, as the x values followed by the y
+# values, little-endian float64, so that a curve with thousands of points is read or
+# written as a single row. Periods whose curve_data is null (e.g. those saved before
+# the setting was changed) continue to use their rows.
+
+MAX_ENTRIES = 1000
+CURVE_DTYPE = np.dtype("<f8")
+
+
+def get_curve_storage():
+    return getattr(settings, "ENHYDRIS_AUTOPROCESS_CURVE_STORAGE", "rows")
+
+
+def encode_curve(x, y):
+    """Return the curve as bytes, with the points sorted by x."""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    order = np.argsort(x, kind="stable")
+    return np.concatenate([x[order], y[order]]).astype(CURVE_DTYPE).tobytes()
+
+
+def decode_curve(data):
+    """Return the x and y arrays of a curve encoded with encode_curve()."""
+    values = np.frombuffer(bytes(data), dtype=CURVE_DTYPE).astype(np.float64)
+    half = len(values) // 2
+    return values[:half], values[half:]
+
+
+class CompiledCurves:
+    """The curves of a curve interpolation as contiguous numpy arrays.
+
+    "periods" is a list of (id, start_date, end_date, x, y) tuples, where x and y are
+    sequences of the same length, sorted by x. The periods are stored sorted by start
+    date. "starts" and "ends" are the bounds of the periods in nanoseconds since the
+    epoch; a period starts at the beginning of its start date and ends at 23:59 of
+    its end date, in UTC. The points of all periods are concatenated in "x" and "y";
+    those of the i-th period are between "offsets[i]" and "offsets[i + 1]".
+    """
+
+    def __init__(self, periods):
+        periods = sorted(periods, key=lambda period: period[1])
+        self.period_ids = [period[0] for period in periods]
+        self.starts = np.array(
+            [self._to_nanoseconds(period[1], dt.time(0, 0)) for period in periods],
+            dtype=np.int64,
+        )
+        self.ends = np.array(
+            [self._to_nanoseconds(period[2], dt.time(23, 59)) for period in periods],
+            dtype=np.int64,
+        )
+        lengths = [len(period[3]) for period in periods]
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self.x = np.array(
+            [x for period in periods for x in period[3]], dtype=np.float64
+        )
+        self.y = np.array(
+            [y for period in periods for y in period[4]], dtype=np.float64
+        )
+        self._compile_segments()
+
+    def _compile_segments(self):
+        # The boundaries of the elementary intervals; ends are inclusive, so an
+        # interval that stops at an end starts again one nanosecond later.
+        boundaries = np.unique(np.concatenate([self.starts, self.ends + 1]))
+        owners = np.full(len(boundaries), -1, dtype=np.int64)
+        for i in range(len(self)):
+            owners[(boundaries >= self.starts[i]) & (boundaries <= self.ends[i])] = i
+        # Merge consecutive intervals with the same owner. The last boundary is after
+        # all periods, so its owner is always -1 and its end does not matter.
+        changes = np.concatenate([[True], owners[1:] != owners[:-1]])[: len(owners)]
+        segment_starts = boundaries[changes]
+        segment_ends = np.append(segment_starts[1:] - 1, -1)[: len(segment_starts)]
+        segment_periods = owners[changes]
+        used = segment_periods >= 0
+        self.segment_starts = segment_starts[used]
+        self.segment_ends = segment_ends[used]
+        self.segment_periods = segment_periods[used]
+
+    def _to_nanoseconds(self, date, time):
+        timestamp = dt.datetime.combine(date, time, tzinfo=dt.timezone.utc)
+        return int(timestamp.timestamp()) * 10**9
+
+    def __len__(self):
+        return len(self.period_ids)
+
+    def get_curve(self, i):
+        """Return the x and y arrays of the i-th period (views, not copies)."""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.x[start:end], self.y[start:end]
+
+    def interpolate(self, timestamps, values):
+        """Return the values interpolated with the curve of their period.
+
+        "timestamps" must be sorted nanoseconds since the epoch (see
+        kernels.get_timestamps()). Values outside all periods, or outside the range
+        of the curve of their period, result in NaN.
+        """
+        result = np.full(len(values), np.nan)
+        firsts = np.searchsorted(timestamps, self.segment_starts, side="left")
+        lasts = np.searchsorted(timestamps, self.segment_ends, side="right")
+        for first, last, period in zip(firsts, lasts, self.segment_periods):
+            if first == last:
+                continue
+            x, y = self.get_curve(period)
+            result[first:last] = np.interp(
+                values[first:last], x, y, left=np.nan, right=np.nan
+            )
+        return result
+
+
+class CurveCache:
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compile):
+        """Return the compiled curves for "key", calling compile() if needed."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        compiled_curves = compile()
+        with self._lock:
+            self._entries[key] = compiled_curves
+            while len(self._entries) > MAX_ENTRIES:
+                self._entries.popitem(last=False)
+        return compiled_curves
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+curve_cache = CurveCache()
@@ -0,0 +1,125 @@
+import copy
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+# Worker-local cache of source time series data
+#
+# Several auto processes of a time series group often use the same source time series
+# (e.g. a curve interpolation and a few aggregations all use the checked time series),
+# and they are usually executed one after the other in the same worker. Instead of
+# having each one of them read the data from the database, we keep the data read
+# recently in memory. Each cached fragment is the result of reading a time series from
+# a start date to an end date (either of which can be None); a fragment can serve any
+# request for a period it covers. Fragments are identified by the last_modified
+# attribute of the time series, so data that has been modified in the meantime is
+# never served. The least recently used fragments are evicted when the memory they
+# occupy exceeds ENHYDRIS_AUTOPROCESS_DATA_CACHE_MEMORY (in bytes; 0 disables the
+# cache).
+
+DEFAULT_MAX_MEMORY = 100 * 1024 * 1024
+
+
+class DataCache:
+    def __init__(self):
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_memory(self):
+        return getattr(
+            settings, "ENHYDRIS_AUTOPROCESS_DATA_CACHE_MEMORY", DEFAULT_MAX_MEMORY
+        )
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "fragments": len(self._fragments),
+            "memory": self.memory,
+        }
+
+    def get_data(self, timeseries, start_date=None, end_date=None):
+        """Return timeseries.get_data(start_date, end_date), reading it if needed.
+
+        The returned HTimeseries is a copy, so the caller can modify it.
+        """
+        if timeseries.last_modified is None:
+            return timeseries.get_data(start_date=start_date, end_date=end_date)
+        with self._lock:
+            htimeseries = self._find(timeseries, start_date, end_date)
+            if htimeseries is not None:
+                self.hits += 1
+                return htimeseries
+            self.misses += 1
+        htimeseries = timeseries.get_data(start_date=start_date, end_date=end_date)
+        with self._lock:
+            self._add(timeseries, start_date, end_date, htimeseries)
+        return self._copy(htimeseries, htimeseries.data)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self.memory = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _find(self, timeseries, start_date, end_date):
+        for key, (htimeseries, _) in self._fragments.items():
+            id, last_modified, fragment_start_date, fragment_end_date = key
+            if (
+                id == timeseries.id
+                and last_modified == timeseries.last_modified
+                and _covers(
+                    fragment_start_date, fragment_end_date, start_date, end_date
+                )
+            ):
+                self._fragments.move_to_end(key)
+                return self._copy(
+                    htimeseries, htimeseries.data.loc[start_date:end_date]
+                )
+
+    def _add(self, timeseries, start_date, end_date, htimeseries):
+        self._remove_outdated(timeseries)
+        size = int(htimeseries.data.memory_usage(deep=True).sum())
+        if size > self.max_memory:
+            return
+        key = (timeseries.id, timeseries.last_modified, start_date, end_date)
+        if key in self._fragments:
+            return
+        self._fragments[key] = (htimeseries, size)
+        self.memory += size
+        while self.memory > self.max_memory:
+            evicted_size = self._fragments.popitem(last=False)[1][1]
+            self.memory -= evicted_size
+
+    def _remove_outdated(self, timeseries):
+        for key in list(self._fragments):
+            id, last_modified = key[:2]
+            if id == timeseries.id and last_modified != timeseries.last_modified:
+                self.memory -= self._fragments.pop(key)[1]
+
+    def _copy(self, htimeseries, data):
+        result = copy.copy(htimeseries)
+        result.data = data.copy()
+        return result
+
+
+def _covers(fragment_start_date, fragment_end_date, start_date, end_date):
+    if fragment_start_date is not None and (
+        start_date is None or start_date < fragment_start_date
+    ):
+        return False
+    if fragment_end_date is not None and (
+        end_date is None or end_date > fragment_end_date
+    ):
+        return False
+    return True
+
+
+data_cache = DataCache()
@@ -0,0 +1,97 @@
+from django.core.cache import cache
+
+from .tasks import cache_is_process_local
+
+# Index of auto processes by source time series
+#
+# Whenever a time series is saved, we need to find the auto processes that use it as
+# their source. The source time series of an auto process depends on its kind and on
+# what time series exist in its group (e.g. the source of an aggregation is the
+# checked time series if it exists, otherwise the initial), so finding it is not a
+# simple lookup. We therefore keep, for each time series group, an index that maps
+# the id of each time series of the group to its type and to the ids of the auto
+# processes that use it as source. The index is stored in the cache and it is
+# invalidated whenever time series or auto processes of the group are created,
+# changed (in the case of time series, only in the fields that determine the source of
+# auto processes) or deleted. Building the index doesn't write anything to the database
+# (unlike the source_timeseries property, which creates the time series if it
+# doesn't exist).
+#
+# Since the invalidation is done by whichever process saves the objects (usually the
+# web server) and the index is used by the workers, this needs a cache shared by all
+# processes. With a cache that is local to each process (see
+# tasks.cache_is_process_local()), a worker could keep using a stale index for up to
+# INDEX_TIMEOUT, and miss new auto processes; in that case the index is built anew
+# every time.
+
+INDEX_TIMEOUT = 86400
+
+
+def _get_index_key(timeseries_group_id):
+    return f"autoprocess_consumers_{timeseries_group_id}"
+
+
+def get_consumer_ids(timeseries):
+    """Return the ids of the auto processes that use the time series as source."""
+    index = {}
+    if not cache_is_process_local():
+        index = cache.get(_get_index_key(timeseries.timeseries_group_id)) or {}
+    entry = index.get(timeseries.id)
+    if entry is None or entry[0] != timeseries.type:
+        index = _build_index(timeseries.timeseries_group_id)
+        entry = index.get(timeseries.id, (timeseries.type, []))
+    return entry[1]
+
+
+def _build_index(timeseries_group_id):
+    from enhydris.models import Timeseries
+
+    from .models import AutoProcess
+
+    timeseries_list = list(
+        Timeseries.objects.filter(timeseries_group_id=timeseries_group_id)
+    )
+    index = {timeseries.id: (timeseries.type, []) for timeseries in timeseries_list}
+    auto_processes = AutoProcess.objects.filter(timeseries_group_id=timeseries_group_id)
+    for auto_process in auto_processes:
+        auto_process = auto_process.as_specific_instance
+        source_timeseries = auto_process.find_source_timeseries(timeseries_list)
+        if source_timeseries is not None:
+            index[source_timeseries.id][1].append(auto_process.id)
+    cache.set(_get_index_key(timeseries_group_id), index, INDEX_TIMEOUT)
+    return index
+
+
+def invalidate(timeseries_group_id):
+    cache.delete(_get_index_key(timeseries_group_id))
+
+
+def invalidate_on_timeseries_creation(sender, *, instance, created, **kwargs):
+    if created:
+        invalidate(instance.timeseries_group_id)
+
+
+# The fields of a time series on which the sources of the auto processes depend (see
+# AutoProcess.find_source_timeseries()).
+SOURCE_FIELDS = ("type", "timeseries_group_id", "time_step", "name")
+
+
+def invalidate_on_timeseries_change(sender, *, instance, update_fields, **kwargs):
+    # A change in these fields can change the consumers of the other time series of
+    # the group (and of the group the time series used to belong to), which
+    # get_consumer_ids() wouldn't notice.
+    if instance.pk is None:
+        return
+    fields = {*SOURCE_FIELDS, "timeseries_group"}
+    if update_fields is not None and not fields & set(update_fields):
+        return
+    old = sender.objects.filter(pk=instance.pk).values(*SOURCE_FIELDS).first()
+    if old is None:
+        return
+    if any(old[field] != getattr(instance, field) for field in SOURCE_FIELDS):
+        invalidate(old["timeseries_group_id"])
+        invalidate(instance.timeseries_group_id)
+
+
+def invalidate_on_deletion(sender, *, instance, **kwargs):
+    invalidate(instance.timeseries_group_id)
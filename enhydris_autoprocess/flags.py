@@ -0,0 +1,83 @@
+from collections import OrderedDict
+
+import numpy as np
+
+# Flags as bits
+#
+# In time series, the flags of a record are a string with space-separated flag names.
+# Adding flags to such strings (or checking whether they contain a flag) requires
+# a pass over Python string objects for each record. While the checks are being
+# performed, we therefore don't touch the "flags" column; instead, the flags added by
+# the checks are stored in an integer column, "flagbits", in which each flag name
+# (registered in flag_registry) corresponds to a bit. Just before the result is
+# stored, to_strings() appends the names of the flags whose bits are set to the
+# original flags, in the order in which the flags have been registered.
+
+BITS_COLUMN = "flagbits"
+
+
+class FlagRegistry:
+    def __init__(self):
+        self._bits = OrderedDict()
+
+    def register(self, name):
+        """Register a flag name (if not already registered) and return its bit."""
+        if name not in self._bits:
+            if len(self._bits) >= 32:
+                raise ValueError("Cannot register more than 32 flags")
+            self._bits[name] = np.uint32(1 << len(self._bits))
+        return self._bits[name]
+
+    def get_bit(self, name):
+        return self._bits[name]
+
+    def add(self, data, mask, name):
+        """Set the flag in the records of the dataframe "data" selected by "mask"."""
+        mask = np.asarray(mask, dtype=bool)
+        data[BITS_COLUMN] = self.get_bits(data) | np.where(
+            mask, self._bits[name], np.uint32(0)
+        )
+
+    def get_bits(self, data):
+        """Return the flag bits of the dataframe as a numpy array.
+
+        If the dataframe does not have a flag bits column, all bits are zero.
+        """
+        if BITS_COLUMN not in data:
+            return np.zeros(len(data), dtype=np.uint32)
+        return data[BITS_COLUMN].values
+
+    def has(self, data, name):
+        """Return a boolean array indicating which records have a flag.
+
+        Only flags that have been added as bits are considered.
+        """
+        if BITS_COLUMN not in data:
+            return np.zeros(len(data), dtype=bool)
+        return (data[BITS_COLUMN].values & self._bits[name]) != 0
+
+    def to_strings(self, data):
+        """Append the flags stored as bits to the "flags" column.
+
+        The flag bits column is removed. The dataframe is modified in place and
+        returned.
+        """
+        if BITS_COLUMN not in data:
+            return data
+        bits = data.pop(BITS_COLUMN).values
+        if not bits.any():
+            return data
+        flags = data["flags"].fillna("").values.astype(object)
+        for name, bit in self._bits.items():
+            rows = np.flatnonzero(bits & bit)
+            if not len(rows):
+                continue
+            old_flags = flags[rows]
+            flags[rows] = np.where(old_flags == "", name, old_flags + " " + name)
+        data["flags"] = flags
+        return data
+
+
+flag_registry = FlagRegistry()
+for name in ("RANGE", "SUSPECT", "TEMPORAL", "MISS", "DATEINSERT", "FLATLINE", "SPIKE"):
+    flag_registry.register(name)
@@ -0,0 +1,402 @@
+import heapq
+from collections import deque
+
+import numpy as np
+import pandas as pd
+from htimeseries import HTimeseries
+from rocc import rocc
+
+from .flags import BITS_COLUMN, flag_registry
+
+# Check kernels
+#
+# The checks of Checks (RangeCheck, RateOfChangeCheck, and any checks registered by
+# other apps with models.register_check()) don't operate on time series; each one
+# provides a kernel (with its get_kernel() method), which operates on numpy arrays.
+# A kernel is called with the timestamps (int64 nanoseconds since the epoch, in UTC)
+# and the values (float64, with NaN for null values) of the records, and it returns
+# a boolean array that shows which values must be removed (set to null), and a uint32
+# array with the flag bits (see flags.py) to add to each record. It must not modify
+# its arguments. run_kernels() runs a sequence of kernels on a dataframe, each one
+# seeing the values after the removals of the previous ones.
+#
+# A kernel is "pointwise" if its result for each record depends only on the value of
+# the record (e.g. a range check). Consecutive pointwise kernels are fused into a
+# kernel that runs all of them on a block of records before proceeding to the next
+# block, so that each block is read from memory once rather than once per kernel.
+
+
+class Kernel:
+    pointwise = False
+
+    # Kernels whose result depends on the local time (e.g. on the month) use "tz",
+    # which run_kernels() sets to the time zone of the data.
+    tz = None
+
+    def __call__(self, timestamps, values):
+        raise NotImplementedError("Kernels must implement __call__()")
+
+
+class FusedKernel(Kernel):
+    pointwise = True
+    block_size = 65536
+
+    def __init__(self, kernels):
+        self.kernels = kernels
+
+    def __call__(self, timestamps, values):
+        values = values.copy()
+        remove = np.zeros(len(values), dtype=bool)
+        flags = np.zeros(len(values), dtype=np.uint32)
+        for start in range(0, len(values), self.block_size):
+            block = slice(start, start + self.block_size)
+            block_values = values[block]  # A view, so it modifies "values"
+            for kernel in self.kernels:
+                block_remove, block_flags = kernel(timestamps[block], block_values)
+                block_values[block_remove] = np.nan
+                remove[block] |= block_remove
+                flags[block] |= block_flags
+        return remove, flags
+
+
+def fuse(kernels):
+    """Return the kernels with consecutive pointwise kernels fused."""
+    result = []
+    group = []
+    for kernel in list(kernels) + [None]:
+        if kernel is not None and kernel.pointwise:
+            group.append(kernel)
+            continue
+        if len(group) == 1:
+            result.append(group[0])
+        elif group:
+            result.append(FusedKernel(group))
+        group = []
+        if kernel is not None:
+            result.append(kernel)
+    return result
+
+
+def get_timestamps(index):
+    """Return the timestamps of a datetime index as nanoseconds since the epoch."""
+    return index.values.astype("datetime64[ns]").view(np.int64)
+
+
+def get_local_timestamps(timestamps, tz):
+    """Convert timestamps from UTC to the time zone "tz" (None means UTC)."""
+    if tz is None:
+        return timestamps
+    utcoffset = tz.utcoffset(None)
+    if utcoffset is not None:  # Fixed offset, which is the usual case in Enhydris
+        return timestamps + pd.Timedelta(utcoffset).value
+    return get_timestamps(
+        pd.to_datetime(timestamps, utc=True).tz_convert(tz).tz_localize(None)
+    )
+
+
+def get_month_hour_slots(timestamps, tz):
+    """Return month * 24 + hour, with 0 for January, for each timestamp."""
+    local_timestamps = get_local_timestamps(timestamps, tz)
+    months = (
+        local_timestamps.view("datetime64[ns]").astype("datetime64[M]").astype(np.int64)
+        % 12
+    )
+    hours = (local_timestamps // pd.Timedelta("1h").value) % 24
+    return months * 24 + hours
+
+
+def run_kernels(kernels, data):
+    """Run the kernels on a dataframe with "value" and "flags" columns.
+
+    The values are replaced and the flag bits are added to the dataframe's flag bits
+    column.
+    """
+    if data.empty:
+        return data
+    timestamps = get_timestamps(data.index)
+    for kernel in kernels:
+        kernel.tz = data.index.tz
+    values = data["value"].values.astype(np.float64)
+    flags = flag_registry.get_bits(data).copy()
+    for kernel in fuse(kernels):
+        kernel_remove, kernel_flags = kernel(timestamps, values)
+        values = np.where(kernel_remove, np.nan, values)
+        flags |= kernel_flags
+    data["value"] = values
+    data[BITS_COLUMN] = flags
+    return data
+
+
+class RangeKernel(Kernel):
+    """Remove values outside the hard limits and flag values outside the soft ones.
+
+    Each limit is either a number or a 12x24 array with the limit for each month and
+    hour of the day (in local time, see "tz"); the limits for each record are then
+    found with a single index lookup. A missing limit (None or NaN) means there is
+    no limit.
+    """
+
+    pointwise = True
+
+    def __init__(self, lower_bound, upper_bound, soft_lower_bound, soft_upper_bound):
+        self.lower_bound = self._prepare_bound(lower_bound, -np.inf)
+        self.upper_bound = self._prepare_bound(upper_bound, np.inf)
+        self.soft_lower_bound = self._prepare_bound(soft_lower_bound, -np.inf)
+        self.soft_upper_bound = self._prepare_bound(soft_upper_bound, np.inf)
+
+    def _prepare_bound(self, bound, default):
+        if bound is None:
+            return default
+        if np.ndim(bound) == 0:
+            return bound
+        bound = np.asarray(bound, dtype=np.float64).reshape(12 * 24)
+        return np.where(np.isnan(bound), default, bound)
+
+    def __call__(self, timestamps, values):
+        bounds = (
+            self.lower_bound,
+            self.upper_bound,
+            self.soft_lower_bound,
+            self.soft_upper_bound,
+        )
+        if any(np.ndim(bound) for bound in bounds):
+            slots = get_month_hour_slots(timestamps, self.tz)
+            bounds = [bound[slots] if np.ndim(bound) else bound for bound in bounds]
+        lower_bound, upper_bound, soft_lower_bound, soft_upper_bound = bounds
+        range_bit = flag_registry.get_bit("RANGE")
+        suspect_bit = flag_registry.get_bit("SUSPECT")
+        with np.errstate(invalid="ignore"):
+            remove = (values < lower_bound) | (values > upper_bound)
+            suspect = ~remove & (
+                (values < soft_lower_bound) | (values > soft_upper_bound)
+            )
+        flags = np.where(remove, range_bit, np.uint32(0)) | np.where(
+            suspect, suspect_bit, np.uint32(0)
+        )
+        return remove, flags.astype(np.uint32)
+
+
+class RateOfChangeKernel(Kernel):
+    """Remove and flag values that differ too much from preceding values.
+
+    "thresholds" and "symmetric" are as in rocc. If "context" is specified, it must
+    have get_context(values) and save_context(values, end_date=None) methods, where
+    "values" is a series; get_context() returns the values preceding "values" that
+    are needed to check them (or None), and save_context() stores the values that
+    will be needed by the next run, and the date of the last record checked if it is
+    not the last of the values (see Check).
+    """
+
+    def __init__(self, thresholds, symmetric, context=None):
+        self.thresholds = thresholds
+        self.symmetric = symmetric
+        self.context = context
+
+    def __call__(self, timestamps, values):
+        values = pd.Series(values, index=pd.to_datetime(timestamps, utc=True))
+        context = None
+        if self.context is not None:
+            context = self.context.get_context(values)
+            if context is not None:
+                values = pd.concat([context, values])
+            self.context.save_context(values)
+        context_length = 0 if context is None else len(context)
+
+        # rocc adds the flag to the "flags" column of the time series it checks. We
+        # give it a time series with empty flags, so the records that fail are those
+        # that end up with nonempty flags.
+        htimeseries = HTimeseries(
+            pd.DataFrame(
+                data={"value": values.values, "flags": ""},
+                columns=["value", "flags"],
+                index=values.index,
+            )
+        )
+        rocc(
+            timeseries=htimeseries,
+            thresholds=self.thresholds,
+            symmetric=self.symmetric,
+            flag="TEMPORAL",
+        )
+        remove = (htimeseries.data["flags"].values != "")[context_length:]
+        flags = np.where(remove, flag_registry.get_bit("TEMPORAL"), np.uint32(0))
+        return remove, flags.astype(np.uint32)
+
+
+class FlatLineKernel(Kernel):
+    """Flag values that have remained unchanged for longer than "duration".
+
+    A record is flagged if it and all the records since a time more than "duration"
+    before it have the same value (i.e. the sensor seems to be stuck). The values are
+    not removed, since a constant value can be legitimate (e.g. zero rainfall).
+
+    The runs of identical values are found with run-length encoding, so the time
+    needed is linear and there are no rolling windows. A record's result depends only
+    on the records up to it, so checking a time series in parts gives the same result
+    as checking it all at once, provided that "context" (which has the same interface
+    as in RateOfChangeKernel) provides the last run of the previous part.
+    """
+
+    def __init__(self, duration, context=None):
+        self.duration = pd.Timedelta(duration).value
+        self.context = context
+
+    def __call__(self, timestamps, values):
+        context_length = 0
+        if self.context is not None:
+            series = pd.Series(values, index=pd.to_datetime(timestamps, utc=True))
+            context = self.context.get_context(series)
+            if context is not None:
+                context_length = len(context)
+                timestamps = np.concatenate([get_timestamps(context.index), timestamps])
+                values = np.concatenate([context.values, values])
+        run_starts = self._get_run_starts(values)
+        run_lengths = np.diff(np.append(run_starts, len(values)))
+        run_start_timestamps = np.repeat(timestamps[run_starts], run_lengths)
+        remove = np.zeros(len(values) - context_length, dtype=bool)
+        flatline = (timestamps - run_start_timestamps > self.duration) & ~np.isnan(
+            values
+        )
+        if self.context is not None:
+            self._save_last_run(timestamps, values, run_starts)
+        flags = np.where(
+            flatline[context_length:], flag_registry.get_bit("FLATLINE"), np.uint32(0)
+        )
+        return remove, flags.astype(np.uint32)
+
+    def _get_run_starts(self, values):
+        # NaN differs from everything (including NaN), so it never forms runs
+        if not len(values):
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([[0], np.flatnonzero(values[1:] != values[:-1]) + 1])
+
+    def _save_last_run(self, timestamps, values, run_starts):
+        # Only the first and the last record of the last run are needed
+        if not len(values):
+            return
+        last_run = np.unique([run_starts[-1], len(values) - 1])
+        self.context.save_context(
+            pd.Series(
+                values[last_run], index=pd.to_datetime(timestamps[last_run], utc=True)
+            )
+        )
+
+
+class SlidingMedian:
+    """The median of a window of values that can be added and removed.
+
+    The values are kept in two heaps, a max-heap with the smaller half and a min-heap
+    with the larger half, so adding or removing a value takes O(log W) time, where W
+    is the window size, and finding the median takes O(1). Removed values are only
+    marked as removed and are popped when they reach the top of their heap. Each
+    value is identified by a key, which must be unique.
+    """
+
+    def __init__(self):
+        self._low = []  # Max-heap, as (-value, key)
+        self._high = []  # Min-heap, as (value, key)
+        self._low_size = 0
+        self._high_size = 0
+        self._in_low = {}
+        self._removed = set()
+
+    def __len__(self):
+        return self._low_size + self._high_size
+
+    def add(self, key, value):
+        if self._low_size and value > -self._low[0][0]:
+            heapq.heappush(self._high, (value, key))
+            self._in_low[key] = False
+            self._high_size += 1
+        else:
+            heapq.heappush(self._low, (-value, key))
+            self._in_low[key] = True
+            self._low_size += 1
+        self._rebalance()
+
+    def remove(self, key):
+        self._removed.add(key)
+        if self._in_low.pop(key):
+            self._low_size -= 1
+        else:
+            self._high_size -= 1
+        self._prune(self._low)
+        self._prune(self._high)
+        self._rebalance()
+
+    def median(self):
+        if self._low_size > self._high_size:
+            return -self._low[0][0]
+        return (-self._low[0][0] + self._high[0][0]) / 2
+
+    def _rebalance(self):
+        if self._low_size > self._high_size + 1:
+            value, key = heapq.heappop(self._low)
+            heapq.heappush(self._high, (-value, key))
+            self._in_low[key] = False
+            self._low_size -= 1
+            self._high_size += 1
+            self._prune(self._low)
+        elif self._low_size < self._high_size:
+            value, key = heapq.heappop(self._high)
+            heapq.heappush(self._low, (-value, key))
+            self._in_low[key] = True
+            self._high_size -= 1
+            self._low_size += 1
+            self._prune(self._high)
+
+    def _prune(self, heap):
+        while heap and heap[0][1] in self._removed:
+            self._removed.remove(heapq.heappop(heap)[1])
+
+
+class SpikeKernel(Kernel):
+    """Remove and flag values that differ too much from the preceding values.
+
+    A value is a spike if it differs from the median of the "window" non-null values
+    that precede it by more than "allowed_diff". Values with fewer than "window"
+    non-null values before them are not checked. Spikes remain in the window of the
+    values that follow them, so that a genuine change of level does not result in
+    the removal of all subsequent values. The median is maintained with
+    SlidingMedian, so the time needed is O(N log W). "context" is as in
+    RateOfChangeKernel; the context saved is the last "window" non-null values.
+    """
+
+    def __init__(self, window, allowed_diff, context=None):
+        self.window = window
+        self.allowed_diff = allowed_diff
+        self.context = context
+
+    def __call__(self, timestamps, values):
+        context_length = 0
+        if self.context is not None:
+            series = pd.Series(values, index=pd.to_datetime(timestamps, utc=True))
+            context = self.context.get_context(series)
+            if context is not None:
+                context_length = len(context)
+                series = pd.concat([context, series])
+            self.context.save_context(
+                series.dropna().tail(self.window), end_date=series.index[-1]
+            )
+            values = series.values
+        medians = self._get_medians(values)
+        with np.errstate(invalid="ignore"):
+            remove = (np.abs(values - medians) > self.allowed_diff)[context_length:]
+        flags = np.where(remove, flag_registry.get_bit("SPIKE"), np.uint32(0))
+        return remove, flags.astype(np.uint32)
+
+    def _get_medians(self, values):
+        """Return the median of the window before each value (NaN if incomplete)."""
+        medians = np.full(len(values), np.nan)
+        sliding_median = SlidingMedian()
+        window_keys = deque()
+        for i, value in enumerate(values.tolist()):
+            if len(window_keys) >= self.window:
+                medians[i] = sliding_median.median()
+            if value != value:  # NaN
+                continue
+            sliding_median.add(i, value)
+            window_keys.append(i)
+            if len(window_keys) > self.window:
+                sliding_median.remove(window_keys.popleft())
+        return medians
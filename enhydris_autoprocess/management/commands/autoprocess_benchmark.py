@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from enhydris_autoprocess import benchmarks
+
+
+class Command(BaseCommand):
+    help = "Run the enhydris-autoprocess benchmarks whose name starts with PREFIX."
+
+    def add_arguments(self, parser):
+        parser.add_argument("prefix", nargs="?", default="")
+        parser.add_argument("--records", type=int, default=100000)
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        try:
+            result = benchmarks.run(
+                options["prefix"], records=options["records"], repeat=options["repeat"]
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        if not result:
+            raise CommandError(f'No benchmark name starts with "{options["prefix"]}"')
+        for name, seconds in result:
+            records_per_second = options["records"] / seconds
+            self.stdout.write(
+                f"{name:40} {seconds:10.3f} s {records_per_second:12.0f} records/s"
+            )
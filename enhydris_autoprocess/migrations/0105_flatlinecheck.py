@@ -0,0 +1,44 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("enhydris_autoprocess", "0104_timeseries_name"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FlatLineCheck",
+            fields=[
+                (
+                    "checks",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to="enhydris_autoprocess.Checks",
+                    ),
+                ),
+                (
+                    "duration",
+                    models.CharField(
+                        help_text=(
+                            "Records whose value has remained unchanged for longer "
+                            "than this are flagged as FLATLINE (but not removed). "
+                            'Specify it like "6H", i.e. a number plus a unit, with '
+                            "no space in between. The units available are min "
+                            "(minutes), H (hours) and D (days)."
+                        ),
+                        max_length=6,
+                        verbose_name="Duration",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Flat line check",
+                "verbose_name_plural": "Flat line checks",
+            },
+        ),
+    ]
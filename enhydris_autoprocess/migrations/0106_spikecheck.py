@@ -0,0 +1,52 @@
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("enhydris_autoprocess", "0105_flatlinecheck"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SpikeCheck",
+            fields=[
+                (
+                    "checks",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to="enhydris_autoprocess.Checks",
+                    ),
+                ),
+                (
+                    "window",
+                    models.PositiveSmallIntegerField(
+                        help_text=(
+                            "The number of non-null values before each value whose "
+                            "median the value is compared with."
+                        ),
+                        validators=[django.core.validators.MinValueValidator(1)],
+                        verbose_name="Window",
+                    ),
+                ),
+                (
+                    "allowed_diff",
+                    models.FloatField(
+                        help_text=(
+                            "Values that differ from the median by more than this "
+                            "are considered spikes and are removed."
+                        ),
+                        verbose_name="Allowed difference",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Spike check",
+                "verbose_name_plural": "Spike checks",
+            },
+        ),
+    ]
@@ -0,0 +1,52 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("enhydris_autoprocess", "0106_spikecheck"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RangeCheckBound",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("month", models.PositiveSmallIntegerField()),
+                ("hour", models.PositiveSmallIntegerField(blank=True, null=True)),
+                ("lower_bound", models.FloatField(blank=True, null=True)),
+                ("soft_lower_bound", models.FloatField(blank=True, null=True)),
+                ("soft_upper_bound", models.FloatField(blank=True, null=True)),
+                ("upper_bound", models.FloatField(blank=True, null=True)),
+                (
+                    "range_check",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="enhydris_autoprocess.RangeCheck",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("range_check", "month", "hour"),
+                        name="unique_range_check_bound_hour",
+                    ),
+                    models.UniqueConstraint(
+                        condition=models.Q(hour__isnull=True),
+                        fields=("range_check", "month"),
+                        name="unique_range_check_bound_month",
+                    ),
+                ],
+            },
+        ),
+    ]
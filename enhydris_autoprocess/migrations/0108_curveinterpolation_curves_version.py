@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("enhydris_autoprocess", "0107_rangecheckbound"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="curveinterpolation",
+            name="curves_version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
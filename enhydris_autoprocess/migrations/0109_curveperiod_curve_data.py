@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("enhydris_autoprocess", "0108_curveinterpolation_curves_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="curveperiod",
+            name="curve_data",
+            field=models.BinaryField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("enhydris_autoprocess", "0109_curveperiod_curve_data"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AggregationState",
+            fields=[
+                (
+                    "aggregation",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to="enhydris_autoprocess.aggregation",
+                    ),
+                ),
+                ("source_end_date", models.DateTimeField()),
+                ("target_end_date", models.DateTimeField(blank=True, null=True)),
+                ("bucket_end_date", models.DateTimeField(blank=True, null=True)),
+                ("count", models.PositiveIntegerField(default=0)),
+                ("sum", models.FloatField(default=0)),
+                ("min", models.FloatField(blank=True, null=True)),
+                ("max", models.FloatField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("enhydris_autoprocess", "0110_aggregationstate"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="aggregation",
+            name="source_aggregation",
+            field=models.ForeignKey(
+                blank=True,
+                help_text=(
+                    "Optionally, another aggregation of the same time series group "
+                    "whose result to use as source instead of the checked or initial "
+                    "time series; e.g. derive the daily sum from the hourly sum "
+                    "instead of from the ten-minute time series. The method must be "
+                    "the same and it must be sum, max or min. The time step of the "
+                    "source aggregation must divide the day and the target time step. "
+                    "Max missing still refers to the records of the time series from "
+                    "which the source aggregation starts; since the number of missing "
+                    "records in an omitted or MISS-flagged source record is not "
+                    "known, it is taken at its highest, so a record is never derived "
+                    "when it would not be derived without the source aggregation."
+                ),
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="cascaded_aggregations",
+                to="enhydris_autoprocess.aggregation",
+                verbose_name="Source aggregation",
+            ),
+        ),
+    ]
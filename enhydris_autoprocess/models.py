@@ -1,9 +1,11 @@
-import csv
+import copy
 import datetime as dt
 import logging
 import re
-from io import StringIO
+from contextlib import contextmanager
 
+from django.core.cache import cache
+from django.core.validators import MinValueValidator
 from django.db import DataError, IntegrityError, models, transaction
 from django.db.models.signals import post_delete
 from django.utils.translation import gettext_lazy as _
@@ -13,28 +15,168 @@ import pandas as pd
 from haggregate import RegularizationMode as RM
 from haggregate import RegularizeError, aggregate, regularize
 from htimeseries import HTimeseries
-from rocc import Threshold, rocc
-
-from enhydris.models import Timeseries, TimeseriesGroup, check_time_step
+from rocc import Threshold
+
+from enhydris.models import (
+    Timeseries,
+    TimeseriesGroup,
+    TimeseriesRecord,
+    check_time_step,
+)
+
+from . import batch, benchmarks, buckets, dependencies, sqlaggregate, tasks
+from .append import append_data
+from .curves import (
+    CompiledCurves,
+    curve_cache,
+    decode_curve,
+    encode_curve,
+    get_curve_storage,
+)
+from .datacache import data_cache
+from .flags import flag_registry
+from .kernels import (
+    FlatLineKernel,
+    RangeKernel,
+    RateOfChangeKernel,
+    SpikeKernel,
+    get_timestamps,
+    run_kernels,
+)
+
+
+class AutoProcessManager(models.Manager):
+    """A manager that joins the subclass tables.
+
+    AutoProcess objects are always instances of one of its subclasses (see
+    AutoProcess.as_specific_instance). This manager retrieves the subclass rows in
+    the same query as the AutoProcess rows, so that finding the subclass of any
+    number of AutoProcess objects doesn't need any additional queries.
+    """
 
-from . import tasks
+    def get_queryset(self):
+        return (
+            super()
+            .get_queryset()
+            .select_related("checks", "curveinterpolation", "aggregation")
+        )
 
 
 class AutoProcess(models.Model):
     timeseries_group = models.ForeignKey(TimeseriesGroup, on_delete=models.CASCADE)
+    objects = AutoProcessManager()
+
+    # The source time series is read and processed in chunks of this length, so
+    # that the memory needed doesn't depend on how much data is pending.
+    chunk_duration = dt.timedelta(days=365)
 
     class Meta:
         verbose_name_plural = _("Auto processes")
 
     def execute(self):
+        with self.memoizing_timeseries():
+            self._appended_data_start_date = self._get_start_date()
+            if hasattr(self, "_htimeseries"):
+                # The source data has been handed off to us (see hand_off_to())
+                self._appended_data = self._execute_chunk()
+            else:
+                self._execute_in_chunks()
+
+    def _execute_in_chunks(self):
+        """Read, process and append the new part of the source, one chunk at a time.
+
+        Each chunk is read together with the part of the source that precedes it by
+        the chunk overlap (see _get_chunk_overlap()), because some auto processes
+        need earlier records in order to process a record. Resulting records that
+        already exist in the target time series are discarded. The source is read at
+        least once, even if it is empty (also when the target is not, e.g. because
+        the source time series has been replaced).
+        """
+        chunk_start = self._appended_data_start_date
+        if chunk_start is None:
+            chunk_start = self.source_timeseries.start_date
+        source_end_date = self.source_timeseries.end_date
+        overlap = self._get_chunk_overlap()
+        results = []
+        while True:
+            if chunk_start is None:
+                chunk_end = None
+                self._htimeseries = data_cache.get_data(self.source_timeseries)
+            else:
+                chunk_end = chunk_start + self.chunk_duration
+                self._htimeseries = data_cache.get_data(
+                    self.source_timeseries,
+                    start_date=chunk_start - overlap,
+                    end_date=chunk_end - dt.timedelta(microseconds=1),
+                )
+            results.append(self._execute_chunk())
+            if (
+                chunk_end is None
+                or source_end_date is None
+                or chunk_end > source_end_date
+            ):
+                break
+            chunk_start = chunk_end
+
+        # If everything has been processed in one go, the result can be handed off
+        # to the consumers; otherwise they'll need to read it from the database.
+        self._appended_data = results[0] if len(results) == 1 else None
+
+    def _execute_chunk(self):
         result = self.process_timeseries()
-        self.target_timeseries.append_data(result)
+        result = self._discard_existing_records(result)
+        append_data(self.target_timeseries, result)
+        return result
+
+    def _discard_existing_records(self, result):
+        data = result.data if isinstance(result, HTimeseries) else result
+        target_end_date = self.target_timeseries.end_date
+        if target_end_date is None or not len(data) or data.index[0] > target_end_date:
+            return result
+        data = data.loc[data.index > target_end_date]
+        if isinstance(result, HTimeseries):
+            result.data = data
+            return result
+        return data
+
+    def _get_chunk_overlap(self):
+        """Return how far before a chunk the source must be read to process it."""
+        return dt.timedelta(0)
+
+    def hand_off_to(self, consumer):
+        """Pass the data just appended to the target time series to a consumer.
+
+        "consumer" is an auto process whose source time series is the target time
+        series of self. After self has been executed, this method provides the
+        consumer with the data self has just appended, so that the consumer does not
+        need to read it back from the database. If the consumer needs older data
+        (i.e. its target time series ends before the data that has just been
+        appended), this method does nothing, and the consumer will read its source
+        data from the database as usual.
+        """
+        appended_data = getattr(self, "_appended_data", None)
+        if appended_data is None:
+            return
+        consumer_start_date = consumer._get_start_date()
+        if self._appended_data_start_date is not None and (
+            consumer_start_date is None
+            or consumer_start_date < self._appended_data_start_date
+        ):
+            return
+        if isinstance(appended_data, HTimeseries):
+            appended_data = appended_data.data
+        if consumer_start_date is not None:
+            appended_data = appended_data.loc[consumer_start_date:]
+        htimeseries = copy.copy(self.htimeseries)
+        htimeseries.data = appended_data.copy()
+        htimeseries.time_step = consumer.source_timeseries.time_step
+        consumer._htimeseries = htimeseries
 
     @property
     def htimeseries(self):
         if not hasattr(self, "_htimeseries"):
-            self._htimeseries = self.source_timeseries.get_data(
-                start_date=self._get_start_date()
+            self._htimeseries = data_cache.get_data(
+                self.source_timeseries, start_date=self._get_start_date()
             )
         return self._htimeseries
 
@@ -52,7 +194,10 @@ class AutoProcess(models.Model):
         AutoProcess object and there exists a related Checks object, this is accessible
         as auto_process.checks. So by checking whether the auto_process object ("self"
         in this case) has a "checks" (or "curveinterpolation", or "aggregation")
-        attribute, we can figure out what the actual subclass is.
+        attribute, we can figure out what the actual subclass is. If the object has
+        been retrieved with AutoProcess.objects (or with a related manager such as
+        timeseries_group.autoprocess_set), the subclass rows have already been
+        fetched together with the AutoProcess row, and this causes no queries.
         """
         for alternative in ("checks", "curveinterpolation", "aggregation"):
             if hasattr(self, alternative):
@@ -65,17 +210,95 @@ class AutoProcess(models.Model):
         return start_date
 
     def save(self, *args, **kwargs):
+        self._invalidate_old_dependencies()
         result = super().save(*args, **kwargs)
-        transaction.on_commit(lambda: tasks.execute_auto_process.delay(self.id))
+        dependencies.invalidate(self.timeseries_group_id)
+        transaction.on_commit(lambda: tasks.enqueue_auto_process(self.id))
         return result
 
+    def _invalidate_old_dependencies(self):
+        # If the time series group is being changed, we also need to invalidate the
+        # dependencies of the group the auto process used to belong to.
+        if self.pk is None:
+            return
+        old_timeseries_group_ids = AutoProcess.objects.filter(pk=self.pk).values_list(
+            "timeseries_group_id", flat=True
+        )
+        for timeseries_group_id in old_timeseries_group_ids:
+            dependencies.invalidate(timeseries_group_id)
+
     @property
     def source_timeseries(self):
+        return self._memoize("source", self._get_source_timeseries)
+
+    def _get_source_timeseries(self):
         raise NotImplementedError("This property is available only in subclasses")
 
+    def find_source_timeseries(self, timeseries_list):
+        """Return the source time series from among the time series of the group.
+
+        "timeseries_list" is a list of all the time series of the group. Unlike the
+        source_timeseries property, this method doesn't access the database (and
+        doesn't create any time series); it returns None if no suitable time series
+        is in the list.
+        """
+        for type in self.source_timeseries_types:
+            for timeseries in timeseries_list:
+                if timeseries.type == type:
+                    return timeseries
+
     @property
     def target_timeseries(self):
-        raise NotImplementedError("This property is available only in subclasses")
+        return self._memoize("target", self._get_target_timeseries)
+
+    def _get_target_timeseries(self):
+        timeseries_group, lookup = self._get_target_timeseries_lookup()
+        obj, created = timeseries_group.timeseries_set.get_or_create(**lookup)
+        return obj
+
+    def find_target_timeseries(self):
+        """Return the target time series, or None if it doesn't exist.
+
+        Unlike the target_timeseries property, this method doesn't create the time
+        series (creating it would trigger the auto processes that use it as source).
+        """
+        timeseries_group, lookup = self._get_target_timeseries_lookup()
+        return timeseries_group.timeseries_set.filter(**lookup).first()
+
+    def _get_target_timeseries_lookup(self):
+        """Return the group of the target time series and the lookup that finds it."""
+        raise NotImplementedError("This method is available only in subclasses")
+
+    @contextmanager
+    def memoizing_timeseries(self):
+        """Resolve source_timeseries and target_timeseries only once in a block.
+
+        Normally each access to these properties results in a query (and possibly in
+        the creation of the time series). Within "with self.memoizing_timeseries()",
+        the time series are found on first access and then reused. They are found
+        again if a field on which they depend (see _get_timeseries_key()) changes.
+        """
+        self._memoized_timeseries = {}
+        try:
+            yield
+        finally:
+            self._memoized_timeseries = None
+
+    def _memoize(self, name, get):
+        memo = getattr(self, "_memoized_timeseries", None)
+        if memo is None:
+            return get()
+        key = (name, self._get_timeseries_key())
+        if key not in memo:
+            memo[key] = get()
+        return memo[key]
+
+    def _get_timeseries_key(self):
+        """Return the values of the fields on which the source and target depend."""
+        return (self.timeseries_group_id,)
+
+
+post_delete.connect(dependencies.invalidate_on_deletion, sender=AutoProcess)
 
 
 class SelectRelatedManager(models.Manager):
@@ -93,33 +316,91 @@ class SelectRelatedManager(models.Manager):
 class Checks(AutoProcess):
     objects = SelectRelatedManager()
     check_types = []
+    source_timeseries_types = (Timeseries.INITIAL,)
 
     def __str__(self):
         return _("Checks for {}").format(str(self.timeseries_group))
 
-    @property
-    def source_timeseries(self):
+    def _get_source_timeseries(self):
         obj, created = self.timeseries_group.timeseries_set.get_or_create(
             type=Timeseries.INITIAL
         )
         return obj
 
-    @property
-    def target_timeseries(self):
-        obj, created = self.timeseries_group.timeseries_set.get_or_create(
-            type=Timeseries.CHECKED
+    def _get_target_timeseries_lookup(self):
+        return self.timeseries_group, {"type": Timeseries.CHECKED}
+
+    def get_checks(self):
+        """Return the existing checks (RangeCheck etc.) in the order of check_types.
+
+        The checks are loaded in a single query, plus one query for each of their
+        prefetch_related_lookups (e.g. the thresholds of the RateOfChangeCheck),
+        regardless of the number of check types. Within memoizing_timeseries() (and
+        therefore during execute()), they are loaded only once.
+        """
+        return self._memoize("checks", self._load_checks)
+
+    def _load_checks(self):
+        related_names = [check_type._meta.model_name for check_type in self.check_types]
+        prefetch_related_lookups = [
+            f"{check_type._meta.model_name}__{lookup}"
+            for check_type in self.check_types
+            for lookup in getattr(check_type, "prefetch_related_lookups", ())
+        ]
+        checks = (
+            Checks.objects.select_related(*related_names)
+            .prefetch_related(*prefetch_related_lookups)
+            .get(pk=self.pk)
         )
-        return obj
+        return [
+            getattr(checks, related_name)
+            for related_name in related_names
+            if hasattr(checks, related_name)
+        ]
+
+    def execute(self):
+        # Data handed off to us (see hand_off_to()) doesn't include the records that
+        # precede it, which the checks need if they have no context.
+        if hasattr(self, "_htimeseries") and self._get_chunk_overlap():
+            del self._htimeseries
+        super().execute()
+
+    def _get_chunk_overlap(self):
+        # If a check that needs preceding records has no context (e.g. it has just
+        # been added, or the cache has been cleared), the source is read from where
+        # the records it needs start. The overlap must then also cover the records
+        # needed by the rest of the checks, because their contexts are only used for
+        # the records that precede the overlap (see Check.get_context()).
+        checks = self.get_checks()
+        end_date = self.target_timeseries.end_date
+        start_date = self._get_start_date()
+        overlaps = [
+            (check, check.get_chunk_overlap(self.target_timeseries, start_date))
+            for check in checks
+        ]
+        if all(
+            not overlap or check.has_context(end_date) for check, overlap in overlaps
+        ):
+            return dt.timedelta(0)
+        return max(overlap for check, overlap in overlaps)
+
+    def _execute_chunk(self):
+        # A context is only valid if it is of a check that ended where the target
+        # time series ends (it isn't, for example, if the target time series has
+        # been modified after it was saved).
+        end_date = self.target_timeseries.end_date
+        for check in self.get_checks():
+            if not check.has_context(end_date):
+                check.delete_context()
+        return super()._execute_chunk()
 
     def process_timeseries(self):
-        for check_type in self.check_types:
-            checked_timeseries = self.htimeseries
-            try:
-                check = check_type.objects.get(checks=self)
-                checked_timeseries = check.check_timeseries(checked_timeseries)
-            except check_type.DoesNotExist:
-                pass
-        return checked_timeseries.data
+        # The kernels of consecutive pointwise checks are run in one pass (see
+        # kernels.py)
+        data = self.htimeseries.data
+        run_kernels([check.get_kernel() for check in self.get_checks()], data)
+        # The checks add flags as bits (see flags.py); now convert them to strings
+        return flag_registry.to_strings(data)
 
 
 def delete_checks_if_no_check(sender, instance, **kwargs):
@@ -130,7 +411,125 @@ def delete_checks_if_no_check(sender, instance, **kwargs):
     checks.delete()
 
 
-class RangeCheck(models.Model):
+def register_check(check_type):
+    """Register a check type (a subclass of Check) with Checks.
+
+    The checks are performed in the order in which their types have been registered.
+    Other apps can use this as a class decorator to add checks. It also registers a
+    "checks/<model name>" benchmark (see benchmarks.py).
+    """
+    Checks.check_types.append(check_type)
+    post_delete.connect(delete_checks_if_no_check, sender=check_type)
+    benchmarks.register_check(
+        check_type._meta.model_name, check_type.get_benchmark_kernel
+    )
+    return check_type
+
+
+class Check(models.Model):
+    """Base class for RangeCheck etc.
+
+    Subclasses must have a one-to-one "checks" field with primary_key=True, and must
+    implement get_kernel(), which returns the kernel (see kernels.py) that performs
+    the check, and get_benchmark_kernel(), which returns a kernel with typical
+    parameters for benchmarking.
+    """
+
+    class Meta:
+        abstract = True
+
+    def get_kernel(self):
+        raise NotImplementedError("Check subclasses must implement get_kernel()")
+
+    @classmethod
+    def get_benchmark_kernel(cls):
+        raise NotImplementedError(
+            "Check subclasses must implement get_benchmark_kernel()"
+        )
+
+    def check_timeseries(self, source_htimeseries):
+        run_kernels([self.get_kernel()], source_htimeseries.data)
+        return source_htimeseries
+
+    # Checks whose result for a record depends on the preceding records keep the
+    # records they will need at the end of each checked part of the time series in
+    # the cache as "context", and pass themselves as the "context" of their kernel
+    # (see RateOfChangeKernel), so that the next part can be checked without reading
+    # the source time series again. The context is cached together with the date of
+    # the last record checked, and Checks discards it unless that is the end date of
+    # the target time series. It is also cached with the parameters of the check on
+    # which it depends (see get_context_parameters()), and it is not used if these
+    # have changed; deleting the context when they change is not enough, because the
+    # cache may not be shared with the process that uses it. If there is no context,
+    # Checks reads the records that precede the new part again (see
+    # get_chunk_overlap()).
+    CONTEXT_TIMEOUT = None
+
+    def _get_context_key(self):
+        return f"autoprocess_{self._meta.model_name}_context_{self.checks_id}"
+
+    def get_context_parameters(self):
+        """Return the parameters of the check on which the context depends."""
+        return None
+
+    def _get_cached_context(self):
+        """Return the cached context and the date of the last record checked.
+
+        Returns (None, None) if there is no context, or if it was saved with other
+        parameters.
+        """
+        context, end_date, parameters = cache.get(
+            self._get_context_key(), (None, None, None)
+        )
+        if context is None or parameters != self.get_context_parameters():
+            return None, None
+        return context, end_date
+
+    def get_context(self, values):
+        """Return the cached values that precede "values".
+
+        Returns None if there are no such values.
+        """
+        context, end_date = self._get_cached_context()
+        if context is None:
+            return None
+        context = context.loc[context.index < values.index[0]]
+        return None if context.empty else context
+
+    def save_context(self, values, end_date=None):
+        """Cache "values" as the context.
+
+        "end_date" is the date of the last record checked; by default it is the date
+        of the last of "values".
+        """
+        if end_date is None:
+            end_date = values.index[-1]
+        cache.set(
+            self._get_context_key(),
+            (values, end_date, self.get_context_parameters()),
+            self.CONTEXT_TIMEOUT,
+        )
+
+    def has_context(self, end_date):
+        """Return True if the cached context is of a check that ended at "end_date"."""
+        context, context_end_date = self._get_cached_context()
+        return context is not None and context_end_date == end_date
+
+    def get_chunk_overlap(self, checked_timeseries, start_date):
+        """Return how far before "start_date" the records needed to check it start.
+
+        "checked_timeseries" is the target time series of the Checks, whose records
+        are the same as those of the source. This is what must be read before the
+        records to be checked when there is no context.
+        """
+        return dt.timedelta(0)
+
+    def delete_context(self):
+        cache.delete(self._get_context_key())
+
+
+@register_check
+class RangeCheck(Check):
     checks = models.OneToOneField(Checks, on_delete=models.CASCADE, primary_key=True)
     upper_bound = models.FloatField(verbose_name=_("Upper bound"))
     lower_bound = models.FloatField(verbose_name=_("Lower bound"))
@@ -141,6 +540,7 @@ class RangeCheck(models.Model):
         blank=True, null=True, verbose_name=_("Soft lower bound")
     )
     objects = SelectRelatedManager()
+    prefetch_related_lookups = ("rangecheckbound_set",)
 
     class Meta:
         verbose_name = _("Range check")
@@ -149,46 +549,143 @@ class RangeCheck(models.Model):
     def __str__(self):
         return _("Range check for {}").format(str(self.checks.timeseries_group))
 
-    def check_timeseries(self, source_htimeseries):
-        result = self._do_hard_limits(source_htimeseries)
-        result = self._do_soft_limits(result)
-        return result
-
-    def _do_hard_limits(self, source_htimeseries):
-        mask = self._find_out_of_bounds_values(
-            source_htimeseries, self.lower_bound, self.upper_bound
-        )
-        self._replace_out_of_bounds_values_with_nan(source_htimeseries, mask)
-        return self._add_flag_to_out_of_bounds_values(source_htimeseries, mask, "RANGE")
+    def get_kernel(self):
+        return RangeKernel(*self.get_bounds())
 
-    def _do_soft_limits(self, source_htimeseries):
-        mask = self._find_out_of_bounds_values(
-            source_htimeseries, self.soft_lower_bound, self.soft_upper_bound
+    @classmethod
+    def get_benchmark_kernel(cls):
+        tables = [np.full((12, 24), bound) for bound in (10.0, 30.0, 15.0, 25.0)]
+        for table in tables:
+            table[5:8, 10:18] += 5  # Summer afternoons
+        return RangeKernel(*tables)
+
+    def get_bounds(self):
+        """Return the lower, upper, soft lower and soft upper bound.
+
+        If there are no seasonal bounds (RangeCheckBound objects), these are the
+        bounds of the range check. Otherwise each one is a 12x24 array with the bound
+        for each month and hour of the day, where NaN means no bound. The bounds of
+        the range check apply unless overridden by seasonal bounds for the month,
+        which apply unless overridden by seasonal bounds for the month and hour.
+        """
+        bounds = [
+            self.lower_bound,
+            self.upper_bound,
+            self.soft_lower_bound,
+            self.soft_upper_bound,
+        ]
+        # Sorted in Python, so that bounds prefetched by Checks.get_checks() are used
+        # without another query
+        seasonal_bounds = sorted(
+            self.rangecheckbound_set.all(),
+            key=lambda b: (b.hour is not None, b.month, b.hour or 0),
         )
-        return self._add_flag_to_out_of_bounds_values(
-            source_htimeseries, mask, "SUSPECT"
+        if not seasonal_bounds:
+            return bounds
+        tables = [np.full((12, 24), np.nan if b is None else b) for b in bounds]
+        for seasonal_bound in seasonal_bounds:
+            month = seasonal_bound.month - 1
+            hours = slice(None) if seasonal_bound.hour is None else seasonal_bound.hour
+            for table, bound in zip(tables, seasonal_bound.bounds):
+                if bound is not None:
+                    table[month, hours] = bound
+        return tables
+
+    def get_seasonal_bounds_as_text(self):
+        seasonal_bounds = sorted(
+            self.rangecheckbound_set.all(),
+            key=lambda b: (b.month, b.hour is not None, b.hour or 0),
         )
+        return "".join(f"{b.as_text()}\n" for b in seasonal_bounds)
 
-    def _find_out_of_bounds_values(self, source_htimeseries, low, high):
-        timeseries = source_htimeseries.data
-        return ~pd.isnull(timeseries["value"]) & ~timeseries["value"].between(low, high)
+    def set_seasonal_bounds(self, s):
+        seasonal_bounds = [
+            RangeCheckBound(range_check=self, **RangeCheckBound.parse_text(line))
+            for line in s.splitlines()
+            if line.strip()
+        ]
+        self.rangecheckbound_set.all().delete()
+        RangeCheckBound.objects.bulk_create(seasonal_bounds)
 
-    def _replace_out_of_bounds_values_with_nan(self, ahtimeseries, mask):
-        ahtimeseries.data.loc[mask, "value"] = np.nan
-        return ahtimeseries
 
-    def _add_flag_to_out_of_bounds_values(self, ahtimeseries, mask, flag):
-        out_of_bounds_with_flags_mask = mask & (ahtimeseries.data["flags"] != "")
-        ahtimeseries.data.loc[out_of_bounds_with_flags_mask, "flags"] += " "
-        ahtimeseries.data.loc[mask, "flags"] += flag
-        return ahtimeseries
+class RangeCheckBound(models.Model):
+    """Bounds of a RangeCheck that apply to a month, or to an hour of a month.
+
+    A null bound means that the bound of the range check (or, for an hour, of the
+    month) applies.
+    """
 
+    range_check = models.ForeignKey(RangeCheck, on_delete=models.CASCADE)
+    month = models.PositiveSmallIntegerField()
+    hour = models.PositiveSmallIntegerField(blank=True, null=True)
+    lower_bound = models.FloatField(blank=True, null=True)
+    soft_lower_bound = models.FloatField(blank=True, null=True)
+    soft_upper_bound = models.FloatField(blank=True, null=True)
+    upper_bound = models.FloatField(blank=True, null=True)
 
-Checks.check_types.append(RangeCheck)
-post_delete.connect(delete_checks_if_no_check, sender=RangeCheck)
+    class Meta:
+        # The hour is null for the bounds of the whole month, and nulls are
+        # distinct, so the bounds of the whole month need a constraint of their own
+        constraints = [
+            models.UniqueConstraint(
+                fields=["range_check", "month", "hour"],
+                name="unique_range_check_bound_hour",
+            ),
+            models.UniqueConstraint(
+                fields=["range_check", "month"],
+                condition=models.Q(hour__isnull=True),
+                name="unique_range_check_bound_month",
+            ),
+        ]
+
+    @property
+    def bounds(self):
+        """The bounds in the order lower, upper, soft lower, soft upper."""
+        return (
+            self.lower_bound,
+            self.upper_bound,
+            self.soft_lower_bound,
+            self.soft_upper_bound,
+        )
+
+    @classmethod
+    def parse_text(cls, line):
+        """Parse a line like "7:14 - 25 38 -" and return the field values.
+
+        The line contains the month (optionally followed by a colon and the hour of
+        the day), the lower, soft lower, soft upper and upper bound, where "-" means
+        null. Raises ValueError if the line is invalid.
+        """
+        items = line.split()
+        if len(items) != 5:
+            raise ValueError(line)
+        month, sep, hour = items[0].partition(":")
+        result = {"month": int(month), "hour": int(hour) if sep else None}
+        if not 1 <= result["month"] <= 12:
+            raise ValueError(line)
+        if result["hour"] is not None and not 0 <= result["hour"] <= 23:
+            raise ValueError(line)
+        names = ("lower_bound", "soft_lower_bound", "soft_upper_bound", "upper_bound")
+        for name, item in zip(names, items[1:]):
+            result[name] = None if item == "-" else float(item)
+        return result
+
+    def as_text(self):
+        def format_bound(bound):
+            return "-" if bound is None else str(bound)
 
+        month = str(self.month) if self.hour is None else f"{self.month}:{self.hour}"
+        bounds = (
+            self.lower_bound,
+            self.soft_lower_bound,
+            self.soft_upper_bound,
+            self.upper_bound,
+        )
+        return "\t".join([month] + [format_bound(bound) for bound in bounds])
 
-class RateOfChangeCheck(models.Model):
+
+@register_check
+class RateOfChangeCheck(Check):
     checks = models.OneToOneField(Checks, on_delete=models.CASCADE, primary_key=True)
     symmetric = models.BooleanField(
         help_text=_(
@@ -200,6 +697,7 @@ class RateOfChangeCheck(models.Model):
         verbose_name=_("Symmetric"),
     )
     objects = SelectRelatedManager()
+    prefetch_related_lookups = ("rateofchangethreshold_set",)
 
     class Meta:
         verbose_name = _("Time consistency check")
@@ -210,46 +708,90 @@ class RateOfChangeCheck(models.Model):
             str(self.checks.timeseries_group)
         )
 
-    def check_timeseries(self, source_htimeseries):
-        rocc(
-            timeseries=source_htimeseries,
-            thresholds=self.thresholds,
-            symmetric=self.symmetric,
-            flag="TEMPORAL",
+    # The context (see Check) is the records within the lookback before the end of
+    # the last checked part of the time series (see also Checks._get_chunk_overlap()).
+    def get_kernel(self):
+        return RateOfChangeKernel(self.thresholds, self.symmetric, context=self)
+
+    @classmethod
+    def get_benchmark_kernel(cls):
+        return RateOfChangeKernel(
+            [Threshold("10min", 5), Threshold("1H", 10)], symmetric=True
         )
-        data = source_htimeseries.data
-        data.loc[data["flags"].str.contains("TEMPORAL"), "value"] = np.nan
-        return source_htimeseries
+
+    def get_context_parameters(self):
+        return self.lookback
+
+    def get_context(self, values):
+        """Return the cached values that precede "values" within the lookback.
+
+        Returns None if there are no such values.
+        """
+        context, end_date = self._get_cached_context()
+        if context is None or context.empty:
+            return None
+        context = context.tz_convert(values.index.tz)
+        start_date = values.index[0]
+        context = context.loc[
+            (context.index >= start_date - self.lookback) & (context.index < start_date)
+        ]
+        return None if context.empty else context
+
+    def save_context(self, values, end_date=None):
+        # These are the values before any are removed by the check, which is how a
+        # check of the whole time series would see them.
+        context = values.loc[values.index >= values.index[-1] - self.lookback].copy()
+        super().save_context(context, end_date)
+
+    def get_chunk_overlap(self, checked_timeseries, start_date):
+        return self.lookback
 
     @property
     def thresholds(self):
-        thresholds = RateOfChangeThreshold.objects.filter(
-            rate_of_change_check=self
-        ).order_by("delta_t")
+        # Sorted in Python, so that thresholds prefetched by Checks.get_checks() are
+        # used without another query
+        thresholds = sorted(
+            self.rateofchangethreshold_set.all(),
+            key=lambda threshold: threshold.delta_t,
+        )
         result = []
         for threshold in thresholds:
             result.append(Threshold(threshold.delta_t, threshold.allowed_diff))
         return result
 
+    @property
+    def lookback(self):
+        """How far before a record we need to look in order to check it."""
+        return max(
+            (pd.Timedelta(threshold.delta_t) for threshold in self.thresholds),
+            default=pd.Timedelta(0),
+        )
+
     def get_thresholds_as_text(self):
         result = ""
         for threshold in self.thresholds:
             result += f"{threshold.delta_t}\t{threshold.allowed_diff}\n"
         return result
 
-    def set_thresholds(self, s):
-        self.rateofchangethreshold_set.all().delete()
-        for line in s.splitlines():
-            delta_t, allowed_diff = line.split()
-            RateOfChangeThreshold(
-                rate_of_change_check=self,
-                delta_t=delta_t,
-                allowed_diff=allowed_diff,
-            ).save()
+    @classmethod
+    def parse_thresholds(cls, s):
+        """Parse thresholds, one per line, and return a list of field values.
 
+        Raises ValueError if a line is invalid (see RateOfChangeThreshold.parse_text).
+        """
+        return [RateOfChangeThreshold.parse_text(line) for line in s.splitlines()]
 
-Checks.check_types.append(RateOfChangeCheck)
-post_delete.connect(delete_checks_if_no_check, sender=RateOfChangeCheck)
+    def set_thresholds(self, s):
+        self.set_parsed_thresholds(self.parse_thresholds(s))
+
+    def set_parsed_thresholds(self, thresholds):
+        """Replace the thresholds with ones returned by parse_thresholds()."""
+        self.delete_context()
+        self.rateofchangethreshold_set.all().delete()
+        RateOfChangeThreshold.objects.bulk_create(
+            RateOfChangeThreshold(rate_of_change_check=self, **threshold)
+            for threshold in thresholds
+        )
 
 
 class RateOfChangeThreshold(models.Model):
@@ -267,19 +809,153 @@ class RateOfChangeThreshold(models.Model):
         else:
             return True
 
+    @classmethod
+    def parse_text(cls, line):
+        """Parse a line like "10min 7.3" and return the field values.
+
+        Raises ValueError if the line is invalid.
+        """
+        try:
+            delta_t, allowed_diff = line.split()
+            allowed_diff = float(allowed_diff)
+            if not cls.is_delta_t_valid(delta_t):
+                raise ValueError()
+        except ValueError:
+            raise ValueError(
+                _('"{}" is not a valid (delta_t, allowed_diff) pair').format(line)
+            )
+        return {"delta_t": delta_t, "allowed_diff": allowed_diff}
+
     def save(self, *args, **kwargs):
         if not self.is_delta_t_valid(self.delta_t):
             raise DataError(f'"{ self.delta_t }" is not a valid delta_t')
         super().save(*args, **kwargs)
 
 
+@register_check
+class FlatLineCheck(Check):
+    checks = models.OneToOneField(Checks, on_delete=models.CASCADE, primary_key=True)
+    duration = models.CharField(
+        max_length=6,
+        help_text=_(
+            "Records whose value has remained unchanged for longer than this are "
+            'flagged as FLATLINE (but not removed). Specify it like "6H", i.e. a '
+            "number plus a unit, with no space in between. The units available are "
+            "min (minutes), H (hours) and D (days)."
+        ),
+        verbose_name=_("Duration"),
+    )
+    objects = SelectRelatedManager()
+
+    class Meta:
+        verbose_name = _("Flat line check")
+        verbose_name_plural = _("Flat line checks")
+
+    def __str__(self):
+        return _("Flat line check for {}").format(str(self.checks.timeseries_group))
+
+    def save(self, *args, **kwargs):
+        if not RateOfChangeThreshold.is_delta_t_valid(self.duration):
+            raise DataError(f'"{ self.duration }" is not a valid duration')
+        super().save(*args, **kwargs)
+
+    # The context (see Check) is the first and last record of the last run of
+    # identical values checked (see FlatLineKernel).
+    def get_kernel(self):
+        return FlatLineKernel(self.duration, context=self)
+
+    @classmethod
+    def get_benchmark_kernel(cls):
+        return FlatLineKernel("1H")
+
+    def get_chunk_overlap(self, checked_timeseries, start_date):
+        # The records since the last one that is more than "duration" before
+        # start_date; without that one, a run of identical values that starts
+        # before it would seem to start later, and could be shorter than "duration".
+        if start_date is None:
+            return dt.timedelta(0)
+        duration = pd.Timedelta(self.duration).to_pytimedelta()
+        timestamp = (
+            TimeseriesRecord.objects.filter(
+                timeseries=checked_timeseries, timestamp__lt=start_date - duration
+            )
+            .order_by("-timestamp")
+            .values_list("timestamp", flat=True)
+            .first()
+        )
+        return duration if timestamp is None else start_date - timestamp
+
+
+@register_check
+class SpikeCheck(Check):
+    checks = models.OneToOneField(Checks, on_delete=models.CASCADE, primary_key=True)
+    window = models.PositiveSmallIntegerField(
+        validators=[MinValueValidator(1)],
+        help_text=_(
+            "The number of non-null values before each value whose median the value "
+            "is compared with."
+        ),
+        verbose_name=_("Window"),
+    )
+    allowed_diff = models.FloatField(
+        help_text=_(
+            "Values that differ from the median by more than this are considered "
+            "spikes and are removed."
+        ),
+        verbose_name=_("Allowed difference"),
+    )
+    objects = SelectRelatedManager()
+
+    class Meta:
+        verbose_name = _("Spike check")
+        verbose_name_plural = _("Spike checks")
+
+    def __str__(self):
+        return _("Spike check for {}").format(str(self.checks.timeseries_group))
+
+    # The context (see Check) is the last "window" non-null values checked (see
+    # SpikeKernel).
+    def get_kernel(self):
+        return SpikeKernel(self.window, self.allowed_diff, context=self)
+
+    def get_context_parameters(self):
+        return self.window
+
+    @classmethod
+    def get_benchmark_kernel(cls):
+        return SpikeKernel(12, 10)
+
+    def get_chunk_overlap(self, checked_timeseries, start_date):
+        # The records since the "window"th last non-null value. Values removed by
+        # this check remain in the window of the following values, so this counts
+        # the non-null values of the checked time series, of which there are at
+        # most as many as the check sees.
+        if start_date is None:
+            return dt.timedelta(0)
+        timestamps = list(
+            TimeseriesRecord.objects.filter(
+                timeseries=checked_timeseries,
+                timestamp__lt=start_date,
+                value__isnull=False,
+            )
+            .order_by("-timestamp")
+            .values_list("timestamp", flat=True)[: self.window]
+        )
+        if not timestamps:
+            return dt.timedelta(0)
+        return start_date - timestamps[-1]
+
+
 class CurveInterpolation(AutoProcess):
     target_timeseries_group = models.ForeignKey(
         TimeseriesGroup,
         on_delete=models.CASCADE,
         verbose_name=_("Target time series group"),
     )
+    # Increased whenever any of the periods or points changes (see curves.py)
+    curves_version = models.PositiveIntegerField(default=0, editable=False)
     objects = SelectRelatedManager()
+    source_timeseries_types = (Timeseries.CHECKED, Timeseries.INITIAL)
 
     class Meta:
         verbose_name = _("Curve interpolation")
@@ -288,8 +964,7 @@ class CurveInterpolation(AutoProcess):
     def __str__(self):
         return f"=> {self.target_timeseries_group}"
 
-    @property
-    def source_timeseries(self):
+    def _get_source_timeseries(self):
         try:
             return self.timeseries_group.timeseries_set.get(type=Timeseries.CHECKED)
         except Timeseries.DoesNotExist:
@@ -299,28 +974,45 @@ class CurveInterpolation(AutoProcess):
         )
         return obj
 
-    @property
-    def target_timeseries(self):
-        obj, created = self.target_timeseries_group.timeseries_set.get_or_create(
-            type=Timeseries.INITIAL
-        )
-        return obj
+    def _get_target_timeseries_lookup(self):
+        return self.target_timeseries_group, {"type": Timeseries.INITIAL}
+
+    def _get_timeseries_key(self):
+        return (self.timeseries_group_id, self.target_timeseries_group_id)
 
     def process_timeseries(self):
         source = self.htimeseries.data
         target = source.copy()
-        target["value"] = np.nan
         target["flags"] = ""
-        for period in self.curveperiod_set.order_by("start_date"):
-            x, y = period._get_curve()
-            utc = dt.timezone.utc
-            start = dt.datetime.combine(period.start_date, dt.time(0, 0), tzinfo=utc)
-            end = dt.datetime.combine(period.end_date, dt.time(23, 59), tzinfo=utc)
-            values_array = source.loc[start:end, "value"].values
-            new_array = np.interp(values_array, x, y, left=np.nan, right=np.nan)
-            target.loc[start:end, "value"] = new_array
+        target["value"] = self.get_compiled_curves().interpolate(
+            get_timestamps(source.index), source["value"].values
+        )
         return target
 
+    def get_compiled_curves(self):
+        """Return the curves of the periods as a CompiledCurves object.
+
+        The result is cached in the worker (see curves.py), so the curves are read
+        from the database only after they change.
+        """
+        return curve_cache.get((self.id, self.curves_version), self._compile_curves)
+
+    def _compile_curves(self):
+        periods = self.curveperiod_set.prefetch_related("curvepoint_set")
+        return CompiledCurves(
+            [
+                (period.id, period.start_date, period.end_date, *period._get_curve())
+                for period in periods
+            ]
+        )
+
+    def curves_changed(self):
+        """Increase curves_version, so that the compiled curves are not reused."""
+        CurveInterpolation.objects.filter(id=self.id).update(
+            curves_version=models.F("curves_version") + 1
+        )
+        self.curves_version += 1
+
 
 class CurvePeriod(models.Model):
     curve_interpolation = models.ForeignKey(
@@ -328,6 +1020,9 @@ class CurvePeriod(models.Model):
     )
     start_date = models.DateField(verbose_name=_("Start date"))
     end_date = models.DateField(verbose_name=_("End date"))
+    # If not null, the curve (see curves.encode_curve()); the points are then not
+    # stored as CurvePoint rows
+    curve_data = models.BinaryField(null=True, blank=True, editable=False)
     objects = SelectRelatedManager()
 
     class Meta:
@@ -339,25 +1034,69 @@ class CurvePeriod(models.Model):
             str(self.curve_interpolation), self.start_date, self.end_date
         )
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.curve_interpolation.curves_changed()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self.curve_interpolation.curves_changed()
+        return result
+
     def _get_curve(self):
-        x = []
-        y = []
-        for point in self.curvepoint_set.filter(curve_period=self).order_by("x"):
-            x.append(point.x)
-            y.append(point.y)
+        if self.curve_data is not None:
+            return decode_curve(self.curve_data)
+        # Sorted in Python, so that prefetched points are used without another query
+        points = sorted(self.curvepoint_set.all(), key=lambda point: point.x)
+        x = [point.x for point in points]
+        y = [point.y for point in points]
         return x, y
 
+    @classmethod
+    def parse_curve(cls, s):
+        """Parse points, one per line, and return a list of (x, y) tuples.
+
+        The x and y of each line can be separated by a comma or a tab. Any further
+        columns (e.g. when the points are pasted from a spreadsheet) are ignored.
+        Raises ValueError if a line is invalid.
+        """
+        result = []
+        for i, line in enumerate(s.splitlines()):
+            items = line.replace("\t", ",").split(",")[:2]
+            try:
+                x, y = [float(item) for item in items]
+            except ValueError:
+                raise ValueError(
+                    _('Error in line {}: "{}" is not a valid pair of numbers').format(
+                        i + 1, line
+                    )
+                )
+            result.append((x, y))
+        return result
+
     def set_curve(self, s):
         """Replaces all existing points with ones read from a string.
 
-        The string can be comma-delimited or tab-delimited, or a mix.
+        The string can be comma-delimited or tab-delimited, or a mix. The points are
+        stored as CurvePoint rows, or in curve_data if the
+        ENHYDRIS_AUTOPROCESS_CURVE_STORAGE setting is "binary".
         """
+        self.set_parsed_curve(self.parse_curve(s))
 
-        s = s.replace("\t", ",")
+    def set_parsed_curve(self, points):
+        """Replace all existing points with ones returned by parse_curve()."""
         self.curvepoint_set.all().delete()
-        for row in csv.reader(StringIO(s)):
-            x, y = [float(item) for item in row[:2]]
-            CurvePoint.objects.create(curve_period=self, x=x, y=y)
+        if get_curve_storage() == "binary":
+            self.curve_data = encode_curve(*zip(*points)) if points else b""
+            self.save(update_fields=["curve_data"])
+            return
+        if self.curve_data is not None:
+            self.curve_data = None
+            self.save(update_fields=["curve_data"])
+        CurvePoint.objects.bulk_create(
+            CurvePoint(curve_period=self, x=x, y=y) for x, y in points
+        )
+        self.curve_interpolation.curves_changed()
 
 
 class CurvePoint(models.Model):
@@ -369,6 +1108,15 @@ class CurvePoint(models.Model):
     def __str__(self):
         return _("{}: Point ({}, {})").format(str(self.curve_period), self.x, self.y)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.curve_period.curve_interpolation.curves_changed()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self.curve_period.curve_interpolation.curves_changed()
+        return result
+
 
 class Aggregation(AutoProcess):
     METHOD_CHOICES = [
@@ -415,7 +1163,34 @@ class Aggregation(AutoProcess):
         ),
         verbose_name=_("Resulting timestamp offset"),
     )
+    source_aggregation = models.ForeignKey(
+        "self",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="cascaded_aggregations",
+        help_text=_(
+            "Optionally, another aggregation of the same time series group whose "
+            "result to use as source instead of the checked or initial time series; "
+            "e.g. derive the daily sum from the hourly sum instead of from the "
+            "ten-minute time series. The method must be the same and it must be sum, "
+            "max or min. The time step of the source aggregation must divide the day "
+            "and the target time step. Max missing still refers to the records of "
+            "the time series from which the source aggregation starts; since the "
+            "number of missing records in an omitted or MISS-flagged source record "
+            "is not known, it is taken at its highest, so a record is never derived "
+            "when it would not be derived without the source aggregation."
+        ),
+        verbose_name=_("Source aggregation"),
+    )
     objects = SelectRelatedManager()
+    source_timeseries_types = (Timeseries.CHECKED, Timeseries.INITIAL)
+    cascadable_methods = ("sum", "max", "min")
+
+    # If the time step of the source time series is not stored, it is inferred from
+    # at most this many records, and the result is cached
+    SOURCE_STEP_SAMPLE_SIZE = 1000
+    SOURCE_STEP_TIMEOUT = None
 
     class Meta:
         verbose_name = _("Aggregation")
@@ -424,8 +1199,9 @@ class Aggregation(AutoProcess):
     def __str__(self):
         return _("Aggregation for {}").format(str(self.timeseries_group))
 
-    @property
-    def source_timeseries(self):
+    def _get_source_timeseries(self):
+        if self.source_aggregation is not None:
+            return self.source_aggregation.target_timeseries
         try:
             return self.timeseries_group.timeseries_set.get(type=Timeseries.CHECKED)
         except Timeseries.DoesNotExist:
@@ -434,19 +1210,56 @@ class Aggregation(AutoProcess):
             )
             return obj
 
-    @property
-    def target_timeseries(self):
-        obj, created = self.timeseries_group.timeseries_set.get_or_create(
-            type=Timeseries.AGGREGATED,
-            time_step=self.target_time_step,
-            name=self.get_method_display(),
+    def find_source_timeseries(self, timeseries_list):
+        if self.source_aggregation is None:
+            return super().find_source_timeseries(timeseries_list)
+        for timeseries in timeseries_list:
+            if (
+                timeseries.type == Timeseries.AGGREGATED
+                and timeseries.time_step == self.source_aggregation.target_time_step
+                and timeseries.name == self.source_aggregation.get_method_display()
+            ):
+                return timeseries
+
+    def _get_target_timeseries_lookup(self):
+        return self.timeseries_group, {
+            "type": Timeseries.AGGREGATED,
+            "time_step": self.target_time_step,
+            "name": self.get_method_display(),
+        }
+
+    def _get_timeseries_key(self):
+        return (
+            self.timeseries_group_id,
+            self.target_time_step,
+            self.method,
+            self.source_aggregation_id,
         )
-        return obj
 
     def save(self, force_insert=False, force_update=False, *args, **kwargs):
         check_time_step(self.target_time_step)
         self._check_resulting_timestamp_offset()
+        self.check_source_aggregation()
         super().save(force_insert, force_update, *args, **kwargs)
+        cache.delete(self._get_source_step_key())
+        AggregationState.objects.filter(
+            aggregation_id__in=[self.id, *self._get_cascaded_aggregation_ids()]
+        ).delete()
+        if hasattr(self, "_aggregation_state"):
+            del self._aggregation_state
+
+    def _get_cascaded_aggregation_ids(self):
+        """Return the ids of the aggregations that use this one as source, directly
+        or through other aggregations."""
+        result = []
+        pending = [self.id]
+        while pending:
+            ids = Aggregation.objects.filter(
+                source_aggregation_id__in=pending
+            ).values_list("id", flat=True)
+            pending = [id for id in ids if id not in result and id != self.id]
+            result.extend(pending)
+        return result
 
     def _check_resulting_timestamp_offset(self):
         if not self.resulting_timestamp_offset:
@@ -464,21 +1277,396 @@ class Aggregation(AutoProcess):
                 )
             )
 
+    def check_source_aggregation(self):
+        """Raise IntegrityError if the aggregation can't use its source aggregation,
+        or if an aggregation that uses it as source can't use it any more.
+
+        The target intervals must consist of whole source intervals, so the time step
+        of the source aggregation must divide the day and the target time step. The
+        chain of source aggregations must not lead back to the aggregation.
+        """
+        if self.source_aggregation is not None:
+            self._check_can_use_as_source(self.source_aggregation)
+            self._check_source_aggregations_have_no_cycle()
+        if self.pk is not None:
+            for aggregation in self.cascaded_aggregations.all():
+                aggregation._check_can_use_as_source(self)
+
+    def _check_can_use_as_source(self, source):
+        if source.timeseries_group_id != self.timeseries_group_id or (
+            self.pk is not None and source.pk == self.pk
+        ):
+            raise IntegrityError(
+                _(
+                    "The source aggregation must be another aggregation of the same "
+                    "time series group."
+                )
+            )
+        if self.method not in self.cascadable_methods or source.method != self.method:
+            raise IntegrityError(
+                _(
+                    'An aggregation with method "{}" can\'t use as source an '
+                    'aggregation with method "{}".'
+                ).format(self.method, source.method)
+            )
+        if not self._target_step_is_multiple_of(source.target_time_step):
+            raise IntegrityError(
+                _(
+                    'The target time step "{}" can\'t be derived from the time step '
+                    '"{}" of the source aggregation.'
+                ).format(self.target_time_step, source.target_time_step)
+            )
+
+    def _check_source_aggregations_have_no_cycle(self):
+        visited = set()
+        source = self.source_aggregation
+        while source is not None and source.pk not in visited:
+            if self.pk is not None and source.pk == self.pk:
+                raise IntegrityError(_("The source aggregations would form a cycle."))
+            visited.add(source.pk)
+            source = source.source_aggregation
+
+    def _target_step_is_multiple_of(self, source_time_step):
+        m = re.match(r"(\d*)(.*)$", source_time_step)
+        source_step = buckets.get_bucket_step(int(m.group(1) or "1"), m.group(2))
+        if source_step is None:
+            return False
+        number, unit = self._get_target_time_step_parts()
+        if unit in ("M", "Y"):
+            return True
+        target_step = pd.Timedelta(
+            number, unit={"min": "min", "H": "h", "D": "D"}[unit]
+        )
+        return target_step > source_step and not target_step % source_step
+
+    def _get_chunk_overlap(self):
+        # A target record must be calculated from all its source records, so we need
+        # to read one whole target interval before the chunk. Months and years are
+        # taken at their longest. If the partial aggregates of the incomplete target
+        # interval are known, we don't need to read it again.
+        if self._get_aggregation_state() is not None:
+            return dt.timedelta(0)
+        number, unit = self._get_target_time_step_parts()
+        if unit == "M":
+            return dt.timedelta(days=31 * number)
+        elif unit == "Y":
+            return dt.timedelta(days=366 * number)
+        return pd.Timedelta(number, unit={"min": "min", "H": "h", "D": "D"}[unit])
+
+    def _get_target_time_step_parts(self):
+        m = re.match(r"(\d*)(.*)$", self.target_time_step)
+        return int(m.group(1) or "1"), m.group(2)
+
+    def _get_start_date(self):
+        state = self._get_aggregation_state()
+        if state is None:
+            return super()._get_start_date()
+        return state.source_end_date + dt.timedelta(minutes=1)
+
+    def _get_aggregation_state(self):
+        """Return the AggregationState if it can be used, otherwise None (see
+        buckets.py)."""
+        if not hasattr(self, "_aggregation_state"):
+            self._aggregation_state = self._load_aggregation_state()
+        return self._aggregation_state
+
+    def _load_aggregation_state(self):
+        if (
+            self.pk is None
+            or self.source_aggregation_id is not None
+            or self._get_bucket_step() is None
+        ):
+            return None
+        try:
+            state = AggregationState.objects.get(aggregation=self)
+        except AggregationState.DoesNotExist:
+            return None
+        # If the target time series has been modified since the state was saved,
+        # the state can't be trusted
+        if state.target_end_date != self.target_timeseries.end_date:
+            return None
+        return state
+
+    def _get_bucket_step(self):
+        return buckets.get_bucket_step(*self._get_target_time_step_parts())
+
+    def execute(self):
+        # Data handed off to us (see hand_off_to()) would be aggregated with pandas
+        # even if the aggregation can be executed in the database.
+        if (
+            hasattr(self, "_htimeseries")
+            and self._get_database_aggregation_parameters() is not None
+        ):
+            del self._htimeseries
+        super().execute()
+
+    def _execute_in_chunks(self):
+        parameters = self._get_database_aggregation_parameters()
+        if parameters is None:
+            super()._execute_in_chunks()
+            return
+        sqlaggregate.aggregate(
+            self.source_timeseries, self.target_timeseries, **parameters
+        )
+        # The result is not in memory, so consumers need to read it, and the next
+        # execution needs to read the incomplete target interval again.
+        self._appended_data = None
+        AggregationState.objects.filter(aggregation=self).delete()
+
+    def _get_database_aggregation_parameters(self):
+        """Return the parameters of sqlaggregate.aggregate(), or None if the
+        aggregation can't be executed in the database (see sqlaggregate.py)."""
+        if (
+            sqlaggregate.get_engine() != "timescaledb"
+            or self.source_aggregation_id is not None
+        ):
+            return None
+        target_step = self._get_bucket_step()
+        source_step = self._get_fixed_source_step()
+        if target_step is None or source_step is None or target_step % source_step:
+            return None
+        source_end_date = self.source_timeseries.end_date
+        if source_end_date is None or not sqlaggregate.is_available():
+            return None
+        origin = self._get_bucket_origin(source_end_date)
+        if origin is None:
+            return None
+        # Like the pandas engine without an AggregationState, we start one target
+        # interval before the end of the target time series
+        start_date = self.target_timeseries.end_date
+        if start_date is not None:
+            start_date += dt.timedelta(minutes=1) - target_step
+        if not sqlaggregate.is_regular(
+            self.source_timeseries, source_step, origin, start_date
+        ):
+            return None
+        return {
+            "method": self.method,
+            "target_step": target_step,
+            "origin": origin,
+            "expected_count": int(target_step / source_step),
+            "max_missing": self.max_missing,
+            "offset": pd.Timedelta(self.resulting_timestamp_offset or 0),
+            "start_date": start_date,
+        }
+
+    def _get_fixed_source_step(self):
+        m = re.match(r"(\d*)(.*)$", self.source_timeseries.time_step or "")
+        if not m.group(2):
+            return None
+        return buckets.get_bucket_step(int(m.group(1) or "1"), m.group(2))
+
+    def _get_bucket_origin(self, source_end_date):
+        # The buckets start at midnight in the time zone of the data, which we find
+        # from the last source record. Time zones with daylight saving time aren't
+        # supported.
+        data = data_cache.get_data(self.source_timeseries, start_date=source_end_date)
+        tz = data.data.index.tz
+        if tz is None:
+            return None
+        origin = pd.Timestamp("2000-01-03", tz=tz)
+        if origin.utcoffset() != pd.Timestamp("2000-07-03", tz=tz).utcoffset():
+            return None
+        return origin.to_pydatetime()
+
+    def _execute_chunk(self):
+        if not hasattr(self, "_target_end_date"):
+            self._target_end_date = self.target_timeseries.end_date
+        result = super()._execute_chunk()
+        data = result.data if isinstance(result, HTimeseries) else result
+        if len(data):
+            self._target_end_date = data.index[-1]
+        self._save_aggregation_state()
+        return result
+
+    def _save_aggregation_state(self):
+        state = self._get_aggregation_state()
+        if state is None and getattr(self, "_regularized", None) is not None:
+            state = self._get_aggregation_state_from_full_aggregation()
+            self._aggregation_state = state
+        if state is None:
+            AggregationState.objects.filter(aggregation=self).delete()
+            return
+        state.target_end_date = self._target_end_date
+        state.save()
+
+    def _get_aggregation_state_from_full_aggregation(self):
+        step = self._get_bucket_step()
+        if step is None:
+            return None
+        open_buckets = self._get_buckets(self._regularized, step)
+        open_buckets = open_buckets[open_buckets.index > self.source_end_date]
+        offset = pd.Timedelta(self.resulting_timestamp_offset or 0)
+        if (open_buckets.index - offset).isin(self._aggregated.data.index).any():
+            return None
+        state = AggregationState(aggregation=self)
+        state.set_open_bucket(open_buckets, self.source_end_date)
+        return state
+
     def process_timeseries(self):
+        self._regularized = None
         if self.htimeseries.data.empty:
             return HTimeseries()
+        if self.source_aggregation is not None:
+            return self._process_timeseries_from_source_aggregation()
         self.source_end_date = self.htimeseries.data.index[-1]
+        state = self._get_aggregation_state()
+        if state is not None:
+            return self._process_timeseries_incrementally(state)
         try:
             regularized = self._regularize_time_series(self.htimeseries)
         except RegularizeError as e:
             logging.getLogger("enhydris.autoprocess").error(str(e))
             return HTimeseries()
         aggregated = self._aggregate_time_series(regularized)
-        return self._trim_last_record_if_not_complete(aggregated)
+        aggregated = self._trim_last_record_if_not_complete(aggregated)
+        # Used by _save_aggregation_state()
+        self._regularized = regularized
+        self._aggregated = aggregated
+        return aggregated
+
+    def _process_timeseries_incrementally(self, state):
+        source_htimeseries = copy.copy(self.htimeseries)
+        data = source_htimeseries.data
+        source_htimeseries.data = data.loc[data.index > state.source_end_date]
+        if source_htimeseries.data.empty:
+            return HTimeseries()
+        try:
+            regularized = self._regularize_time_series(source_htimeseries)
+        except RegularizeError as e:
+            logging.getLogger("enhydris.autoprocess").error(str(e))
+            return HTimeseries()
+        step = self._get_bucket_step()
+        new_buckets = self._get_buckets(regularized, step)
+        all_buckets = buckets.merge_buckets(
+            state.get_open_bucket(new_buckets.index.tz), new_buckets
+        )
+        is_complete = all_buckets.index <= self.source_end_date
+        result = HTimeseries(
+            buckets.aggregate_buckets(
+                all_buckets[is_complete],
+                self.method,
+                expected_count=self._divide_target_step_by_source_step(
+                    self._get_source_step(regularized), self._get_target_step()
+                ),
+                max_missing=self.max_missing,
+                offset=pd.Timedelta(self.resulting_timestamp_offset or 0),
+            )
+        )
+        state.set_open_bucket(all_buckets[~is_complete], self.source_end_date)
+        return result
+
+    def _process_timeseries_from_source_aggregation(self):
+        # The source records are aggregated as they are, together with the number of
+        # source records that exist (and have a value) and the number of those that
+        # have the MISS flag in each target interval. From these we find the highest
+        # number of records that may be missing in the time series from which the
+        # chain of aggregations starts, and compare it with max_missing.
+        source = self.source_aggregation
+        data = self.htimeseries.data.copy()
+        data.index = data.index + pd.Timedelta(source.resulting_timestamp_offset or 0)
+        self.source_end_date = data.index[-1]
+        present = data["value"].notna()
+        miss = present & data["flags"].fillna("").str.split().map(
+            lambda flags: "MISS" in flags
+        )
+        values = self._aggregate_source_records(data["value"], self.method)
+        count = self._aggregate_source_records(
+            present.astype(float).where(present), "sum"
+        ).reindex(values.index, fill_value=0)
+        misses = self._aggregate_source_records(
+            miss.astype(float).where(present), "sum"
+        ).reindex(values.index, fill_value=0)
+        expected = self._get_expected_source_records(data.index).reindex(values.index)
+        records_per_source_record = self._get_records_per_source_record()
+        if records_per_source_record is None:
+            # If we don't know it, a missing source record always counts as too many
+            records_per_source_record = self.max_missing + 1
+        missing = (
+            records_per_source_record * (expected - count) + source.max_missing * misses
+        )
+        is_derived = missing <= self.max_missing
+        result = HTimeseries(
+            pd.DataFrame(
+                {
+                    "value": values[is_derived].values.astype(float),
+                    "flags": np.where(missing[is_derived] > 0, "MISS", ""),
+                },
+                columns=["value", "flags"],
+                index=values.index[is_derived]
+                - pd.Timedelta(self.resulting_timestamp_offset or 0),
+            )
+        )
+        return self._trim_last_record_if_not_complete(result)
+
+    def _aggregate_source_records(self, values, method):
+        htimeseries = HTimeseries(
+            pd.DataFrame({"value": values, "flags": ""}, index=values.index)
+        )
+        htimeseries.time_step = self.htimeseries.time_step
+        aggregated = aggregate(
+            htimeseries, self._get_target_step(), method, min_count=1
+        )
+        return aggregated.data["value"]
+
+    def _get_expected_source_records(self, index):
+        # The number of source records in each target interval, found by aggregating
+        # a complete source time series that covers the first and last interval
+        overlap = self._get_chunk_overlap()
+        step = buckets.get_bucket_step(
+            *self.source_aggregation._get_target_time_step_parts()
+        )
+        complete_index = pd.date_range(
+            index[0] - overlap, index[-1] + overlap, freq=step
+        )
+        return self._aggregate_source_records(
+            pd.Series(1.0, index=complete_index), "sum"
+        )
+
+    def _get_records_per_source_record(self):
+        """Return how many records of the time series from which the chain of
+        aggregations starts correspond to a source record, or None if unknown."""
+        number, unit = self.source_aggregation._get_target_time_step_parts()
+        first_step = self.source_aggregation._get_first_source_step()
+        if first_step is None:
+            return None
+        return self._divide_target_step_by_source_step(first_step, f"{number}{unit}")
+
+    def _get_first_source_step(self):
+        if self.source_aggregation is not None:
+            return self.source_aggregation._get_first_source_step()
+        return self.source_timeseries.time_step or cache.get(
+            self._get_source_step_key()
+        )
+
+    def _get_regularization_mode(self):
+        return self.method == "mean" and RM.INSTANTANEOUS or RM.INTERVAL
 
     def _regularize_time_series(self, source_htimeseries):
-        mode = self.method == "mean" and RM.INSTANTANEOUS or RM.INTERVAL
-        return regularize(source_htimeseries, new_date_flag="DATEINSERT", mode=mode)
+        mode = self._get_regularization_mode()
+        regularized = batch.memoize(
+            ("regularize", *self._get_data_key(source_htimeseries), mode),
+            lambda: regularize(
+                source_htimeseries, new_date_flag="DATEINSERT", mode=mode
+            ),
+        )
+        # The regularized time series may be shared with other aggregations
+        result = copy.copy(regularized)
+        result.data = regularized.data.copy()
+        return result
+
+    def _get_data_key(self, htimeseries):
+        # Identifies the source data for batch.memoize(); within a batch, the part of
+        # the source time series between two dates doesn't change.
+        index = htimeseries.data.index
+        return (self.source_timeseries.id, index[0], index[-1], len(index))
+
+    def _get_buckets(self, regularized, step):
+        key = self._get_data_key(regularized)
+        return batch.memoize(
+            ("buckets", *key, self._get_regularization_mode(), step),
+            lambda: buckets.get_buckets(regularized.data["value"], step),
+        )
 
     def _aggregate_time_series(self, source_htimeseries):
         source_step = self._get_source_step(source_htimeseries)
@@ -497,7 +1685,20 @@ class Aggregation(AutoProcess):
         )
 
     def _get_source_step(self, source_htimeseries):
-        return pd.infer_freq(source_htimeseries.data.index)
+        return self.htimeseries.time_step or self._infer_source_step(source_htimeseries)
+
+    def _infer_source_step(self, source_htimeseries):
+        key = self._get_source_step_key()
+        result = cache.get(key)
+        if result is None:
+            index = source_htimeseries.data.index[: self.SOURCE_STEP_SAMPLE_SIZE]
+            result = pd.infer_freq(index) if len(index) >= 3 else None
+            if result is not None:
+                cache.set(key, result, self.SOURCE_STEP_TIMEOUT)
+        return result
+
+    def _get_source_step_key(self):
+        return f"autoprocess_aggregation_source_step_{self.id}"
 
     def _get_target_step(self):
         result = self.target_timeseries.time_step
@@ -525,9 +1726,61 @@ class Aggregation(AutoProcess):
             return False
         last_target_record = ahtimeseries.data.iloc[-1]
         last_target_record_date = last_target_record.name + pd.Timedelta(
-            self.resulting_timestamp_offset
+            self.resulting_timestamp_offset or 0
         )
         return (
             "MISS" in last_target_record["flags"]
             and self.source_end_date < last_target_record_date
         )
+
+
+class AggregationState(models.Model):
+    """The partial aggregates of the incomplete last target interval of an
+    Aggregation (see buckets.py).
+
+    "bucket_end_date" is the end of the interval, or null if the source time series
+    ends exactly at the end of an interval. "min" and "max" are null if "count" is
+    zero.
+    """
+
+    aggregation = models.OneToOneField(
+        Aggregation, on_delete=models.CASCADE, primary_key=True
+    )
+    source_end_date = models.DateTimeField()
+    target_end_date = models.DateTimeField(blank=True, null=True)
+    bucket_end_date = models.DateTimeField(blank=True, null=True)
+    count = models.PositiveIntegerField(default=0)
+    sum = models.FloatField(default=0)
+    min = models.FloatField(blank=True, null=True)
+    max = models.FloatField(blank=True, null=True)
+
+    def get_open_bucket(self, tz):
+        """Return the open bucket like buckets.get_buckets() (i.e. as a DataFrame
+        with one row, or with none if there's no open bucket)."""
+        if self.bucket_end_date is None:
+            return pd.DataFrame(columns=list(buckets.AGGREGATES), dtype=float)
+        return pd.DataFrame(
+            {
+                "count": [self.count],
+                "sum": [self.sum],
+                "min": [self.min],
+                "max": [self.max],
+            },
+            columns=list(buckets.AGGREGATES),
+            index=pd.DatetimeIndex([self.bucket_end_date]).tz_convert(tz),
+            dtype=float,
+        )
+
+    def set_open_bucket(self, open_buckets, source_end_date):
+        """Set the open bucket from buckets (at most one) and the source end date."""
+        self.source_end_date = source_end_date
+        if open_buckets.empty:
+            self.bucket_end_date = None
+            self.count, self.sum, self.min, self.max = 0, 0, None, None
+            return
+        bucket = open_buckets.iloc[-1]
+        self.bucket_end_date = open_buckets.index[-1]
+        self.count = int(bucket["count"])
+        self.sum = float(bucket["sum"])
+        self.min = None if np.isnan(bucket["min"]) else float(bucket["min"])
+        self.max = None if np.isnan(bucket["max"]) else float(bucket["max"])
@@ -0,0 +1,151 @@
+import logging
+import threading
+
+from . import batch, dependencies, tasks
+
+_local = threading.local()
+
+
+def is_scheduled(auto_process_id):
+    """Return True if a running pipeline is going to execute the auto process.
+
+    When an auto process appends data to its target time series, ``post_save`` is
+    triggered for the time series, which normally results in enqueueing the auto
+    processes that use it as source. If the pipeline is going to execute these auto
+    processes anyway, enqueueing them would only cause a needless Celery round trip.
+    """
+    return auto_process_id in getattr(_local, "scheduled", ())
+
+
+class Pipeline:
+    """Execute an auto process and all auto processes that depend on it.
+
+    Auto processes form a dependency graph: the target time series of an auto
+    process (e.g. the checked time series produced by Checks) can be the source time
+    series of other auto processes (e.g. Aggregation and CurveInterpolation in the
+    same group). A CurveInterpolation's target is in another time series group
+    (``target_timeseries_group``), so the graph can span groups.
+
+    ``Pipeline(auto_process).execute()`` discovers the part of the graph that is
+    downstream of ``auto_process`` and executes it in topological order, so that
+    each auto process runs after the ones it depends on. If the graph has a cycle,
+    the edge that closes it is ignored. If an auto process fails, the auto processes
+    depending on it are skipped. If an auto process (other than the first one) is
+    already being executed by some other worker, it is enqueued instead, and it and
+    its dependants are skipped; they will be processed when the other execution
+    appends data.
+
+    If ``hand_off`` is true (the default), the data each auto process appends to its
+    target time series is also passed in memory to the auto processes that use that
+    time series as source (see ``AutoProcess.hand_off_to()``). For example, the
+    checked data produced by Checks goes straight to the aggregations and curve
+    interpolations of the group, so that each upload results in a single read of the
+    source data instead of one read per auto process.
+
+    The auto processes are executed as a batch (see ``batch.py``), so that, for
+    example, the aggregations of a group regularize their common source only once
+    per regularization mode.
+    """
+
+    def __init__(self, auto_process, hand_off=True):
+        self.root = auto_process
+        self.hand_off = hand_off
+
+    def execute(self):
+        self._build_graph()
+        self._sort()
+        _local.scheduled = {auto_process.id for auto_process in self.order}
+        try:
+            with batch.batch():
+                self._execute_all()
+        finally:
+            _local.scheduled = set()
+
+    def _build_graph(self):
+        self.nodes = {self.root.id: self.root}
+        self.dependants = {}
+        self.dependencies = {self.root.id: set()}
+        pending = [self.root]
+        while pending:
+            producer = pending.pop()
+            self.dependants[producer.id] = []
+            for consumer in self._get_consumers(producer):
+                self.dependants[producer.id].append(consumer.id)
+                self.dependencies.setdefault(consumer.id, set()).add(producer.id)
+                if consumer.id not in self.nodes:
+                    self.nodes[consumer.id] = consumer
+                    pending.append(consumer)
+
+    def _get_consumers(self, producer):
+        from .models import AutoProcess
+
+        # The target time series must not be created here (as the target_timeseries
+        # property would do), because its creation would enqueue its consumers
+        # before they are scheduled (see is_scheduled()). If it doesn't exist,
+        # nothing uses it as source yet.
+        target_timeseries = producer.find_target_timeseries()
+        if target_timeseries is None:
+            return
+        consumer_ids = dependencies.get_consumer_ids(target_timeseries)
+        for consumer in AutoProcess.objects.filter(id__in=consumer_ids):
+            yield self.nodes.get(consumer.id, consumer.as_specific_instance)
+
+    def _sort(self):
+        # Reverse postorder of a depth-first search. Edges to nodes that are still
+        # being visited close cycles and are ignored.
+        visited = set()
+        postorder = []
+        stack = [(self.root.id, iter(self.dependants[self.root.id]))]
+        visited.add(self.root.id)
+        while stack:
+            node_id, children = stack[-1]
+            child_id = next(children, None)
+            if child_id is None:
+                stack.pop()
+                postorder.append(node_id)
+            elif child_id not in visited:
+                visited.add(child_id)
+                stack.append((child_id, iter(self.dependants[child_id])))
+        self.order = [self.nodes[node_id] for node_id in reversed(postorder)]
+
+    def _execute_all(self):
+        self.not_executed = set()
+        for auto_process in self.order:
+            _local.scheduled.discard(auto_process.id)
+            if self.dependencies[auto_process.id] & self.not_executed:
+                self.not_executed.add(auto_process.id)
+                continue
+            self._execute_one(auto_process)
+
+    def _execute_one(self, auto_process):
+        is_root = auto_process is self.root
+        if not is_root and not tasks.acquire_running_lock(auto_process.id):
+            tasks.enqueue_auto_process(auto_process.id)
+            self.not_executed.add(auto_process.id)
+            return
+        try:
+            auto_process.execute()
+            if self.hand_off:
+                self._hand_off(auto_process)
+        except Exception:
+            if is_root:
+                raise
+            logging.getLogger("enhydris.autoprocess").exception(
+                f"Error while executing auto process {auto_process.id}"
+            )
+            self.not_executed.add(auto_process.id)
+        finally:
+            if not is_root:
+                tasks.release_running_lock(auto_process.id)
+
+    def _hand_off(self, producer):
+        # The dependency graph may be outdated; for example, when it was built, the
+        # source of an aggregation may have been the initial time series, whereas
+        # now, after checks have run, it's the checked time series.
+        target_timeseries = producer.find_target_timeseries()
+        if target_timeseries is None:
+            return
+        consumer_ids = dependencies.get_consumer_ids(target_timeseries)
+        for consumer_id in self.dependants[producer.id]:
+            if consumer_id in consumer_ids:
+                producer.hand_off_to(self.nodes[consumer_id])
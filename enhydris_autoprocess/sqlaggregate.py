@@ -0,0 +1,149 @@
+from django.conf import settings
+from django.db import connection, transaction
+
+from enhydris.models import TimeseriesRecord
+
+# Aggregation in the database
+#
+# By default an Aggregation reads the source records, regularizes and aggregates them
+# with haggregate, and appends the result to the target time series (the "pandas"
+# engine). If the ENHYDRIS_AUTOPROCESS_AGGREGATION_ENGINE setting is "timescaledb",
+# aggregations whose result can be computed with TimescaleDB's time_bucket() are
+# instead executed with a single INSERT ... SELECT statement, so the source records
+# never leave the database. This is only done when the result is the same as that of
+# the pandas engine, which remains the reference implementation:
+#
+#   - The time steps of the source and the target must be of a fixed length that
+#     divides the day (see buckets.get_bucket_step()), and the target time step must
+#     be a multiple of the source time step.
+#   - The time zone of the time series must have a fixed offset, and the source
+#     records must all be on the source time step (in that time zone); then
+#     regularization only inserts missing records, and a target record is derived
+#     from the source records after the start and up to and including the end of its
+#     interval (see buckets.py), of which count(value) are not null.
+#   - The aggregation must not use another aggregation as source.
+#
+# Otherwise (or if the database doesn't have TimescaleDB) the pandas engine is used.
+# The equivalence of the two engines is checked in tests/test_sqlaggregate.py.
+
+FUNCTIONS = {"sum": "sum", "mean": "avg", "max": "max", "min": "min"}
+
+
+def get_engine():
+    return getattr(settings, "ENHYDRIS_AUTOPROCESS_AGGREGATION_ENGINE", "pandas")
+
+
+def is_available():
+    """Return True if the database has TimescaleDB."""
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'timescaledb'")
+        return cursor.fetchone() is not None
+
+
+def _get_table_and_columns():
+    opts = TimeseriesRecord._meta
+    columns = [
+        connection.ops.quote_name(opts.get_field(name).column)
+        for name in ("timeseries", "timestamp", "value", "flags")
+    ]
+    return connection.ops.quote_name(opts.db_table), columns
+
+
+def is_regular(timeseries, step, origin, start_date=None):
+    """Return True if all records from start_date are on the time step.
+
+    "step" is a Timedelta and "origin" an aware datetime that is on the time step.
+    """
+    table, (timeseries_column, timestamp, value, flags) = _get_table_and_columns()
+    query = f"""
+        SELECT NOT EXISTS (
+            SELECT 1 FROM {table}
+            WHERE {timeseries_column} = %(timeseries)s
+            AND (%(start_date)s::timestamptz IS NULL OR {timestamp} >= %(start_date)s)
+            AND time_bucket(%(step)s, {timestamp}, %(origin)s) <> {timestamp}
+        )
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            query,
+            {
+                "timeseries": timeseries.id,
+                "start_date": start_date,
+                "step": step.to_pytimedelta(),
+                "origin": origin,
+            },
+        )
+        return cursor.fetchone()[0]
+
+
+def aggregate(
+    source_timeseries,
+    target_timeseries,
+    *,
+    method,
+    target_step,
+    origin,
+    expected_count,
+    max_missing,
+    offset,
+    start_date=None,
+):
+    """Aggregate the source records into the target time series; return the count.
+
+    The source records from start_date (or all, if it is None) are aggregated into
+    buckets of "target_step" (a Timedelta) that are on the time step of "origin"
+    (an aware datetime), like buckets.get_buckets() and
+    buckets.aggregate_buckets() would do: buckets with fewer than expected_count
+    non-null values get the MISS flag, and those with more than max_missing (but at
+    least one) missing are omitted. The timestamps are the ends of the buckets minus
+    "offset" (a Timedelta). Resulting records that already exist in the target time
+    series are discarded, and, as in Aggregation._trim_last_record_if_not_complete(),
+    so is the last one if it has the MISS flag and its interval ends after the source
+    time series. Like append.copy_append_data(), the target time series is saved in
+    the same transaction.
+    """
+    table, (timeseries_column, timestamp, value, flags) = _get_table_and_columns()
+    query = f"""
+        INSERT INTO {table} ({timeseries_column}, {timestamp}, {value}, {flags})
+        SELECT %(target)s, bucket_end - %(offset)s, bucket_value, bucket_flags
+        FROM (
+            SELECT
+                time_bucket(
+                    %(step)s, {timestamp} - interval '1 microsecond', %(origin)s
+                ) + %(step)s AS bucket_end,
+                {FUNCTIONS[method]}({value}) AS bucket_value,
+                count({value}) AS bucket_count,
+                CASE WHEN count({value}) < %(expected_count)s THEN 'MISS' ELSE ''
+                    END AS bucket_flags
+            FROM {table}
+            WHERE {timeseries_column} = %(source)s
+            AND (%(start_date)s::timestamptz IS NULL OR {timestamp} >= %(start_date)s)
+            GROUP BY bucket_end
+        ) AS buckets
+        WHERE bucket_count >= %(min_count)s
+        AND (
+            %(target_end_date)s::timestamptz IS NULL
+            OR bucket_end - %(offset)s > %(target_end_date)s
+        )
+        AND NOT (bucket_flags = 'MISS' AND bucket_end > %(source_end_date)s)
+    """
+    parameters = {
+        "source": source_timeseries.id,
+        "target": target_timeseries.id,
+        "step": target_step.to_pytimedelta(),
+        "origin": origin,
+        "expected_count": expected_count,
+        "min_count": max(expected_count - max_missing, 1),
+        "offset": offset.to_pytimedelta(),
+        "start_date": start_date,
+        "target_end_date": target_timeseries.end_date,
+        "source_end_date": source_timeseries.end_date,
+    }
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(query, parameters)
+            count = cursor.rowcount
+        target_timeseries.save()
+    return count
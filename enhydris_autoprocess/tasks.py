@@ -1,8 +1,77 @@
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+
 from enhydris.celery import app
 
+# Coalescing of auto process executions
+#
+# Timeseries get saved often (e.g. a logger uploading data in many small commits),
+# and each save would enqueue an execution of the auto processes depending on the
+# time series. To avoid executing the same auto process many times for nothing, we
+# keep a "pending" marker in the cache for each auto process that has been enqueued
+# but whose execution hasn't started yet. Further triggers that arrive while the
+# marker is there do nothing. The worker removes the marker just before it starts
+# executing, so that if new data arrives during execution, a follow-up execution is
+# enqueued. A "running" marker prevents the follow-up execution from running
+# concurrently with the one in progress; if the follow-up execution is picked up by a
+# worker while the previous one is still running, it is postponed.
+#
+# The markers must be seen by both the web server and the workers, so this needs a
+# cache shared by all processes (e.g. Memcached, Redis or the database). With a cache
+# that is local to each process, such as Django's default LocMemCache, the worker
+# couldn't remove the marker set by the web server, and all triggers until the
+# marker expired would be lost; in that case we don't coalesce, and every trigger
+# enqueues an execution.
+#
+# The task executes not only the auto process it is given, but also all auto
+# processes that depend on it, in dependency order (see pipeline.py).
+
+PENDING_TIMEOUT = 600
+RUNNING_TIMEOUT = 3600
+POSTPONE_COUNTDOWN = 10
+
+
+def _get_pending_key(auto_process_id):
+    return f"autoprocess_pending_{auto_process_id}"
+
+
+def _get_running_key(auto_process_id):
+    return f"autoprocess_running_{auto_process_id}"
+
+
+def cache_is_process_local():
+    """Return True if the default cache isn't shared among processes."""
+    return isinstance(caches["default"], LocMemCache)
+
+
+def enqueue_auto_process(auto_process_id):
+    if cache_is_process_local() or cache.add(
+        _get_pending_key(auto_process_id), True, PENDING_TIMEOUT
+    ):
+        execute_auto_process.delay(auto_process_id)
+
+
+def acquire_running_lock(auto_process_id):
+    return cache.add(_get_running_key(auto_process_id), True, RUNNING_TIMEOUT)
+
+
+def release_running_lock(auto_process_id):
+    cache.delete(_get_running_key(auto_process_id))
+
 
 @app.task
 def execute_auto_process(auto_process_id):
     from .models import AutoProcess
+    from .pipeline import Pipeline
 
-    AutoProcess.objects.get(id=auto_process_id).as_specific_instance.execute()
+    if not acquire_running_lock(auto_process_id):
+        execute_auto_process.apply_async(
+            args=[auto_process_id], countdown=POSTPONE_COUNTDOWN
+        )
+        return
+    try:
+        cache.delete(_get_pending_key(auto_process_id))
+        auto_process = AutoProcess.objects.get(id=auto_process_id)
+        Pipeline(auto_process.as_specific_instance).execute()
+    finally:
+        release_running_lock(auto_process_id)
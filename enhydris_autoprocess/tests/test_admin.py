@@ -1,5 +1,7 @@
 import datetime as dt
+from unittest import mock
 
+from django.contrib import admin
 from django.contrib.auth import get_user_model
 from django.test import TestCase, override_settings
 
@@ -10,7 +12,11 @@ import enhydris.models
 from enhydris.tests import ClearCacheMixin
 from enhydris.tests.admin import get_formset_parameters
 from enhydris_autoprocess import models
-from enhydris_autoprocess.admin import AggregationForm, CurvePeriodForm
+from enhydris_autoprocess.admin import (
+    AggregationForm,
+    AggregationInline,
+    CurvePeriodForm,
+)
 
 User = get_user_model()
 
@@ -104,6 +110,13 @@ class TimeseriesGroupFormTestCaseBase(TestCaseBase):
         )
         cls.roc_check.set_thresholds("10min\t25.0\n1H\t35.0\n")
 
+    @classmethod
+    def _create_flatline_check(cls):
+        cls._ensure_we_have_checks()
+        cls.flatline_check = mommy.make(
+            models.FlatLineCheck, checks=cls.checks, duration="6H"
+        )
+
 
 @override_settings(ENHYDRIS_USERS_CAN_ADD_CONTENT=True)
 class TimeseriesGroupFormRangeCheckValidationTestCase(TimeseriesGroupFormTestCaseBase):
@@ -130,6 +143,31 @@ class TimeseriesGroupFormRangeCheckValidationTestCase(TimeseriesGroupFormTestCas
         response = self._post_form(data)
         self.assertEqual(response.status_code, 302)
 
+    def test_returns_error_if_only_seasonal_bounds_are_specified(self):
+        data = {**self.data, "timeseriesgroup_set-0-seasonal_bounds": "7 1 2 3 4"}
+        response = self._post_form(data)
+        self.assertContains(response, "To perform a range check")
+
+    def test_returns_error_if_seasonal_bounds_are_garbage(self):
+        data = {
+            **self.data,
+            "timeseriesgroup_set-0-lower_bound": 1,
+            "timeseriesgroup_set-0-upper_bound": 4,
+            "timeseriesgroup_set-0-seasonal_bounds": "garbage",
+        }
+        response = self._post_form(data)
+        self.assertContains(response, "is not a valid line of seasonal bounds")
+
+    def test_returns_error_if_seasonal_bounds_are_repeated(self):
+        data = {
+            **self.data,
+            "timeseriesgroup_set-0-lower_bound": 1,
+            "timeseriesgroup_set-0-upper_bound": 4,
+            "timeseriesgroup_set-0-seasonal_bounds": "7 1 - - 3\n7 0 - - 3",
+        }
+        response = self._post_form(data)
+        self.assertContains(response, "has the same month and hour as an earlier line")
+
     def test_succeeds_if_both_upper_and_lower_bounds_are_specified(self):
         data = {
             **self.data,
@@ -158,6 +196,7 @@ class TimeseriesGroupFormCreatesRangeCheckTestCase(TimeseriesGroupFormTestCaseBa
             "timeseriesgroup_set-0-soft_lower_bound": 84,
             "timeseriesgroup_set-0-soft_upper_bound": 168,
             "timeseriesgroup_set-0-upper_bound": 420,
+            "timeseriesgroup_set-0-seasonal_bounds": "7 50 - - 400\n7:14 - - 170 -",
         }
         response = self._post_form(data)
         assert response.status_code == 302
@@ -174,6 +213,12 @@ class TimeseriesGroupFormCreatesRangeCheckTestCase(TimeseriesGroupFormTestCaseBa
     def test_upper_bound(self):
         self.assertEqual(self.range_check.upper_bound, 420)
 
+    def test_seasonal_bounds(self):
+        self.assertEqual(
+            self.range_check.get_seasonal_bounds_as_text(),
+            "7\t50.0\t-\t-\t400.0\n7:14\t-\t-\t170.0\t-\n",
+        )
+
 
 @override_settings(ENHYDRIS_USERS_CAN_ADD_CONTENT=True)
 class TimeseriesGroupFormSavesExistingRangeCheckTestCase(
@@ -200,6 +245,7 @@ class TimeseriesGroupFormSavesExistingRangeCheckTestCase(
             "timeseriesgroup_set-0-soft_lower_bound": 84,
             "timeseriesgroup_set-0-soft_upper_bound": 168,
             "timeseriesgroup_set-0-upper_bound": 420,
+            "timeseriesgroup_set-0-seasonal_bounds": "7 50 - - 400\n7:14 - - 170 -",
         }
         response = self._post_form(data)
         assert response.status_code == 302
@@ -399,6 +445,128 @@ class TimeseriesGroupFormRocCheckInitialValuesTestCase(TimeseriesGroupFormTestCa
 
 
 @override_settings(ENHYDRIS_USERS_CAN_ADD_CONTENT=True)
+@override_settings(ENHYDRIS_USERS_CAN_ADD_CONTENT=True)
+class TimeseriesGroupFormFlatLineCheckTestCase(TimeseriesGroupFormTestCaseBase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data()
+
+    def setUp(self):
+        super().setUp()
+        self.data = self._get_basic_form_contents()
+
+    def test_returns_error_if_duration_is_garbage(self):
+        data = {**self.data, "timeseriesgroup_set-0-flatline_duration": "garbage"}
+        response = self._post_form(data)
+        self.assertContains(response, "is not a valid duration")
+
+    def test_creates_flatline_check(self):
+        data = {**self.data, "timeseriesgroup_set-0-flatline_duration": "6H"}
+        response = self._post_form(data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(models.FlatLineCheck.objects.get().duration, "6H")
+
+    def test_does_not_create_flatline_check_if_duration_is_unspecified(self):
+        data = {**self.data, "timeseriesgroup_set-0-flatline_duration": ""}
+        response = self._post_form(data)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(models.FlatLineCheck.objects.exists())
+
+
+@override_settings(ENHYDRIS_USERS_CAN_ADD_CONTENT=True)
+class TimeseriesGroupFormExistingFlatLineCheckTestCase(TimeseriesGroupFormTestCaseBase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data()
+        cls._create_flatline_check()
+        cls._create_range_check()  # This is to ensure Checks is not deleted
+
+    def _post_duration(self, duration):
+        data = {
+            **self._get_basic_form_contents(),
+            "timeseriesgroup_set-0-id": self.timeseries_group.id,
+            "timeseriesgroup_set-0-gentity": self.station.id,
+            "timeseriesgroup_set-0-lower_bound": "1",
+            "timeseriesgroup_set-0-upper_bound": "4",
+            "timeseriesgroup_set-0-flatline_duration": duration,
+        }
+        response = self._post_form(data)
+        assert response.status_code == 302
+
+    def test_initial_value(self):
+        soup = BeautifulSoup(self._get_form().content, "html.parser")
+        value = soup.find(id="id_timeseriesgroup_set-0-flatline_duration")["value"]
+        self.assertEqual(value, "6H")
+
+    def test_updates_flatline_check(self):
+        self._post_duration("1D")
+        self.assertEqual(models.FlatLineCheck.objects.get().duration, "1D")
+
+    def test_deletes_flatline_check(self):
+        self._post_duration("")
+        self.assertFalse(models.FlatLineCheck.objects.exists())
+
+
+@override_settings(ENHYDRIS_USERS_CAN_ADD_CONTENT=True)
+class TimeseriesGroupFormSpikeCheckTestCase(TimeseriesGroupFormTestCaseBase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data()
+
+    def setUp(self):
+        super().setUp()
+        self.data = self._get_basic_form_contents()
+
+    def test_returns_error_if_only_window_is_specified(self):
+        data = {**self.data, "timeseriesgroup_set-0-spike_window": "5"}
+        response = self._post_form(data)
+        self.assertContains(response, "To perform a spike check")
+
+    def test_creates_spike_check(self):
+        data = {
+            **self.data,
+            "timeseriesgroup_set-0-spike_window": "5",
+            "timeseriesgroup_set-0-spike_allowed_diff": "3.5",
+        }
+        response = self._post_form(data)
+        self.assertEqual(response.status_code, 302)
+        spike_check = models.SpikeCheck.objects.get()
+        self.assertEqual(spike_check.window, 5)
+        self.assertAlmostEqual(spike_check.allowed_diff, 3.5)
+
+    def test_does_not_create_spike_check_if_parameters_are_unspecified(self):
+        response = self._post_form(self.data)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(models.SpikeCheck.objects.exists())
+
+
+@override_settings(ENHYDRIS_USERS_CAN_ADD_CONTENT=True)
+class TimeseriesGroupFormExistingSpikeCheckTestCase(TimeseriesGroupFormTestCaseBase):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_data()
+        cls._ensure_we_have_checks()
+        mommy.make(models.SpikeCheck, checks=cls.checks, window=5, allowed_diff=3.5)
+        cls._create_range_check()  # This is to ensure Checks is not deleted
+
+    def test_initial_value(self):
+        soup = BeautifulSoup(self._get_form().content, "html.parser")
+        value = soup.find(id="id_timeseriesgroup_set-0-spike_window")["value"]
+        self.assertEqual(value, "5")
+
+    def test_spike_check_has_been_deleted(self):
+        data = {
+            **self._get_basic_form_contents(),
+            "timeseriesgroup_set-0-id": self.timeseries_group.id,
+            "timeseriesgroup_set-0-gentity": self.station.id,
+            "timeseriesgroup_set-0-lower_bound": "1",
+            "timeseriesgroup_set-0-upper_bound": "4",
+        }
+        response = self._post_form(data)
+        assert response.status_code == 302
+        self.assertFalse(models.SpikeCheck.objects.exists())
+
+
 class AggregationFormTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -437,6 +605,72 @@ class AggregationFormTestCase(TestCase):
         )
         self.assertTrue(form.is_valid())
 
+    def _get_form_with_source_aggregation(self, method):
+        source_aggregation = mommy.make(
+            models.Aggregation,
+            target_time_step="10min",
+            method=method,
+            timeseries_group=self.aggregation.timeseries_group,
+        )
+        return AggregationForm(
+            {
+                "target_time_step": "H",
+                "method": "sum",
+                "max_missing": 0,
+                "resulting_timestamp_offset": "",
+                "source_aggregation": source_aggregation.id,
+            },
+            instance=self.aggregation,
+        )
+
+    def test_validates_with_source_aggregation(self):
+        form = self._get_form_with_source_aggregation(method="sum")
+        self.assertTrue(form.is_valid())
+
+    def test_does_not_validate_when_invalid_source_aggregation(self):
+        form = self._get_form_with_source_aggregation(method="max")
+        self.assertFalse(form.is_valid())
+        self.assertEqual(
+            form.non_field_errors()[0],
+            'An aggregation with method "sum" can\'t use as source an aggregation '
+            'with method "max".',
+        )
+
+
+class AggregationInlineTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.station = mommy.make(enhydris.models.Station)
+        cls.aggregation = mommy.make(
+            models.Aggregation,
+            target_time_step="H",
+            method="sum",
+            timeseries_group__gentity=cls.station,
+        )
+        mommy.make(
+            models.Aggregation,
+            target_time_step="H",
+            method="sum",
+            timeseries_group__gentity=mommy.make(enhydris.models.Station),
+        )
+
+    def _get_source_aggregation_choices(self, url_kwargs):
+        inline = AggregationInline(enhydris.models.TimeseriesGroup, admin.site)
+        request = mock.Mock(resolver_match=mock.Mock(kwargs=url_kwargs))
+        formfield = inline.formfield_for_foreignkey(
+            models.Aggregation._meta.get_field("source_aggregation"), request
+        )
+        return list(formfield.queryset)
+
+    def test_source_aggregations_of_station(self):
+        choices = self._get_source_aggregation_choices(
+            {"object_id": str(self.station.id)}
+        )
+        self.assertEqual(choices, [self.aggregation])
+
+    def test_no_source_aggregations_when_adding_station(self):
+        self.assertEqual(self._get_source_aggregation_choices({}), [])
+
 
 class CurvePeriodFormTestCase(TestCase):
     @classmethod
@@ -0,0 +1,112 @@
+import datetime as dt
+from unittest import mock
+
+from django.db import IntegrityError
+from django.test import TestCase, override_settings
+
+import numpy as np
+import pandas as pd
+from htimeseries import HTimeseries
+from model_mommy import mommy
+
+from enhydris.models import Station, Timeseries, TimeseriesGroup
+from enhydris_autoprocess import benchmarks
+from enhydris_autoprocess.append import append_data, copy_append_data
+
+
+def _get_dataframe(values, flags, minutes):
+    return pd.DataFrame(
+        data={"value": values, "flags": flags},
+        columns=["value", "flags"],
+        index=[
+            dt.datetime(2019, 5, 21, 17, m, tzinfo=dt.timezone.utc) for m in minutes
+        ],
+    )
+
+
+class CopyAppendDataTestCase(TestCase):
+    def setUp(self):
+        station = mommy.make(Station, display_timezone="Etc/GMT-2")
+        self.timeseries_group = mommy.make(
+            TimeseriesGroup, gentity=station, variable__descr="h"
+        )
+        self.timeseries = mommy.make(
+            Timeseries, timeseries_group=self.timeseries_group, type=Timeseries.INITIAL
+        )
+        self.timeseries.set_data(_get_dataframe([1.0], [""], [0]))
+
+    def _get_stored_data(self):
+        return Timeseries.objects.get(id=self.timeseries.id).get_data().data
+
+    def test_appends_data(self):
+        copy_append_data(
+            self.timeseries,
+            _get_dataframe([2.0, np.nan, 4.0], ["", "RANGE", "A, B"], [10, 20, 30]),
+        )
+        data = self._get_stored_data()
+        np.testing.assert_equal(data["value"].values, [1.0, 2.0, np.nan, 4.0])
+        self.assertEqual(list(data["flags"]), ["", "", "RANGE", "A, B"])
+
+    def test_appends_htimeseries(self):
+        copy_append_data(
+            self.timeseries, HTimeseries(_get_dataframe([2.0], [""], [10]))
+        )
+        self.assertEqual(list(self._get_stored_data()["value"]), [1.0, 2.0])
+
+    def test_stores_timestamps_in_utc(self):
+        data = _get_dataframe([2.0], [""], [10])
+        data.index = data.index.tz_convert("Etc/GMT-2")
+        copy_append_data(self.timeseries, data)
+        self.assertEqual(
+            self._get_stored_data().index[-1],
+            dt.datetime(2019, 5, 21, 17, 10, tzinfo=dt.timezone.utc),
+        )
+
+    def test_updates_last_modified(self):
+        last_modified = Timeseries.objects.get(id=self.timeseries.id).last_modified
+        copy_append_data(self.timeseries, _get_dataframe([2.0], [""], [10]))
+        self.assertGreater(
+            Timeseries.objects.get(id=self.timeseries.id).last_modified, last_modified
+        )
+
+    def test_refuses_to_append_older_data(self):
+        with self.assertRaises(IntegrityError):
+            copy_append_data(self.timeseries, _get_dataframe([2.0], [""], [0]))
+
+    def test_does_nothing_if_data_is_empty(self):
+        copy_append_data(self.timeseries, _get_dataframe([], [], []))
+        self.assertEqual(len(self._get_stored_data()), 1)
+
+
+@mock.patch("enhydris_autoprocess.append.copy_append_data")
+@mock.patch("enhydris.models.Timeseries.append_data")
+class AppendDataTestCase(TestCase):
+    def setUp(self):
+        self.timeseries = mommy.make(Timeseries)
+        self.data = _get_dataframe([2.0], [""], [10])
+
+    def test_uses_append_data_by_default(self, mock_append_data, mock_copy):
+        append_data(self.timeseries, self.data)
+        mock_append_data.assert_called_once_with(self.data)
+        mock_copy.assert_not_called()
+
+    @override_settings(ENHYDRIS_AUTOPROCESS_APPEND_METHOD="copy")
+    def test_uses_copy_if_configured(self, mock_append_data, mock_copy):
+        append_data(self.timeseries, self.data)
+        mock_copy.assert_called_once_with(self.timeseries, self.data)
+        mock_append_data.assert_not_called()
+
+
+class AppendBenchmarkTestCase(TestCase):
+    def setUp(self):
+        mommy.make(TimeseriesGroup)
+
+    def test_runs_append_benchmarks(self):
+        result = benchmarks.run("append/", records=10, repeat=1)
+        self.assertEqual(
+            [name for name, seconds in result], ["append/append_data", "append/copy"]
+        )
+
+    def test_leaves_no_data(self):
+        benchmarks.run("append/", records=10, repeat=1)
+        self.assertFalse(Timeseries.objects.exists())
@@ -1,5 +1,6 @@
 from unittest import mock
 
+from django.core.cache import cache
 from django.db import transaction
 from django.test import TransactionTestCase
 
@@ -28,14 +29,15 @@ class EnqueueAutoProcessTestCase(TransactionTestCase):
             timeseries_group=self.auto_process.timeseries_group,
             type=Timeseries.INITIAL,
         )
+        cache.clear()
 
-    @mock.patch("enhydris_autoprocess.apps.execute_auto_process")
+    @mock.patch("enhydris_autoprocess.tasks.execute_auto_process")
     def test_enqueues_auto_process(self, m):
         with transaction.atomic():
             self.timeseries.save()
         m.delay.assert_any_call(self.auto_process.id)
 
-    @mock.patch("enhydris_autoprocess.apps.execute_auto_process")
+    @mock.patch("enhydris_autoprocess.tasks.execute_auto_process")
     def test_auto_process_is_not_triggered_before_commit(self, m):
         with transaction.atomic():
             self.timeseries.save()
@@ -0,0 +1,35 @@
+from unittest import mock
+
+from django.test import TestCase
+
+from enhydris_autoprocess import batch
+
+
+class MemoizeTestCase(TestCase):
+    def setUp(self):
+        self.func = mock.Mock(return_value=42)
+
+    def test_computes_once_in_batch(self):
+        with batch.batch():
+            batch.memoize("key", self.func)
+            result = batch.memoize("key", self.func)
+        self.assertEqual(result, 42)
+        self.assertEqual(self.func.call_count, 1)
+
+    def test_different_keys(self):
+        with batch.batch():
+            batch.memoize("key1", self.func)
+            batch.memoize("key2", self.func)
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_computes_every_time_outside_batch(self):
+        batch.memoize("key", self.func)
+        batch.memoize("key", self.func)
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_forgets_after_batch(self):
+        with batch.batch():
+            batch.memoize("key", self.func)
+        with batch.batch():
+            batch.memoize("key", self.func)
+        self.assertEqual(self.func.call_count, 2)
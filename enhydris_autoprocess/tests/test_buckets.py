@@ -0,0 +1,79 @@
+from django.test import TestCase
+
+import numpy as np
+import pandas as pd
+
+from enhydris_autoprocess import buckets
+
+
+class GetBucketStepTestCase(TestCase):
+    def test_hours(self):
+        self.assertEqual(buckets.get_bucket_step(3, "H"), pd.Timedelta("3h"))
+
+    def test_day(self):
+        self.assertEqual(buckets.get_bucket_step(1, "D"), pd.Timedelta("1D"))
+
+    def test_step_that_does_not_divide_the_day(self):
+        self.assertIsNone(buckets.get_bucket_step(7, "min"))
+
+    def test_more_than_a_day(self):
+        self.assertIsNone(buckets.get_bucket_step(7, "D"))
+
+    def test_months(self):
+        self.assertIsNone(buckets.get_bucket_step(1, "M"))
+
+
+class BucketsTestCase(TestCase):
+    # Same data as in test_models.AggregationProcessTimeseriesTestCase
+    _values = [2, 3, 5, 7, 11, 13, 17, 19, np.nan, 29, 31, 37, 41, 43, 47, 53, 59]
+
+    def setUp(self):
+        index = pd.date_range("2019-05-21 10:00", periods=17, freq="10min", tz="UTC")
+        self.values = pd.Series(self._values, index=index)
+        self.step = pd.Timedelta("1h")
+
+    def test_get_buckets(self):
+        result = buckets.get_buckets(self.values, self.step)
+        self.assertEqual(list(result["count"]), [1, 6, 5, 4])
+        self.assertEqual(list(result["sum"]), [2, 56, 157, 202])
+        self.assertEqual(list(result["min"]), [2, 3, 19, 43])
+        self.assertEqual(result.index[1], pd.Timestamp("2019-05-21 11:00", tz="UTC"))
+
+    def _aggregate(self, bucket_list, max_missing, method="sum"):
+        return buckets.aggregate_buckets(
+            bucket_list, method, 6, max_missing, pd.Timedelta("1min")
+        )
+
+    def test_aggregate_buckets(self):
+        result = self._aggregate(buckets.get_buckets(self.values, self.step), 1)
+        self.assertEqual(list(result["value"]), [56, 157])
+        self.assertEqual(list(result["flags"]), ["", "MISS"])
+        self.assertEqual(result.index[0], pd.Timestamp("2019-05-21 10:59", tz="UTC"))
+
+    def test_mean(self):
+        result = self._aggregate(
+            buckets.get_buckets(self.values, self.step), 0, method="mean"
+        )
+        self.assertAlmostEqual(result["value"].iloc[0], 56 / 6)
+
+    def test_split_anywhere_gives_same_result(self):
+        all_buckets = buckets.get_buckets(self.values, self.step)
+        expected = self._aggregate(all_buckets, 5)
+        for i in range(1, len(self.values)):
+            first, second = self.values.iloc[:i], self.values.iloc[i:]
+            first_buckets = buckets.get_buckets(first, self.step)
+            open_bucket = first_buckets[first_buckets.index > first.index[-1]]
+            complete_buckets = first_buckets[first_buckets.index <= first.index[-1]]
+            merged = buckets.merge_buckets(
+                open_bucket, buckets.get_buckets(second, self.step)
+            )
+            result = pd.concat(
+                [self._aggregate(complete_buckets, 5), self._aggregate(merged, 5)]
+            )
+            pd.testing.assert_frame_equal(result, expected, check_freq=False)
+
+    def test_merge_empty(self):
+        all_buckets = buckets.get_buckets(self.values, self.step)
+        empty = all_buckets.iloc[:0]
+        result = buckets.merge_buckets(empty, all_buckets)
+        pd.testing.assert_frame_equal(result, all_buckets, check_freq=False)
@@ -0,0 +1,179 @@
+import datetime as dt
+
+from django.test import TestCase
+
+import numpy as np
+
+from enhydris_autoprocess import benchmarks, curves
+from enhydris_autoprocess.curves import (
+    CompiledCurves,
+    CurveCache,
+    decode_curve,
+    encode_curve,
+)
+
+
+class CompiledCurvesTestCase(TestCase):
+    def setUp(self):
+        self.compiled_curves = CompiledCurves(
+            [
+                (2, dt.date(2019, 6, 1), dt.date(2019, 6, 30), [3, 4], [200, 300]),
+                (1, dt.date(2019, 5, 1), dt.date(2019, 5, 31), [3, 4, 5], [1, 2, 3]),
+            ]
+        )
+
+    def test_len(self):
+        self.assertEqual(len(self.compiled_curves), 2)
+
+    def test_sorted_by_start_date(self):
+        self.assertEqual(self.compiled_curves.period_ids, [1, 2])
+
+    def test_starts(self):
+        self.assertEqual(
+            self.compiled_curves.starts[0],
+            int(dt.datetime(2019, 5, 1, tzinfo=dt.timezone.utc).timestamp()) * 10**9,
+        )
+
+    def test_ends(self):
+        self.assertEqual(
+            self.compiled_curves.ends[1],
+            int(dt.datetime(2019, 6, 30, 23, 59, tzinfo=dt.timezone.utc).timestamp())
+            * 10**9,
+        )
+
+    def test_get_curve(self):
+        x, y = self.compiled_curves.get_curve(1)
+        np.testing.assert_equal(x, [3.0, 4.0])
+        np.testing.assert_equal(y, [200.0, 300.0])
+
+    def test_arrays_are_contiguous(self):
+        self.assertEqual(self.compiled_curves.x.dtype, np.float64)
+        np.testing.assert_equal(self.compiled_curves.offsets, [0, 3, 5])
+
+    def test_empty(self):
+        self.assertEqual(len(CompiledCurves([])), 0)
+
+
+class CurveCacheTestCase(TestCase):
+    def setUp(self):
+        self.curve_cache = CurveCache()
+        self.compile_calls = 0
+
+    def _compile(self):
+        self.compile_calls += 1
+        return CompiledCurves([])
+
+    def test_compiles_only_once(self):
+        first = self.curve_cache.get((1, 0), self._compile)
+        second = self.curve_cache.get((1, 0), self._compile)
+        self.assertIs(first, second)
+        self.assertEqual(self.compile_calls, 1)
+
+    def test_different_version_is_compiled_again(self):
+        self.curve_cache.get((1, 0), self._compile)
+        self.curve_cache.get((1, 1), self._compile)
+        self.assertEqual(self.compile_calls, 2)
+
+    def test_hits_and_misses(self):
+        self.curve_cache.get((1, 0), self._compile)
+        self.curve_cache.get((1, 0), self._compile)
+        self.assertEqual((self.curve_cache.hits, self.curve_cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used(self):
+        original_max_entries = curves.MAX_ENTRIES
+        curves.MAX_ENTRIES = 2
+        try:
+            self.curve_cache.get((1, 0), self._compile)
+            self.curve_cache.get((2, 0), self._compile)
+            self.curve_cache.get((1, 0), self._compile)
+            self.curve_cache.get((3, 0), self._compile)
+            self.curve_cache.get((1, 0), self._compile)
+            self.assertEqual(self.compile_calls, 3)
+            self.curve_cache.get((2, 0), self._compile)
+            self.assertEqual(self.compile_calls, 4)
+        finally:
+            curves.MAX_ENTRIES = original_max_entries
+
+    def test_clear(self):
+        self.curve_cache.get((1, 0), self._compile)
+        self.curve_cache.clear()
+        self.curve_cache.get((1, 0), self._compile)
+        self.assertEqual(self.compile_calls, 2)
+
+
+class CompiledCurvesInterpolateTestCase(TestCase):
+    def _get_timestamps(self, *datetimes):
+        return np.array(
+            [
+                int(dt.datetime(*d, tzinfo=dt.timezone.utc).timestamp()) * 10**9
+                for d in datetimes
+            ],
+            dtype=np.int64,
+        )
+
+    def test_interpolate(self):
+        compiled_curves = CompiledCurves(
+            [
+                (1, dt.date(2019, 5, 1), dt.date(2019, 5, 31), [3, 5], [100, 200]),
+                (2, dt.date(2019, 6, 1), dt.date(2019, 6, 30), [3, 5], [300, 400]),
+            ]
+        )
+        timestamps = self._get_timestamps(
+            (2019, 4, 30, 23, 59),
+            (2019, 5, 1, 0, 0),
+            (2019, 5, 31, 23, 59),
+            (2019, 6, 1, 0, 0),
+            (2019, 6, 15, 0, 0),
+            (2019, 7, 1, 0, 0),
+        )
+        values = np.array([4.0, 4.0, 4.0, 4.0, 6.0, 4.0])
+        np.testing.assert_equal(
+            compiled_curves.interpolate(timestamps, values),
+            [np.nan, 150, 150, 350, np.nan, np.nan],
+        )
+
+    def test_later_period_wins_where_periods_overlap(self):
+        compiled_curves = CompiledCurves(
+            [
+                (1, dt.date(2019, 5, 1), dt.date(2019, 5, 31), [0, 10], [0, 10]),
+                (2, dt.date(2019, 5, 10), dt.date(2019, 5, 20), [0, 10], [0, 100]),
+            ]
+        )
+        timestamps = self._get_timestamps(
+            (2019, 5, 9, 12, 0), (2019, 5, 15, 12, 0), (2019, 5, 21, 12, 0)
+        )
+        values = np.array([1.0, 1.0, 1.0])
+        np.testing.assert_equal(
+            compiled_curves.interpolate(timestamps, values), [1, 10, 1]
+        )
+
+    def test_no_periods(self):
+        timestamps = self._get_timestamps((2019, 5, 9, 12, 0))
+        result = CompiledCurves([]).interpolate(timestamps, np.array([1.0]))
+        np.testing.assert_equal(result, [np.nan])
+
+
+class CurveBenchmarksTestCase(TestCase):
+    def test_runs_curve_benchmarks(self):
+        result = benchmarks.run("curves/", records=10, repeat=1)
+        self.assertEqual([name for name, seconds in result], ["curves/interpolate"])
+
+
+class EncodeCurveTestCase(TestCase):
+    def test_little_endian_float64(self):
+        data = encode_curve([1.5], [2.5])
+        self.assertEqual(data, np.array([1.5, 2.5], dtype="<f8").tobytes())
+
+    def test_sorts_by_x(self):
+        x, y = decode_curve(encode_curve([3, 1, 2], [30, 10, 20]))
+        np.testing.assert_equal(x, [1, 2, 3])
+        np.testing.assert_equal(y, [10, 20, 30])
+
+    def test_decode_memoryview(self):
+        x, y = decode_curve(memoryview(encode_curve([1, 2], [3, 4])))
+        np.testing.assert_equal(x, [1, 2])
+        np.testing.assert_equal(y, [3, 4])
+
+    def test_empty(self):
+        x, y = decode_curve(b"")
+        self.assertEqual((len(x), len(y)), (0, 0))
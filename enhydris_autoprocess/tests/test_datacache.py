@@ -0,0 +1,108 @@
+import datetime as dt
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+import pandas as pd
+from model_mommy import mommy
+
+from enhydris.models import Station, Timeseries, TimeseriesGroup
+from enhydris_autoprocess.datacache import DataCache
+
+
+class DataCacheTestCase(TestCase):
+    def setUp(self):
+        station = mommy.make(Station, display_timezone="Etc/GMT-2")
+        timeseries_group = mommy.make(
+            TimeseriesGroup, gentity=station, variable__descr="h"
+        )
+        self.timeseries = mommy.make(
+            Timeseries, timeseries_group=timeseries_group, type=Timeseries.INITIAL
+        )
+        self.timeseries.set_data(
+            pd.DataFrame(
+                data={"value": [1.0, 2.0, 3.0, 4.0], "flags": 4 * [""]},
+                columns=["value", "flags"],
+                index=[self._date(m) for m in (0, 10, 20, 30)],
+            )
+        )
+        self.timeseries = Timeseries.objects.get(id=self.timeseries.id)
+        self.data_cache = DataCache()
+        patcher = mock.patch.object(
+            Timeseries, "get_data", autospec=True, side_effect=Timeseries.get_data
+        )
+        self.mock_get_data = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _date(self, minute):
+        return dt.datetime(2019, 5, 21, 17, minute, tzinfo=dt.timezone.utc)
+
+    def _get_values(self, **kwargs):
+        htimeseries = self.data_cache.get_data(self.timeseries, **kwargs)
+        return list(htimeseries.data["value"])
+
+    def test_miss(self):
+        self.assertEqual(self._get_values(), [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(self.data_cache.stats["misses"], 1)
+        self.assertEqual(self.data_cache.stats["hits"], 0)
+
+    def test_hit(self):
+        self._get_values()
+        self.assertEqual(self._get_values(), [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(self.mock_get_data.call_count, 1)
+        self.assertEqual(self.data_cache.stats["hits"], 1)
+
+    def test_hit_on_covered_part(self):
+        self._get_values()
+        values = self._get_values(start_date=self._date(10), end_date=self._date(20))
+        self.assertEqual(values, [2.0, 3.0])
+        self.assertEqual(self.mock_get_data.call_count, 1)
+
+    def test_miss_on_part_not_covered(self):
+        self._get_values(start_date=self._date(10))
+        self.assertEqual(self._get_values(), [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(self.mock_get_data.call_count, 2)
+
+    def test_miss_after_modification(self):
+        self._get_values()
+        self.timeseries.last_modified += dt.timedelta(seconds=1)
+        self._get_values()
+        self.assertEqual(self.mock_get_data.call_count, 2)
+
+    def test_outdated_fragments_are_removed(self):
+        self._get_values()
+        self.timeseries.last_modified += dt.timedelta(seconds=1)
+        self._get_values()
+        self.assertEqual(self.data_cache.stats["fragments"], 1)
+
+    def test_returns_copy(self):
+        htimeseries = self.data_cache.get_data(self.timeseries)
+        htimeseries.data["value"] = 42.0
+        self.assertEqual(self._get_values(), [1.0, 2.0, 3.0, 4.0])
+
+    def test_evicts_least_recently_used(self):
+        self._get_values(end_date=self._date(10))
+        size = self.data_cache.memory
+        with override_settings(ENHYDRIS_AUTOPROCESS_DATA_CACHE_MEMORY=2 * size):
+            self._get_values(start_date=self._date(20))
+            self._get_values(end_date=self._date(10))  # Now most recently used
+            self._get_values(start_date=self._date(10), end_date=self._date(20))
+            self.assertEqual(self.data_cache.stats["fragments"], 2)
+            self._get_values(end_date=self._date(10))
+            self.assertEqual(self.mock_get_data.call_count, 3)
+            self._get_values(start_date=self._date(20))
+            self.assertEqual(self.mock_get_data.call_count, 4)
+
+    @override_settings(ENHYDRIS_AUTOPROCESS_DATA_CACHE_MEMORY=0)
+    def test_disabled(self):
+        self._get_values()
+        self._get_values()
+        self.assertEqual(self.mock_get_data.call_count, 2)
+        self.assertEqual(self.data_cache.memory, 0)
+
+    def test_clear(self):
+        self._get_values()
+        self.data_cache.clear()
+        self.assertEqual(
+            self.data_cache.stats, {"hits": 0, "misses": 0, "fragments": 0, "memory": 0}
+        )
@@ -0,0 +1,148 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from model_mommy import mommy
+
+from enhydris.models import Station, Timeseries, TimeseriesGroup
+from enhydris_autoprocess import dependencies
+from enhydris_autoprocess.models import Aggregation, Checks, CurveInterpolation
+
+
+class GetConsumerIdsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch(
+            "enhydris_autoprocess.dependencies.cache_is_process_local",
+            return_value=False,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.station = mommy.make(Station)
+        self.timeseries_group = mommy.make(TimeseriesGroup, gentity=self.station)
+        self.initial = self._make_timeseries(Timeseries.INITIAL)
+        self.checks = mommy.make(Checks, timeseries_group=self.timeseries_group)
+        self.aggregation = mommy.make(
+            Aggregation, timeseries_group=self.timeseries_group, target_time_step="H"
+        )
+        self.curve_interpolation = mommy.make(
+            CurveInterpolation,
+            timeseries_group=self.timeseries_group,
+            target_timeseries_group__gentity=self.station,
+        )
+
+    def _make_timeseries(self, type):
+        return mommy.make(Timeseries, timeseries_group=self.timeseries_group, type=type)
+
+    def test_all_consume_initial_if_there_is_no_checked(self):
+        self.assertEqual(
+            set(dependencies.get_consumer_ids(self.initial)),
+            {self.checks.id, self.aggregation.id, self.curve_interpolation.id},
+        )
+
+    def test_checks_consume_initial_if_there_is_checked(self):
+        self._make_timeseries(Timeseries.CHECKED)
+        self.assertEqual(dependencies.get_consumer_ids(self.initial), [self.checks.id])
+
+    def test_others_consume_checked(self):
+        checked = self._make_timeseries(Timeseries.CHECKED)
+        self.assertEqual(
+            set(dependencies.get_consumer_ids(checked)),
+            {self.aggregation.id, self.curve_interpolation.id},
+        )
+
+    def test_no_consumers(self):
+        aggregated = self._make_timeseries(Timeseries.AGGREGATED)
+        self.assertEqual(dependencies.get_consumer_ids(aggregated), [])
+
+    def test_does_not_create_timeseries(self):
+        dependencies.get_consumer_ids(self.initial)
+        self.assertEqual(Timeseries.objects.count(), 1)
+
+    def test_no_queries_when_cached(self):
+        dependencies.get_consumer_ids(self.initial)
+        with self.assertNumQueries(0):
+            dependencies.get_consumer_ids(self.initial)
+
+    def test_invalidated_when_timeseries_is_created(self):
+        dependencies.get_consumer_ids(self.initial)
+        self._make_timeseries(Timeseries.CHECKED)
+        self.assertEqual(dependencies.get_consumer_ids(self.initial), [self.checks.id])
+
+    def test_invalidated_when_timeseries_is_deleted(self):
+        checked = self._make_timeseries(Timeseries.CHECKED)
+        dependencies.get_consumer_ids(self.initial)
+        checked.delete()
+        self.assertEqual(len(dependencies.get_consumer_ids(self.initial)), 3)
+
+    def test_invalidated_when_timeseries_type_changes(self):
+        dependencies.get_consumer_ids(self.initial)
+        self.initial.type = Timeseries.CHECKED
+        self.initial.save()
+        self.assertEqual(
+            set(dependencies.get_consumer_ids(self.initial)),
+            {self.aggregation.id, self.curve_interpolation.id},
+        )
+
+    def test_invalidated_when_type_of_other_timeseries_changes(self):
+        checked = self._make_timeseries(Timeseries.CHECKED)
+        dependencies.get_consumer_ids(self.initial)
+        checked.type = Timeseries.AGGREGATED
+        checked.save()
+        self.assertEqual(len(dependencies.get_consumer_ids(self.initial)), 3)
+
+    def test_invalidated_when_other_timeseries_changes_group(self):
+        checked = self._make_timeseries(Timeseries.CHECKED)
+        dependencies.get_consumer_ids(self.initial)
+        checked.timeseries_group = mommy.make(TimeseriesGroup, gentity=self.station)
+        checked.save()
+        self.assertEqual(len(dependencies.get_consumer_ids(self.initial)), 3)
+
+    def test_not_invalidated_when_other_fields_change(self):
+        dependencies.get_consumer_ids(self.initial)
+        self.initial.precision = 2
+        self.initial.save()
+        with self.assertNumQueries(0):
+            dependencies.get_consumer_ids(self.initial)
+
+    def test_invalidated_when_auto_process_is_created(self):
+        dependencies.get_consumer_ids(self.initial)
+        checks = mommy.make(Checks, timeseries_group=self.timeseries_group)
+        self.assertIn(checks.id, dependencies.get_consumer_ids(self.initial))
+
+    def test_invalidated_when_auto_process_is_deleted(self):
+        aggregation_id = self.aggregation.id
+        dependencies.get_consumer_ids(self.initial)
+        self.aggregation.delete()
+        self.assertNotIn(aggregation_id, dependencies.get_consumer_ids(self.initial))
+
+    def test_invalidated_when_auto_process_changes_group(self):
+        dependencies.get_consumer_ids(self.initial)
+        self.aggregation.timeseries_group = mommy.make(TimeseriesGroup)
+        self.aggregation.save()
+        self.assertNotIn(
+            self.aggregation.id, dependencies.get_consumer_ids(self.initial)
+        )
+
+
+class GetConsumerIdsWithProcessLocalCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.timeseries_group = mommy.make(TimeseriesGroup, gentity=mommy.make(Station))
+        self.initial = mommy.make(
+            Timeseries, timeseries_group=self.timeseries_group, type=Timeseries.INITIAL
+        )
+
+    @mock.patch(
+        "enhydris_autoprocess.dependencies.cache_is_process_local", return_value=True
+    )
+    def test_ignores_cached_index(self, m):
+        dependencies.get_consumer_ids(self.initial)
+        # Creating an auto process in another process wouldn't invalidate our cache
+        checks = mommy.make(Checks, timeseries_group=self.timeseries_group)
+        cache.set(
+            dependencies._get_index_key(self.timeseries_group.id),
+            {self.initial.id: (Timeseries.INITIAL, [])},
+        )
+        self.assertEqual(dependencies.get_consumer_ids(self.initial), [checks.id])
@@ -0,0 +1,65 @@
+from django.test import TestCase
+
+import numpy as np
+import pandas as pd
+
+from enhydris_autoprocess.flags import BITS_COLUMN, FlagRegistry, flag_registry
+
+
+class FlagRegistryTestCase(TestCase):
+    def setUp(self):
+        self.registry = FlagRegistry()
+        self.registry.register("RANGE")
+        self.registry.register("TEMPORAL")
+        self.data = pd.DataFrame(
+            data={"value": [1.0, 2.0, 3.0], "flags": ["", "FLAG1", ""]},
+            columns=["value", "flags"],
+        )
+
+    def test_register_assigns_consecutive_bits(self):
+        self.assertEqual(self.registry.get_bit("RANGE"), 1)
+        self.assertEqual(self.registry.get_bit("TEMPORAL"), 2)
+
+    def test_register_is_idempotent(self):
+        self.assertEqual(self.registry.register("RANGE"), 1)
+
+    def test_add(self):
+        self.registry.add(self.data, [True, False, True], "TEMPORAL")
+        self.registry.add(self.data, [True, True, False], "RANGE")
+        self.assertEqual(list(self.data[BITS_COLUMN]), [3, 1, 2])
+
+    def test_add_does_not_modify_flags(self):
+        self.registry.add(self.data, [True, True, True], "RANGE")
+        self.assertEqual(list(self.data["flags"]), ["", "FLAG1", ""])
+
+    def test_has(self):
+        self.registry.add(self.data, [False, True, False], "RANGE")
+        np.testing.assert_equal(
+            self.registry.has(self.data, "RANGE"), [False, True, False]
+        )
+        np.testing.assert_equal(
+            self.registry.has(self.data, "TEMPORAL"), [False, False, False]
+        )
+
+    def test_to_strings(self):
+        self.registry.add(self.data, [True, True, False], "TEMPORAL")
+        self.registry.add(self.data, [True, False, False], "RANGE")
+        self.registry.to_strings(self.data)
+        self.assertEqual(
+            list(self.data["flags"]), ["RANGE TEMPORAL", "FLAG1 TEMPORAL", ""]
+        )
+
+    def test_to_strings_removes_bits_column(self):
+        self.registry.add(self.data, [True, False, False], "RANGE")
+        self.registry.to_strings(self.data)
+        self.assertEqual(list(self.data.columns), ["value", "flags"])
+
+    def test_to_strings_without_bits(self):
+        self.registry.to_strings(self.data)
+        self.assertEqual(list(self.data["flags"]), ["", "FLAG1", ""])
+
+
+class DefaultFlagRegistryTestCase(TestCase):
+    def test_standard_flags_are_registered(self):
+        for name in ("RANGE", "SUSPECT", "TEMPORAL", "MISS", "DATEINSERT"):
+            flag_registry.get_bit(name)
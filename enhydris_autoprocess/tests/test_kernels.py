@@ -0,0 +1,297 @@
+import datetime as dt
+
+from django.test import TestCase
+
+import numpy as np
+import pandas as pd
+from model_mommy import mommy
+from rocc import Threshold
+
+from enhydris.models import TimeseriesGroup
+from enhydris_autoprocess import benchmarks
+from enhydris_autoprocess.flags import BITS_COLUMN, flag_registry
+from enhydris_autoprocess.kernels import (
+    FlatLineKernel,
+    FusedKernel,
+    Kernel,
+    RangeKernel,
+    RateOfChangeKernel,
+    SlidingMedian,
+    SpikeKernel,
+    fuse,
+    get_month_hour_slots,
+    get_timestamps,
+    run_kernels,
+)
+from enhydris_autoprocess.models import Checks, RangeCheck, RateOfChangeCheck
+
+
+def _get_dataframe(values):
+    return pd.DataFrame(
+        data={"value": values, "flags": ""},
+        columns=["value", "flags"],
+        index=pd.date_range(
+            "2019-05-21 17:00", periods=len(values), freq="10min", tz="UTC"
+        ),
+    )
+
+
+class RangeKernelTestCase(TestCase):
+    def setUp(self):
+        self.timestamps = np.zeros(5, dtype=np.int64)
+        self.values = np.array([1.0, 5.0, np.nan, 25.0, 40.0])
+
+    def test_remove(self):
+        remove, flags = RangeKernel(2, 30, 4, 20)(self.timestamps, self.values)
+        np.testing.assert_equal(remove, [True, False, False, False, True])
+
+    def test_flags(self):
+        remove, flags = RangeKernel(2, 30, 4, 20)(self.timestamps, self.values)
+        range_bit = flag_registry.get_bit("RANGE")
+        suspect_bit = flag_registry.get_bit("SUSPECT")
+        np.testing.assert_equal(flags, [range_bit, 0, 0, suspect_bit, range_bit])
+
+    def test_missing_bounds(self):
+        remove, flags = RangeKernel(None, 30, None, None)(self.timestamps, self.values)
+        np.testing.assert_equal(remove, [False, False, False, False, True])
+
+    def test_does_not_modify_values(self):
+        RangeKernel(2, 30, 4, 20)(self.timestamps, self.values)
+        np.testing.assert_equal(self.values, [1.0, 5.0, np.nan, 25.0, 40.0])
+
+
+class FuseTestCase(TestCase):
+    def setUp(self):
+        self.range_kernel1 = RangeKernel(0, 10, None, None)
+        self.range_kernel2 = RangeKernel(0, 20, None, None)
+        self.range_kernel3 = RangeKernel(0, 30, None, None)
+        self.other_kernel = Kernel()
+
+    def test_fuses_consecutive_pointwise_kernels(self):
+        result = fuse([self.range_kernel1, self.range_kernel2])
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].kernels, [self.range_kernel1, self.range_kernel2])
+
+    def test_does_not_fuse_across_non_pointwise_kernel(self):
+        result = fuse(
+            [
+                self.range_kernel1,
+                self.range_kernel2,
+                self.other_kernel,
+                self.range_kernel3,
+            ]
+        )
+        self.assertEqual(len(result), 3)
+        self.assertIsInstance(result[0], FusedKernel)
+        self.assertIs(result[1], self.other_kernel)
+        self.assertIs(result[2], self.range_kernel3)
+
+    def test_empty(self):
+        self.assertEqual(fuse([]), [])
+
+
+class FusedKernelTestCase(TestCase):
+    def setUp(self):
+        self.kernels = [RangeKernel(0, 30, 5, 25), RangeKernel(10, 40, None, None)]
+        rng = np.random.default_rng(42)
+        self.values = rng.normal(20, 10, 100).round(1)
+        self.values[::7] = np.nan
+        self.timestamps = np.zeros(100, dtype=np.int64)
+
+    def test_same_result_as_separate_kernels(self):
+        fused_kernel = FusedKernel(self.kernels)
+        fused_kernel.block_size = 16
+        fused_remove, fused_flags = fused_kernel(self.timestamps, self.values)
+
+        values = self.values.copy()
+        remove = np.zeros(100, dtype=bool)
+        flags = np.zeros(100, dtype=np.uint32)
+        for kernel in self.kernels:
+            kernel_remove, kernel_flags = kernel(self.timestamps, values)
+            values[kernel_remove] = np.nan
+            remove |= kernel_remove
+            flags |= kernel_flags
+
+        np.testing.assert_equal(fused_remove, remove)
+        np.testing.assert_equal(fused_flags, flags)
+
+    def test_does_not_modify_values(self):
+        values = self.values.copy()
+        FusedKernel(self.kernels)(self.timestamps, self.values)
+        np.testing.assert_equal(self.values, values)
+
+
+class RunKernelsTestCase(TestCase):
+    def test_sets_values_and_flag_bits(self):
+        data = _get_dataframe([1.0, 5.0, 25.0, 40.0])
+        run_kernels([RangeKernel(2, 30, 4, 20)], data)
+        np.testing.assert_equal(data["value"].values, [np.nan, 5.0, 25.0, np.nan])
+        self.assertEqual(
+            list(flag_registry.to_strings(data)["flags"]),
+            ["RANGE", "", "SUSPECT", "RANGE"],
+        )
+
+    def test_adds_to_existing_flag_bits(self):
+        data = _get_dataframe([1.0, 5.0])
+        flag_registry.add(data, [False, True], "MISS")
+        run_kernels([RangeKernel(2, 30, None, None)], data)
+        self.assertEqual(
+            list(data[BITS_COLUMN]),
+            [flag_registry.get_bit("RANGE"), flag_registry.get_bit("MISS")],
+        )
+
+    def test_later_kernels_see_removed_values(self):
+        data = _get_dataframe([1.0, 1.5, 2.0, 50.0, 2.5])
+        run_kernels(
+            [
+                RangeKernel(0, 30, None, None),
+                RateOfChangeKernel([Threshold("10min", 10)], symmetric=True),
+            ],
+            data,
+        )
+        # Without the range check, the record after 50.0 would fail the time
+        # consistency check
+        self.assertEqual(
+            list(flag_registry.to_strings(data)["flags"]), ["", "", "", "RANGE", ""]
+        )
+
+    def test_empty(self):
+        data = _get_dataframe([])
+        run_kernels([RangeKernel(2, 30, None, None)], data)
+        self.assertTrue(data.empty)
+
+
+class CheckBenchmarksTestCase(TestCase):
+    def setUp(self):
+        mommy.make(TimeseriesGroup)
+
+    def test_registers_benchmark_for_each_check_type(self):
+        for check_type in Checks.check_types:
+            name = f"checks/{check_type._meta.model_name}"
+            self.assertIn(name, benchmarks.benchmarks)
+
+    def test_runs_check_benchmarks(self):
+        result = benchmarks.run("checks/", records=10, repeat=1)
+        names = [name for name, seconds in result]
+        self.assertIn("checks/rangecheck", names)
+        self.assertIn("checks/rateofchangecheck", names)
+
+    def test_check_types_are_registered_in_order(self):
+        self.assertEqual(Checks.check_types[:2], [RangeCheck, RateOfChangeCheck])
+
+
+class FlatLineKernelTestCase(TestCase):
+    def setUp(self):
+        self.timestamps = get_timestamps(
+            pd.date_range("2019-05-21 17:00", periods=8, freq="10min", tz="UTC")
+        )
+        self.values = np.array([1.0, 2.0, 2.0, 2.0, 2.0, np.nan, np.nan, np.nan])
+
+    def test_flags(self):
+        remove, flags = FlatLineKernel("20min")(self.timestamps, self.values)
+        flatline_bit = flag_registry.get_bit("FLATLINE")
+        np.testing.assert_equal(flags, [0, 0, 0, 0, flatline_bit, 0, 0, 0])
+
+    def test_does_not_remove_values(self):
+        remove, flags = FlatLineKernel("20min")(self.timestamps, self.values)
+        self.assertFalse(remove.any())
+
+    def test_irregular_timestamps(self):
+        timestamps = self.timestamps.copy()
+        timestamps[2] += 25 * 60 * 10**9
+        timestamps[3] += 25 * 60 * 10**9
+        timestamps[4] += 25 * 60 * 10**9
+        remove, flags = FlatLineKernel("20min")(timestamps, self.values)
+        self.assertEqual(
+            list(flags != 0), [False, False, True, True, True] + [False] * 3
+        )
+
+
+class SlidingMedianTestCase(TestCase):
+    def test_same_as_median_of_window(self):
+        rng = np.random.default_rng(42)
+        values = rng.integers(0, 10, 200).astype(float)
+        sliding_median = SlidingMedian()
+        for i, value in enumerate(values):
+            sliding_median.add(i, value)
+            if i >= 7:
+                sliding_median.remove(i - 7)
+            start, end = max(i - 6, 0), i + 1
+            window = values[start:end]
+            self.assertEqual(sliding_median.median(), np.median(window))
+
+    def test_len(self):
+        sliding_median = SlidingMedian()
+        sliding_median.add("a", 1.0)
+        sliding_median.add("b", 2.0)
+        sliding_median.remove("a")
+        self.assertEqual(len(sliding_median), 1)
+
+
+class SpikeKernelTestCase(TestCase):
+    def setUp(self):
+        self.timestamps = get_timestamps(
+            pd.date_range("2019-05-21 17:00", periods=8, freq="10min", tz="UTC")
+        )
+        self.values = np.array([1.0, 2.0, 1.5, 9.0, 1.0, np.nan, 12.0, 8.0])
+
+    def test_remove(self):
+        remove, flags = SpikeKernel(3, 5)(self.timestamps, self.values)
+        np.testing.assert_equal(
+            remove, [False, False, False, True, False, False, True, False]
+        )
+
+    def test_flags(self):
+        remove, flags = SpikeKernel(3, 5)(self.timestamps, self.values)
+        spike_bit = flag_registry.get_bit("SPIKE")
+        np.testing.assert_equal(flags, [0, 0, 0, spike_bit, 0, 0, spike_bit, 0])
+
+    def test_does_not_check_values_with_incomplete_window(self):
+        values = np.array([1.0, 9.0, 1.0, 2.0, 1.0, 1.0, 1.0, 1.0])
+        remove, flags = SpikeKernel(2, 5)(self.timestamps, values)
+        self.assertFalse(remove.any())
+
+
+class SeasonalRangeKernelTestCase(TestCase):
+    def setUp(self):
+        index = pd.date_range(
+            "2019-01-31 21:00",
+            periods=4,
+            freq="1h",
+            tz=dt.timezone(dt.timedelta(hours=2)),
+        )
+        self.timestamps = get_timestamps(index)
+        self.lower_bound = np.zeros((12, 24))
+        self.lower_bound[1, :] = 10  # February
+        self.lower_bound[1, 0] = 20  # February, 00:00-00:59
+        self.kernel = RangeKernel(self.lower_bound, 100, None, None)
+        self.kernel.tz = index.tz
+
+    def test_month_hour_slots(self):
+        slots = get_month_hour_slots(self.timestamps, self.kernel.tz)
+        np.testing.assert_equal(slots, [21, 22, 23, 24])
+
+    def test_month_hour_slots_in_utc(self):
+        slots = get_month_hour_slots(self.timestamps, None)
+        np.testing.assert_equal(slots, [19, 20, 21, 22])
+
+    def test_remove(self):
+        values = np.array([15.0, 15.0, 15.0, 15.0])
+        remove, flags = self.kernel(self.timestamps, values)
+        np.testing.assert_equal(remove, [False, False, False, True])
+
+    def test_nan_means_no_bound(self):
+        self.lower_bound[0, :] = np.nan
+        kernel = RangeKernel(self.lower_bound, 100, None, None)
+        kernel.tz = self.kernel.tz
+        remove, flags = kernel(self.timestamps, np.array([-50.0, -50.0, -50.0, -50.0]))
+        np.testing.assert_equal(remove, [False, False, False, True])
+
+    def test_run_kernels_sets_time_zone(self):
+        kernel = RangeKernel(self.lower_bound, 100, None, None)
+        data = _get_dataframe([15.0, 15.0, 15.0, 15.0])
+        data.index = pd.DatetimeIndex(
+            [dt.datetime(2019, 1, 31, 22, 0, tzinfo=dt.timezone.utc)] * 4
+        ).tz_convert(dt.timezone(dt.timedelta(hours=2)))
+        run_kernels([kernel], data)
+        np.testing.assert_equal(data["value"].values, [np.nan] * 4)
@@ -2,12 +2,16 @@ import datetime as dt
 import textwrap
 from unittest import mock
 
-from django.db import DataError, IntegrityError, transaction
-from django.test import TestCase, TransactionTestCase
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import DataError, IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 import numpy as np
 import pandas as pd
 from haggregate import RegularizationMode as RM
+from haggregate import regularize
 from htimeseries import HTimeseries
 from model_mommy import mommy
 from rocc import Threshold
@@ -15,17 +19,24 @@ from rocc import Threshold
 from enhydris.models import Station, Timeseries, TimeseriesGroup, Variable
 from enhydris.tests import ClearCacheMixin
 from enhydris.tests.test_models.test_timeseries import get_tzinfo
-from enhydris_autoprocess import tasks
+from enhydris_autoprocess import batch, tasks
+from enhydris_autoprocess.curves import curve_cache
+from enhydris_autoprocess.datacache import data_cache
+from enhydris_autoprocess.flags import flag_registry
 from enhydris_autoprocess.models import (
     Aggregation,
+    AggregationState,
     AutoProcess,
     Checks,
     CurveInterpolation,
     CurvePeriod,
     CurvePoint,
+    FlatLineCheck,
     RangeCheck,
+    RangeCheckBound,
     RateOfChangeCheck,
     RateOfChangeThreshold,
+    SpikeCheck,
 )
 
 
@@ -60,6 +71,45 @@ class AutoProcessTestCase(TestCase):
         self.assertEqual(AutoProcess.objects.count(), 0)
 
 
+class AutoProcessAsSpecificInstanceTestCase(TestCase):
+    def setUp(self):
+        station = mommy.make(Station)
+        timeseries_group1 = mommy.make(TimeseriesGroup, gentity=station)
+        timeseries_group2 = mommy.make(TimeseriesGroup, gentity=station)
+        self.checks = mommy.make(Checks, timeseries_group=timeseries_group1)
+        self.curve_interpolation = mommy.make(
+            CurveInterpolation,
+            timeseries_group=timeseries_group1,
+            target_timeseries_group=timeseries_group2,
+        )
+        self.aggregation = mommy.make(
+            Aggregation, timeseries_group=timeseries_group1, target_time_step="H"
+        )
+
+    def test_as_specific_instance(self):
+        auto_processes = AutoProcess.objects.order_by("id")
+        self.assertEqual(
+            [x.as_specific_instance for x in auto_processes],
+            [self.checks, self.curve_interpolation, self.aggregation],
+        )
+
+    def test_subclass_fields_are_loaded(self):
+        auto_process = AutoProcess.objects.get(id=self.aggregation.id)
+        self.assertEqual(auto_process.as_specific_instance.target_time_step, "H")
+
+    def test_no_extra_queries_for_as_specific_instance(self):
+        with self.assertNumQueries(1):
+            for auto_process in AutoProcess.objects.all():
+                specific_instance = auto_process.as_specific_instance
+                specific_instance.timeseries_group_id
+
+    def test_no_extra_queries_for_as_specific_instance_via_group(self):
+        timeseries_group = self.checks.timeseries_group
+        with self.assertNumQueries(1):
+            for auto_process in timeseries_group.autoprocess_set.all():
+                auto_process.as_specific_instance
+
+
 class AutoProcessSaveTestCase(TransactionTestCase):
     # Setting available_apps activates TRUNCATE ... CASCADE, which is necessary because
     # enhydris.TimeseriesRecord is unmanaged, TransactionTestCase doesn't attempt to
@@ -68,6 +118,7 @@ class AutoProcessSaveTestCase(TransactionTestCase):
     available_apps = ["django.contrib.sites", "enhydris", "enhydris_autoprocess"]
 
     def setUp(self):
+        cache.clear()
         with transaction.atomic():
             self.timeseries_group = mommy.make(TimeseriesGroup)
         self.original_execute_auto_process = tasks.execute_auto_process
@@ -190,6 +241,262 @@ class AutoProcessExecuteDealsOnlyWithNewerTimeseriesPartTestCase(TestCase):
         )
 
 
+class AutoProcessExecuteInChunksTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        station = mommy.make(Station, display_timezone="Etc/GMT-2")
+        self.timeseries_group = mommy.make(
+            TimeseriesGroup, gentity=station, variable__descr="h"
+        )
+        self.source_timeseries = mommy.make(
+            Timeseries, timeseries_group=self.timeseries_group, type=Timeseries.INITIAL
+        )
+        self.source_timeseries.set_data(
+            pd.DataFrame(
+                data={"value": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0], "flags": 6 * [""]},
+                columns=["value", "flags"],
+                index=[
+                    dt.datetime(2019, 5, 21, 17, m, tzinfo=get_tzinfo("Etc/GMT-2"))
+                    for m in (0, 10, 20, 30, 40, 50)
+                ],
+            )
+        )
+        self.target_timeseries = mommy.make(
+            Timeseries, timeseries_group=self.timeseries_group, type=Timeseries.CHECKED
+        )
+        self.checks = mommy.make(Checks, timeseries_group=self.timeseries_group)
+        self.checks.chunk_duration = dt.timedelta(minutes=20)
+        self.chunks = []
+
+    def _process_timeseries(self, checks):
+        self.chunks.append([x.minute for x in checks.htimeseries.data.index])
+        return checks.htimeseries.data
+
+    def _execute(self):
+        with mock.patch(
+            "enhydris_autoprocess.models.Checks.process_timeseries",
+            side_effect=self._process_timeseries,
+            autospec=True,
+        ):
+            self.checks.execute()
+
+    def test_processes_in_chunks(self):
+        self._execute()
+        self.assertEqual(self.chunks, [[0, 10], [20, 30], [40, 50]])
+
+    def test_reads_overlap_with_previous_chunk(self):
+        roc_check = mommy.make(RateOfChangeCheck, checks=self.checks)
+        roc_check.set_thresholds("10min\t5")
+        self._execute()
+        self.assertEqual(self.chunks, [[0, 10], [10, 20, 30], [30, 40, 50]])
+
+    def test_appends_all_data(self):
+        roc_check = mommy.make(RateOfChangeCheck, checks=self.checks)
+        roc_check.set_thresholds("10min\t5")
+        self._execute()
+        self.assertEqual(
+            list(self.target_timeseries.get_data().data["value"]),
+            [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+        )
+
+    def test_does_not_hand_off_data_of_many_chunks(self):
+        self._execute()
+        self.assertIsNone(self.checks._appended_data)
+
+    def test_processes_once_if_source_is_empty_and_target_is_not(self):
+        self.target_timeseries.set_data(self.source_timeseries.get_data().data)
+        self.source_timeseries.set_data(
+            pd.DataFrame(columns=["value", "flags"], index=pd.DatetimeIndex([]))
+        )
+        self._execute()
+        self.assertEqual(self.chunks, [[]])
+
+    def test_processes_in_one_chunk_if_chunks_are_long(self):
+        self.checks.chunk_duration = dt.timedelta(days=1)
+        self._execute()
+        self.assertEqual(self.chunks, [[0, 10, 20, 30, 40, 50]])
+
+
+class AggregationChunkOverlapTestCase(TestCase):
+    def _get_chunk_overlap(self, target_time_step):
+        return Aggregation(target_time_step=target_time_step)._get_chunk_overlap()
+
+    def test_hourly(self):
+        self.assertEqual(self._get_chunk_overlap("H"), dt.timedelta(hours=1))
+
+    def test_two_days(self):
+        self.assertEqual(self._get_chunk_overlap("2D"), dt.timedelta(days=2))
+
+    def test_ten_minutes(self):
+        self.assertEqual(self._get_chunk_overlap("10min"), dt.timedelta(minutes=10))
+
+    def test_monthly(self):
+        self.assertEqual(self._get_chunk_overlap("M"), dt.timedelta(days=31))
+
+    def test_yearly(self):
+        self.assertEqual(self._get_chunk_overlap("Y"), dt.timedelta(days=366))
+
+
+class AutoProcessHandOffTestCase(TestCase):
+    def setUp(self):
+        station = mommy.make(Station, display_timezone="Etc/GMT-2")
+        self.timeseries_group = mommy.make(
+            TimeseriesGroup, gentity=station, variable__descr="h"
+        )
+        self.initial_timeseries = self._make_timeseries(Timeseries.INITIAL)
+        self.initial_timeseries.set_data(
+            self._get_dataframe([1.0, 2.0, 3.0, 4.0], ["00", "10", "20", "30"])
+        )
+        self.checked_timeseries = self._make_timeseries(Timeseries.CHECKED)
+        self.checks = mommy.make(Checks, timeseries_group=self.timeseries_group)
+        mommy.make(RangeCheck, checks=self.checks, lower_bound=0, upper_bound=100)
+        self.aggregation = mommy.make(
+            Aggregation,
+            timeseries_group=self.timeseries_group,
+            target_time_step="H",
+            method="sum",
+        )
+
+    def _make_timeseries(self, type, **kwargs):
+        kwargs.setdefault("time_step", "10min")
+        return mommy.make(
+            Timeseries, timeseries_group=self.timeseries_group, type=type, **kwargs
+        )
+
+    def _get_dataframe(self, values, minutes):
+        return pd.DataFrame(
+            data={"value": values, "flags": len(values) * [""]},
+            columns=["value", "flags"],
+            index=[
+                dt.datetime(2019, 5, 21, 17, int(m), tzinfo=get_tzinfo("Etc/GMT-2"))
+                for m in minutes
+            ],
+        )
+
+    def test_hands_off_appended_data(self):
+        self.checks.execute()
+        self.checks.hand_off_to(self.aggregation)
+        self.assertEqual(
+            list(self.aggregation.htimeseries.data["value"]), [1.0, 2.0, 3.0, 4.0]
+        )
+
+    def test_sets_time_step(self):
+        self.checks.execute()
+        self.checks.hand_off_to(self.aggregation)
+        self.assertEqual(self.aggregation.htimeseries.time_step, "10min")
+
+    def test_does_not_hand_off_if_consumer_needs_older_data(self):
+        self.checked_timeseries.set_data(self._get_dataframe([1.0, 2.0], ["00", "10"]))
+        self.checks.execute()
+        self.checks.hand_off_to(self.aggregation)
+        self.assertFalse(hasattr(self.aggregation, "_htimeseries"))
+
+    def test_hands_off_only_the_part_the_consumer_needs(self):
+        self.checked_timeseries.set_data(self._get_dataframe([1.0, 2.0], ["00", "10"]))
+        aggregated_timeseries = self._make_timeseries(
+            Timeseries.AGGREGATED, time_step="H", name="Sum"
+        )
+        aggregated_timeseries.set_data(self._get_dataframe([42.0], ["20"]))
+        self.checks.execute()
+        self.checks.hand_off_to(self.aggregation)
+        self.assertEqual(list(self.aggregation.htimeseries.data["value"]), [4.0])
+
+    def test_does_nothing_if_not_executed(self):
+        self.checks.hand_off_to(self.aggregation)
+        self.assertFalse(hasattr(self.aggregation, "_htimeseries"))
+
+
+class AutoProcessMemoizingTimeseriesTestCase(TestCase):
+    def setUp(self):
+        self.station = mommy.make(Station, display_timezone="Etc/GMT-2")
+        self.timeseries_group = mommy.make(
+            TimeseriesGroup, gentity=self.station, variable__descr="h"
+        )
+        self.checked_timeseries = mommy.make(
+            Timeseries,
+            timeseries_group=self.timeseries_group,
+            type=Timeseries.CHECKED,
+            time_step="10min",
+        )
+        self.aggregated_timeseries = mommy.make(
+            Timeseries,
+            timeseries_group=self.timeseries_group,
+            type=Timeseries.AGGREGATED,
+            time_step="H",
+            name="Sum",
+        )
+        self.aggregation = mommy.make(
+            Aggregation,
+            timeseries_group=self.timeseries_group,
+            target_time_step="H",
+            method="sum",
+        )
+
+    def test_queries_on_each_access_by_default(self):
+        self.aggregation.target_timeseries
+        with self.assertNumQueries(1):
+            self.aggregation.target_timeseries
+
+    def test_no_queries_on_repeated_access(self):
+        with self.aggregation.memoizing_timeseries():
+            self.aggregation.source_timeseries
+            self.aggregation.target_timeseries
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                    self.aggregation.source_timeseries, self.checked_timeseries
+                )
+                self.assertEqual(
+                    self.aggregation.target_timeseries, self.aggregated_timeseries
+                )
+
+    def test_memoization_ends_after_block(self):
+        with self.aggregation.memoizing_timeseries():
+            self.aggregation.target_timeseries
+        with self.assertNumQueries(1):
+            self.aggregation.target_timeseries
+
+    def test_finds_timeseries_again_if_group_changes(self):
+        timeseries_group2 = mommy.make(TimeseriesGroup, gentity=self.station)
+        checked_timeseries2 = mommy.make(
+            Timeseries, timeseries_group=timeseries_group2, type=Timeseries.CHECKED
+        )
+        with self.aggregation.memoizing_timeseries():
+            self.aggregation.source_timeseries
+            self.aggregation.timeseries_group = timeseries_group2
+            self.assertEqual(self.aggregation.source_timeseries, checked_timeseries2)
+
+    def test_finds_target_again_if_method_changes(self):
+        with self.aggregation.memoizing_timeseries():
+            self.aggregation.target_timeseries
+            self.aggregation.method = "max"
+            self.assertEqual(self.aggregation.target_timeseries.name, "Max")
+
+    @mock.patch(
+        "enhydris_autoprocess.models.Aggregation._get_target_timeseries",
+        autospec=True,
+        side_effect=Aggregation._get_target_timeseries,
+    )
+    @mock.patch(
+        "enhydris_autoprocess.models.Aggregation._get_source_timeseries",
+        autospec=True,
+        side_effect=Aggregation._get_source_timeseries,
+    )
+    def test_execute_finds_timeseries_once(self, mock_get_source, mock_get_target):
+        self.checked_timeseries.set_data(
+            pd.DataFrame(
+                data={"value": [1.0, 2.0, 3.0], "flags": 3 * [""]},
+                columns=["value", "flags"],
+                index=[
+                    dt.datetime(2019, 5, 21, h, m, tzinfo=get_tzinfo("Etc/GMT-2"))
+                    for h, m in ((17, 40), (17, 50), (18, 0))
+                ],
+            )
+        )
+        self.aggregation.execute()
+        self.assertEqual(mock_get_source.call_count, 1)
+        self.assertEqual(mock_get_target.call_count, 1)
+
+
 class ChecksTestCase(TestCase):
     def test_create(self):
         timeseries_group = mommy.make(TimeseriesGroup)
@@ -247,7 +554,7 @@ class ChecksTestCase(TestCase):
         checks.target_timeseries.id
         self.assertTrue(Timeseries.objects.exists())
 
-    @mock.patch("enhydris_autoprocess.models.RangeCheck.check_timeseries")
+    @mock.patch("enhydris_autoprocess.models.RangeCheck.get_kernel")
     @mock.patch("enhydris.models.Timeseries.append_data")
     def test_runs_range_check(self, m1, m2):
         station = mommy.make(Station, display_timezone="Etc/GMT")
@@ -265,6 +572,47 @@ class ChecksTestCase(TestCase):
             str(Checks.objects.first())
 
 
+class ChecksGetChecksTestCase(TestCase):
+    def setUp(self):
+        self.checks = mommy.make(Checks)
+        self.range_check = mommy.make(
+            RangeCheck, checks=self.checks, lower_bound=2, upper_bound=5
+        )
+        self.roc_check = mommy.make(
+            RateOfChangeCheck, checks=self.checks, symmetric=True
+        )
+        self.roc_check.set_thresholds("10min\t7.0\n1H\t15.0\n")
+
+    def test_get_checks(self):
+        self.assertEqual(self.checks.get_checks(), [self.range_check, self.roc_check])
+
+    def test_get_checks_with_some_checks_missing(self):
+        self.range_check.delete()
+        checks = Checks.objects.get(id=self.checks.id)
+        self.assertEqual(checks.get_checks(), [self.roc_check])
+
+    def test_loads_checks_thresholds_and_seasonal_bounds_in_three_queries(self):
+        with self.assertNumQueries(3):
+            checks = self.checks.get_checks()
+            thresholds = checks[1].thresholds
+            checks[1].lookback
+        self.assertEqual(thresholds, [Threshold("10min", 7.0), Threshold("1H", 15.0)])
+
+    def test_loads_checks_once_during_execution(self):
+        with self.checks.memoizing_timeseries():
+            self.checks.get_checks()
+            with self.assertNumQueries(0):
+                self.checks.get_checks()
+
+    def test_process_timeseries_queries(self):
+        self.checks._htimeseries = HTimeseries(
+            RateOfChangeCheckProcessTimeseriesTestCase.source_timeseries.copy()
+        )
+        cache.clear()
+        with self.assertNumQueries(3):
+            self.checks.process_timeseries()
+
+
 class ChecksAutoDeletionTestCase(TestCase):
     def setUp(self):
         self.checks = mommy.make(Checks, timeseries_group__variable__descr="pH")
@@ -370,10 +718,100 @@ class RangeCheckProcessTimeseriesTestCase(TestCase):
             soft_lower_bound=3,
             soft_upper_bound=4,
         )
-        self.range_check.checks._htimeseries = HTimeseries(self.source_timeseries)
+        self.range_check.checks._htimeseries = HTimeseries(
+            self.source_timeseries.copy()
+        )
         result = self.range_check.checks.process_timeseries()
         pd.testing.assert_frame_equal(result, self.expected_result)
 
+    def test_execute_without_soft_bounds(self):
+        self.range_check = mommy.make(RangeCheck, lower_bound=2, upper_bound=5)
+        self.range_check.checks._htimeseries = HTimeseries(
+            self.source_timeseries.copy()
+        )
+        result = self.range_check.checks.process_timeseries()
+        self.assertEqual(
+            list(result["flags"]),
+            ["RANGE", "", "", "", "FLAG1", "FLAG2", "FLAG3 RANGE"],
+        )
+
+
+class RangeCheckSeasonalBoundsTestCase(TestCase):
+    def setUp(self):
+        self.range_check = mommy.make(
+            RangeCheck,
+            lower_bound=2,
+            upper_bound=5,
+            soft_lower_bound=None,
+            soft_upper_bound=4,
+        )
+        self.range_check.set_seasonal_bounds("7 3 - - 6\n7:14 - - 4.5 -\n")
+
+    def test_get_bounds_without_seasonal_bounds(self):
+        self.range_check.set_seasonal_bounds("")
+        self.assertEqual(self.range_check.get_bounds(), [2, 5, None, 4])
+
+    def test_get_bounds(self):
+        (
+            lower_bound,
+            upper_bound,
+            soft_lower_bound,
+            soft_upper_bound,
+        ) = self.range_check.get_bounds()
+        self.assertEqual(lower_bound[0, 0], 2)
+        self.assertEqual(lower_bound[6, 0], 3)
+        self.assertEqual(upper_bound[6, 14], 6)
+        self.assertTrue(np.isnan(soft_lower_bound).all())
+        self.assertEqual(soft_upper_bound[6, 13], 4)
+        self.assertEqual(soft_upper_bound[6, 14], 4.5)
+        self.assertEqual(soft_upper_bound[7, 14], 4)
+
+    def test_get_seasonal_bounds_as_text(self):
+        self.assertEqual(
+            self.range_check.get_seasonal_bounds_as_text(),
+            "7\t3.0\t-\t-\t6.0\n7:14\t-\t-\t4.5\t-\n",
+        )
+
+    def test_set_seasonal_bounds_replaces_existing(self):
+        self.range_check.set_seasonal_bounds("1 0 - - 1")
+        self.assertEqual(RangeCheckBound.objects.count(), 1)
+
+    def test_refuses_repeated_month(self):
+        with self.assertRaises(IntegrityError):
+            self.range_check.set_seasonal_bounds("1 0 - - 1\n1 0 - - 2")
+
+    def test_refuses_repeated_hour(self):
+        with self.assertRaises(IntegrityError):
+            self.range_check.set_seasonal_bounds("1:3 0 - - 1\n1:3 0 - - 2")
+
+    def test_parse_text_refuses_invalid_month(self):
+        with self.assertRaises(ValueError):
+            RangeCheckBound.parse_text("13 0 - - 1")
+
+    def test_parse_text_refuses_invalid_hour(self):
+        with self.assertRaises(ValueError):
+            RangeCheckBound.parse_text("1:24 0 - - 1")
+
+    def test_parse_text_refuses_wrong_number_of_items(self):
+        with self.assertRaises(ValueError):
+            RangeCheckBound.parse_text("1 0 1")
+
+    def test_process_timeseries(self):
+        self.range_check.checks._htimeseries = HTimeseries(
+            pd.DataFrame(
+                data={"value": [2.5, 2.5, 4.2, 4.2], "flags": ""},
+                columns=["value", "flags"],
+                index=[
+                    dt.datetime(2019, 6, 21, 14, 0, tzinfo=dt.timezone.utc),
+                    dt.datetime(2019, 7, 21, 13, 0, tzinfo=dt.timezone.utc),
+                    dt.datetime(2019, 7, 21, 13, 30, tzinfo=dt.timezone.utc),
+                    dt.datetime(2019, 7, 21, 14, 0, tzinfo=dt.timezone.utc),
+                ],
+            )
+        )
+        result = self.range_check.checks.process_timeseries()
+        self.assertEqual(list(result["flags"]), ["", "RANGE", "SUSPECT", ""])
+
 
 class RateOfChangeCheckTestCase(TestCase):
     def _mommy_make_rate_of_change_check(self):
@@ -466,6 +904,43 @@ class RateOfChangeCheckThresholdsTestCase(TestCase):
             self.rocc.thresholds, [Threshold("10min", 25.0), Threshold("1H", 35.0)]
         )
 
+    def test_set_thresholds_number_of_queries_does_not_depend_on_lines(self):
+        with CaptureQueriesContext(connection) as one_line:
+            self.rocc.set_thresholds("10min\t25.0\n")
+        with CaptureQueriesContext(connection) as many_lines:
+            self.rocc.set_thresholds(
+                "".join(f"{i + 1}min\t{i}.0\n" for i in range(100))
+            )
+        self.assertEqual(len(many_lines), len(one_line))
+        self.assertEqual(RateOfChangeThreshold.objects.count(), 100)
+
+    def test_set_thresholds_does_not_delete_thresholds_if_invalid(self):
+        self.rocc.set_thresholds("10min\t25.0\n")
+        with self.assertRaises(ValueError):
+            self.rocc.set_thresholds("20min\t25.0\n20hours\t35.0\n")
+        self.assertEqual(self.rocc.thresholds, [Threshold("10min", 25.0)])
+
+
+class RateOfChangeThresholdParseTextTestCase(TestCase):
+    def test_parse_text(self):
+        self.assertEqual(
+            RateOfChangeThreshold.parse_text("10min  7.3"),
+            {"delta_t": "10min", "allowed_diff": 7.3},
+        )
+
+    def test_invalid_delta_t(self):
+        msg = '"10hours 7.3" is not a valid (delta_t, allowed_diff) pair'
+        with self.assertRaisesRegex(ValueError, msg):
+            RateOfChangeThreshold.parse_text("10hours 7.3")
+
+    def test_invalid_allowed_diff(self):
+        with self.assertRaises(ValueError):
+            RateOfChangeThreshold.parse_text("10min hello")
+
+    def test_wrong_number_of_items(self):
+        with self.assertRaises(ValueError):
+            RateOfChangeThreshold.parse_text("10min 7.3 8")
+
 
 class RateOfChangeCheckProcessTimeseriesTestCase(TestCase):
     _index = [
@@ -496,6 +971,9 @@ class RateOfChangeCheckProcessTimeseriesTestCase(TestCase):
         index=_index,
     )
 
+    def setUp(self):
+        cache.clear()
+
     def test_execute(self):
         self.roc_check = mommy.make(RateOfChangeCheck)
         mommy.make(
@@ -509,6 +987,296 @@ class RateOfChangeCheckProcessTimeseriesTestCase(TestCase):
         pd.testing.assert_frame_equal(result, self.expected_result)
 
 
+class RateOfChangeCheckContextTestCase(TestCase):
+    data = RateOfChangeCheckProcessTimeseriesTestCase.source_timeseries
+
+    def setUp(self):
+        cache.clear()
+        self.roc_check = mommy.make(RateOfChangeCheck, symmetric=True)
+        mommy.make(
+            RateOfChangeThreshold,
+            rate_of_change_check=self.roc_check,
+            delta_t="10min",
+            allowed_diff=7.0,
+        )
+
+    def _check(self, start, end):
+        htimeseries = HTimeseries(self.data.iloc[start:end].copy())
+        return flag_registry.to_strings(
+            self.roc_check.check_timeseries(htimeseries).data
+        )
+
+    def test_compares_first_records_with_context(self):
+        self._check(0, 5)
+        result = self._check(5, 7)
+        self.assertEqual(list(result["flags"]), ["FLAG2 TEMPORAL", "FLAG3"])
+
+    def test_does_not_return_context(self):
+        self._check(0, 5)
+        result = self._check(5, 7)
+        pd.testing.assert_index_equal(result.index, self.data.index[5:7])
+
+    def test_without_context(self):
+        self._check(0, 5)
+        cache.clear()
+        result = self._check(5, 7)
+        self.assertEqual(list(result["flags"]), ["FLAG2", "FLAG3"])
+
+    def test_has_context(self):
+        self._check(0, 5)
+        self.assertTrue(self.roc_check.has_context(self.data.index[4]))
+
+    def test_has_no_context_for_other_date(self):
+        self._check(0, 5)
+        self.assertFalse(self.roc_check.has_context(self.data.index[3]))
+
+    def test_set_thresholds_deletes_context(self):
+        self._check(0, 5)
+        self.roc_check.set_thresholds("20min\t7.0")
+        self.assertFalse(self.roc_check.has_context(self.data.index[4]))
+
+    def test_has_no_context_if_lookback_changes(self):
+        # E.g. if the thresholds have been changed by a process that doesn't share
+        # the cache
+        self._check(0, 5)
+        mommy.make(
+            RateOfChangeThreshold,
+            rate_of_change_check=self.roc_check,
+            delta_t="20min",
+            allowed_diff=7.0,
+        )
+        self.assertFalse(self.roc_check.has_context(self.data.index[4]))
+
+    def test_checks_do_not_read_overlap_if_context_is_cached(self):
+        self._check(0, 5)
+        self.roc_check.checks.target_timeseries.set_data(self.data.iloc[:5])
+        self.assertEqual(self.roc_check.checks._get_chunk_overlap(), dt.timedelta(0))
+
+    def test_checks_read_overlap_if_context_is_not_cached(self):
+        self.roc_check.checks.target_timeseries.set_data(self.data.iloc[:5])
+        self.assertEqual(
+            self.roc_check.checks._get_chunk_overlap(), dt.timedelta(minutes=10)
+        )
+
+    def test_checks_read_overlap_instead_of_handed_off_data(self):
+        checks = self.roc_check.checks
+        checks.target_timeseries.set_data(self.data.iloc[:5])
+        checks._htimeseries = HTimeseries(self.data.iloc[5:7].copy())
+        with mock.patch.object(Checks, "_execute_in_chunks") as m:
+            checks.execute()
+        m.assert_called_once_with()
+
+
+class FlatLineCheckTestCase(TestCase):
+    def test_create(self):
+        checks = mommy.make(Checks)
+        FlatLineCheck(checks=checks, duration="6H").save()
+        self.assertEqual(FlatLineCheck.objects.count(), 1)
+
+    def test_refuses_invalid_duration(self):
+        checks = mommy.make(Checks)
+        with self.assertRaises(DataError):
+            FlatLineCheck(checks=checks, duration="6 hours").save()
+
+    def test_str(self):
+        flatline_check = mommy.make(
+            FlatLineCheck,
+            duration="6H",
+            checks__timeseries_group__name="Temperature",
+        )
+        self.assertEqual(str(flatline_check), "Flat line check for Temperature")
+
+    def test_checks_is_deleted_if_only_check_is_deleted(self):
+        flatline_check = mommy.make(FlatLineCheck, duration="6H")
+        flatline_check.delete()
+        self.assertFalse(Checks.objects.exists())
+
+
+class FlatLineCheckProcessTimeseriesTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.flatline_check = mommy.make(FlatLineCheck, duration="20min")
+        self.data = pd.DataFrame(
+            data={
+                "value": [1.0, 2.0, 2.0, 2.0, 2.0, 2.0, np.nan, np.nan, np.nan, 3.0],
+                "flags": ["", "", "", "", "FLAG1", "", "", "", "", ""],
+            },
+            columns=["value", "flags"],
+            index=pd.date_range("2019-05-21 17:00", periods=10, freq="10min", tz="UTC"),
+        )
+
+    def _check(self, start, end):
+        htimeseries = HTimeseries(self.data.iloc[start:end].copy())
+        return flag_registry.to_strings(
+            self.flatline_check.check_timeseries(htimeseries).data
+        )
+
+    def test_flags(self):
+        result = self._check(0, 10)
+        self.assertEqual(
+            list(result["flags"]),
+            ["", "", "", "", "FLAG1 FLATLINE", "FLATLINE", "", "", "", ""],
+        )
+
+    def test_does_not_remove_values(self):
+        result = self._check(0, 10)
+        np.testing.assert_equal(result["value"].values, self.data["value"].values)
+
+    def test_continues_run_from_previous_part(self):
+        self._check(0, 4)
+        result = self._check(4, 10)
+        self.assertEqual(
+            list(result["flags"]), ["FLAG1 FLATLINE", "FLATLINE", "", "", "", ""]
+        )
+
+    def test_continues_run_when_parts_overlap(self):
+        self._check(0, 4)
+        result = self._check(2, 10)
+        self.assertEqual(
+            list(result["flags"]),
+            ["", "", "FLAG1 FLATLINE", "FLATLINE", "", "", "", ""],
+        )
+
+    def test_without_context(self):
+        self._check(0, 4)
+        cache.clear()
+        result = self._check(4, 10)
+        self.assertEqual(list(result["flags"]), ["FLAG1", "", "", "", "", ""])
+
+    def test_checks_do_not_read_overlap_if_context_is_cached(self):
+        self._check(0, 6)
+        self.flatline_check.checks.target_timeseries.set_data(self.data.iloc[:6])
+        self.assertEqual(
+            self.flatline_check.checks._get_chunk_overlap(), dt.timedelta(0)
+        )
+
+    def test_checks_read_duration_if_context_is_not_cached(self):
+        # The records after 17:50 need those after 17:31 plus the one before
+        self.flatline_check.checks.target_timeseries.set_data(self.data.iloc[:6])
+        self.assertEqual(
+            self.flatline_check.checks._get_chunk_overlap(), dt.timedelta(minutes=21)
+        )
+
+    def test_checks_read_duration_if_context_does_not_end_at_target_end(self):
+        self._check(0, 4)
+        self.flatline_check.checks.target_timeseries.set_data(self.data.iloc[:6])
+        self.assertEqual(
+            self.flatline_check.checks._get_chunk_overlap(), dt.timedelta(minutes=21)
+        )
+
+    def test_checks_discard_context_that_does_not_end_at_target_end(self):
+        self._check(0, 2)
+        checks = self.flatline_check.checks
+        checks.target_timeseries.set_data(self.data.iloc[:3])
+        checks._htimeseries = HTimeseries(self.data.iloc[3:6].copy())
+        checks._execute_chunk()
+        result = checks.target_timeseries.get_data().data
+        self.assertEqual(list(result["flags"].iloc[3:]), ["", "FLAG1", ""])
+
+
+class SpikeCheckTestCase(TestCase):
+    def test_create(self):
+        checks = mommy.make(Checks)
+        SpikeCheck(checks=checks, window=5, allowed_diff=3.0).save()
+        self.assertEqual(SpikeCheck.objects.count(), 1)
+
+    def test_refuses_zero_window(self):
+        checks = mommy.make(Checks)
+        with self.assertRaises(ValidationError):
+            SpikeCheck(checks=checks, window=0, allowed_diff=3.0).full_clean()
+
+    def test_str(self):
+        spike_check = mommy.make(
+            SpikeCheck, checks__timeseries_group__name="Temperature"
+        )
+        self.assertEqual(str(spike_check), "Spike check for Temperature")
+
+    def test_checks_is_deleted_if_only_check_is_deleted(self):
+        spike_check = mommy.make(SpikeCheck)
+        spike_check.delete()
+        self.assertFalse(Checks.objects.exists())
+
+
+class SpikeCheckProcessTimeseriesTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.spike_check = mommy.make(SpikeCheck, window=3, allowed_diff=5.0)
+        self.data = pd.DataFrame(
+            data={
+                "value": [1.0, 2.0, 1.5, 9.0, 1.0, np.nan, 12.0, 8.0],
+                "flags": ["", "", "", "FLAG1", "", "", "", ""],
+            },
+            columns=["value", "flags"],
+            index=pd.date_range("2019-05-21 17:00", periods=8, freq="10min", tz="UTC"),
+        )
+
+    def _check(self, start, end):
+        htimeseries = HTimeseries(self.data.iloc[start:end].copy())
+        return flag_registry.to_strings(
+            self.spike_check.check_timeseries(htimeseries).data
+        )
+
+    def test_flags(self):
+        result = self._check(0, 8)
+        self.assertEqual(
+            list(result["flags"]), ["", "", "", "FLAG1 SPIKE", "", "", "SPIKE", ""]
+        )
+
+    def test_removes_spikes(self):
+        result = self._check(0, 8)
+        np.testing.assert_equal(
+            result["value"].values, [1.0, 2.0, 1.5, np.nan, 1.0, np.nan, np.nan, 8.0]
+        )
+
+    def test_uses_window_from_previous_part(self):
+        self._check(0, 3)
+        result = self._check(3, 8)
+        self.assertEqual(list(result["flags"]), ["FLAG1 SPIKE", "", "", "SPIKE", ""])
+
+    def test_without_context(self):
+        self._check(0, 3)
+        cache.clear()
+        result = self._check(3, 8)
+        self.assertEqual(list(result["flags"]), ["FLAG1", "", "", "", ""])
+
+    def test_context_ends_at_last_checked_record(self):
+        self._check(0, 6)
+        self.assertTrue(self.spike_check.has_context(self.data.index[5]))
+
+    def test_has_no_context_if_window_changes(self):
+        self._check(0, 3)
+        self.spike_check.window = 4
+        self.assertFalse(self.spike_check.has_context(self.data.index[2]))
+
+    def test_checks_do_not_read_overlap_if_context_is_cached(self):
+        self._check(0, 6)
+        self.spike_check.checks.target_timeseries.set_data(self.data.iloc[:6])
+        self.assertEqual(self.spike_check.checks._get_chunk_overlap(), dt.timedelta(0))
+
+    def test_checks_read_window_if_context_is_not_cached(self):
+        # The window of the records after 17:50 starts at 17:20
+        self.spike_check.checks.target_timeseries.set_data(self.data.iloc[:6])
+        self.assertEqual(
+            self.spike_check.checks._get_chunk_overlap(), dt.timedelta(minutes=31)
+        )
+
+    def test_checks_read_window_if_context_does_not_end_at_target_end(self):
+        self._check(0, 3)
+        self.spike_check.checks.target_timeseries.set_data(self.data.iloc[:6])
+        self.assertEqual(
+            self.spike_check.checks._get_chunk_overlap(), dt.timedelta(minutes=31)
+        )
+
+    def test_checks_discard_context_that_does_not_end_at_target_end(self):
+        self._check(0, 3)
+        checks = self.spike_check.checks
+        checks.target_timeseries.set_data(self.data.iloc[:6])
+        checks._htimeseries = HTimeseries(self.data.iloc[6:8].copy())
+        checks._execute_chunk()
+        result = checks.target_timeseries.get_data().data
+        self.assertEqual(list(result["flags"].iloc[6:]), ["", ""])
+
+
 class CurveInterpolationTestCase(TestCase):
     def setUp(self):
         self.station = mommy.make(Station)
@@ -716,6 +1484,70 @@ class CurvePeriodSetCurveTestCase(TestCase):
         self.assertAlmostEqual(points[2].x, 9)
         self.assertAlmostEqual(points[2].y, 10)
 
+    def test_number_of_queries_does_not_depend_on_points(self):
+        with CaptureQueriesContext(connection) as one_point:
+            self.period.set_curve("1,2\n")
+        with CaptureQueriesContext(connection) as many_points:
+            self.period.set_curve("".join(f"{i},{i * 2}\n" for i in range(5000)))
+        self.assertEqual(len(many_points), len(one_point))
+        self.assertEqual(CurvePoint.objects.count(), 5000)
+
+    def test_does_not_delete_points_if_invalid(self):
+        with self.assertRaises(ValueError):
+            self.period.set_curve("5,6\ngarbage\n")
+        self.assertEqual(CurvePoint.objects.count(), 1)
+
+
+class CurvePeriodParseCurveTestCase(TestCase):
+    def test_parse_curve(self):
+        self.assertEqual(
+            CurvePeriod.parse_curve("5,6\n7\t8\n"), [(5.0, 6.0), (7.0, 8.0)]
+        )
+
+    def test_parse_curve_ignores_extra_columns(self):
+        self.assertEqual(
+            CurvePeriod.parse_curve("5,6,0\n7\t8\tx\n"), [(5.0, 6.0), (7.0, 8.0)]
+        )
+
+    def test_error_message(self):
+        msg = 'Error in line 2: "7 8" is not a valid pair of numbers'
+        with self.assertRaisesRegex(ValueError, msg):
+            CurvePeriod.parse_curve("5,6\n7 8\n")
+
+    def test_too_many_items(self):
+        with self.assertRaises(ValueError):
+            CurvePeriod.parse_curve("5,6,7\n")
+
+
+@override_settings(ENHYDRIS_AUTOPROCESS_CURVE_STORAGE="binary")
+class CurvePeriodSetCurveBinaryTestCase(TestCase):
+    def setUp(self):
+        self.period = mommy.make(
+            CurvePeriod, start_date=dt.date(2019, 9, 3), end_date=dt.date(2021, 9, 4)
+        )
+        mommy.make(CurvePoint, curve_period=self.period, x=2.718, y=3.141)
+        self.period.set_curve("9,10\n5,6\n7\t8\n")
+
+    def test_deletes_points(self):
+        self.assertEqual(CurvePoint.objects.count(), 0)
+
+    def test_curve(self):
+        period = CurvePeriod.objects.get(id=self.period.id)
+        x, y = period._get_curve()
+        np.testing.assert_equal(x, [5, 7, 9])
+        np.testing.assert_equal(y, [6, 8, 10])
+
+    def test_curve_is_read_in_one_query(self):
+        with self.assertNumQueries(1):
+            CurvePeriod.objects.get(id=self.period.id)._get_curve()
+
+    @override_settings(ENHYDRIS_AUTOPROCESS_CURVE_STORAGE="rows")
+    def test_setting_curve_as_rows_clears_curve_data(self):
+        self.period.set_curve("1,2\n3,4\n")
+        period = CurvePeriod.objects.get(id=self.period.id)
+        self.assertIsNone(period.curve_data)
+        self.assertEqual(period._get_curve(), ([1, 3], [2, 4]))
+
 
 class CurveInterpolationProcessTimeseriesTestCase(TestCase):
     _index = [
@@ -756,7 +1588,8 @@ class CurveInterpolationProcessTimeseriesTestCase(TestCase):
         index=_index,
     )
 
-    def test_execute(self):
+    def setUp(self):
+        curve_cache.clear()
         station = mommy.make(Station)
         self.curve_interpolation = mommy.make(
             CurveInterpolation,
@@ -766,9 +1599,64 @@ class CurveInterpolationProcessTimeseriesTestCase(TestCase):
         self._setup_period1()
         self._setup_period2()
         self.curve_interpolation._htimeseries = HTimeseries(self.source_timeseries)
+
+    def test_execute(self):
         result = self.curve_interpolation.process_timeseries()
         pd.testing.assert_frame_equal(result, self.expected_result)
 
+    def test_no_curve_queries_on_repeated_execution(self):
+        self.curve_interpolation.process_timeseries()
+        with self.assertNumQueries(0):
+            result = self.curve_interpolation.process_timeseries()
+        pd.testing.assert_frame_equal(result, self.expected_result)
+
+    def test_no_curve_queries_on_new_instance(self):
+        self.curve_interpolation.process_timeseries()
+        curve_interpolation = CurveInterpolation.objects.get(
+            id=self.curve_interpolation.id
+        )
+        curve_interpolation._htimeseries = HTimeseries(self.source_timeseries)
+        with self.assertNumQueries(0):
+            curve_interpolation.process_timeseries()
+
+    def test_changed_curve_is_used(self):
+        self.curve_interpolation.process_timeseries()
+        period = self.curve_interpolation.curveperiod_set.get(
+            start_date=dt.date(2019, 5, 1)
+        )
+        period.set_curve("3,1000\n5,2000\n")
+        curve_interpolation = CurveInterpolation.objects.get(
+            id=self.curve_interpolation.id
+        )
+        curve_interpolation._htimeseries = HTimeseries(self.source_timeseries)
+        result = curve_interpolation.process_timeseries()
+        self.assertAlmostEqual(result["value"].iloc[2], 1050)
+
+    @override_settings(ENHYDRIS_AUTOPROCESS_CURVE_STORAGE="binary")
+    def test_binary_curves(self):
+        for period in self.curve_interpolation.curveperiod_set.all():
+            x, y = period._get_curve()
+            period.set_curve("\n".join(f"{a},{b}" for a, b in zip(x, y)))
+        self.assertEqual(CurvePoint.objects.count(), 0)
+        curve_interpolation = CurveInterpolation.objects.get(
+            id=self.curve_interpolation.id
+        )
+        curve_interpolation._htimeseries = HTimeseries(self.source_timeseries)
+        result = curve_interpolation.process_timeseries()
+        pd.testing.assert_frame_equal(result, self.expected_result)
+
+    def test_deleted_period_is_not_used(self):
+        self.curve_interpolation.process_timeseries()
+        self.curve_interpolation.curveperiod_set.get(
+            start_date=dt.date(2019, 6, 1)
+        ).delete()
+        curve_interpolation = CurveInterpolation.objects.get(
+            id=self.curve_interpolation.id
+        )
+        curve_interpolation._htimeseries = HTimeseries(self.source_timeseries)
+        result = curve_interpolation.process_timeseries()
+        self.assertTrue(np.isnan(result["value"].iloc[4]))
+
     def _setup_period1(self):
         period1 = self._make_period(dt.date(2019, 5, 1), dt.date(2019, 5, 31))
         mommy.make(CurvePoint, curve_period=period1, x=3, y=100)
@@ -991,7 +1879,7 @@ class AggregationProcessTimeseriesTestCase(TestCase):
         ],
     )
 
-    def _execute(self, max_missing):
+    def _execute(self, max_missing, resulting_timestamp_offset="1min"):
         station = mommy.make(Station)
         self.aggregation = mommy.make(
             Aggregation,
@@ -1000,7 +1888,7 @@ class AggregationProcessTimeseriesTestCase(TestCase):
             target_time_step="H",
             method="sum",
             max_missing=max_missing,
-            resulting_timestamp_offset="1min",
+            resulting_timestamp_offset=resulting_timestamp_offset,
         )
         self.aggregation._htimeseries = HTimeseries(self.source_timeseries)
         self.aggregation._htimeseries.time_step = "10min"
@@ -1027,6 +1915,12 @@ class AggregationProcessTimeseriesTestCase(TestCase):
         result = aggregation.process_timeseries().data
         self.assertTrue(result.empty)
 
+    def test_trims_last_record_without_resulting_timestamp_offset(self):
+        result = self._execute(max_missing=5, resulting_timestamp_offset="")
+        self.assertEqual(
+            result.index[-1], dt.datetime(2019, 5, 21, 12, 0, tzinfo=dt.timezone.utc)
+        )
+
     def test_execute_for_max_missing_too_high(self):
         result = self._execute(max_missing=10000)
         self.assert_frame_equal(result, self.expected_result_for_max_missing_five)
@@ -1044,6 +1938,368 @@ class AggregationProcessTimeseriesTestCase(TestCase):
         pd.testing.assert_frame_equal(result, expected_result)
 
 
+class AggregationGetSourceStepTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.aggregation = mommy.make(
+            Aggregation,
+            timeseries_group__variable__descr="Hello",
+            target_time_step="H",
+            method="sum",
+        )
+        self.aggregation._htimeseries = HTimeseries(self._get_data(10))
+
+    def _get_data(self, records):
+        index = pd.date_range("2019-05-21", periods=records, freq="10min", tz="UTC")
+        return pd.DataFrame({"value": 1.0, "flags": ""}, index=index)
+
+    @mock.patch("enhydris_autoprocess.models.pd.infer_freq")
+    def test_uses_stored_time_step(self, m):
+        self.aggregation._htimeseries.time_step = "10min"
+        result = self.aggregation._get_source_step(self.aggregation._htimeseries)
+        self.assertEqual(result, "10min")
+        m.assert_not_called()
+
+    def test_infers_time_step_if_not_stored(self):
+        self.aggregation._htimeseries.time_step = ""
+        result = self.aggregation._get_source_step(self.aggregation._htimeseries)
+        self.assertEqual(pd.Timedelta(result), pd.Timedelta("10min"))
+
+    def test_infers_time_step_from_sample(self):
+        data = self._get_data(2000)
+        # The last record is irregular, so the time step can't be inferred from all
+        data.index = data.index[:-1].append(
+            pd.DatetimeIndex([data.index[-1] + pd.Timedelta("1min")])
+        )
+        htimeseries = HTimeseries(data)
+        self.aggregation._htimeseries.time_step = ""
+        result = self.aggregation._get_source_step(htimeseries)
+        self.assertEqual(pd.Timedelta(result), pd.Timedelta("10min"))
+
+    def test_caches_inferred_time_step(self):
+        self.aggregation._htimeseries.time_step = ""
+        self.aggregation._get_source_step(self.aggregation._htimeseries)
+        with mock.patch("enhydris_autoprocess.models.pd.infer_freq") as m:
+            self.aggregation._get_source_step(self.aggregation._htimeseries)
+        m.assert_not_called()
+
+    def test_does_not_infer_time_step_from_too_few_records(self):
+        htimeseries = HTimeseries(self._get_data(2))
+        self.aggregation._htimeseries.time_step = ""
+        self.assertIsNone(self.aggregation._get_source_step(htimeseries))
+
+    def test_saving_clears_cached_time_step(self):
+        self.aggregation._htimeseries.time_step = ""
+        self.aggregation._get_source_step(self.aggregation._htimeseries)
+        self.aggregation.save()
+        self.assertIsNone(cache.get(self.aggregation._get_source_step_key()))
+
+
+class AggregationIncrementalTestCase(ClearCacheMixin, TestCase):
+    _values = AggregationProcessTimeseriesTestCase._values
+
+    def setUp(self):
+        super().setUp()
+        data_cache.clear()
+        station = mommy.make(Station, display_timezone="Etc/GMT-2")
+        self.timeseries_group = mommy.make(
+            TimeseriesGroup, gentity=station, variable__descr="h"
+        )
+        self.source_timeseries = mommy.make(
+            Timeseries,
+            timeseries_group=self.timeseries_group,
+            type=Timeseries.CHECKED,
+            time_step="10min",
+        )
+        self.aggregation = mommy.make(
+            Aggregation,
+            timeseries_group=self.timeseries_group,
+            target_time_step="H",
+            method="sum",
+            max_missing=1,
+            resulting_timestamp_offset="1min",
+        )
+        # Until 11:20, so that the 12:00 interval is incomplete
+        self.source_timeseries.append_data(self._get_data(0, 9))
+        self.aggregation.execute()
+
+    def _get_data(self, start, end):
+        index = pd.date_range(
+            "2019-05-21 10:00", periods=17, freq="10min", tz=get_tzinfo("Etc/GMT-2")
+        )
+        return pd.DataFrame(
+            data={"value": self._values[start:end], "flags": ""},
+            columns=["value", "flags"],
+            index=index[start:end],
+        )
+
+    def _execute_again(self):
+        self.source_timeseries.append_data(self._get_data(9, 17))
+        aggregation = Aggregation.objects.get(id=self.aggregation.id)
+        aggregation.execute()
+        return aggregation
+
+    def _get_target_data(self):
+        return self.aggregation.target_timeseries.get_data().data
+
+    def test_saves_state(self):
+        state = AggregationState.objects.get(aggregation=self.aggregation)
+        self.assertEqual(
+            state.bucket_end_date,
+            dt.datetime(2019, 5, 21, 12, 0, tzinfo=get_tzinfo("Etc/GMT-2")),
+        )
+        self.assertEqual(
+            (state.count, state.sum, state.min, state.max), (1, 19, 19, 19)
+        )
+
+    def test_result_after_first_execution(self):
+        self.assertEqual(list(self._get_target_data()["value"]), [56.0])
+
+    def test_result_after_second_execution(self):
+        self._execute_again()
+        data = self._get_target_data()
+        self.assertEqual(list(data["value"]), [56.0, 157.0])
+        self.assertEqual(list(data["flags"]), ["", "MISS"])
+
+    def test_reads_only_new_records(self):
+        aggregation = self._execute_again()
+        self.assertEqual(
+            aggregation.htimeseries.data.index[0],
+            dt.datetime(2019, 5, 21, 11, 30, tzinfo=get_tzinfo("Etc/GMT-2")),
+        )
+
+    def test_ignores_state_if_target_has_been_modified(self):
+        self.aggregation.target_timeseries.append_data(
+            pd.DataFrame(
+                data={"value": [42.0], "flags": [""]},
+                columns=["value", "flags"],
+                index=[
+                    dt.datetime(2019, 5, 21, 11, 59, tzinfo=get_tzinfo("Etc/GMT-2"))
+                ],
+            )
+        )
+        aggregation = Aggregation.objects.get(id=self.aggregation.id)
+        self.assertIsNone(aggregation._get_aggregation_state())
+
+    def test_saving_aggregation_deletes_state(self):
+        self.aggregation.save()
+        self.assertFalse(AggregationState.objects.exists())
+
+    def test_no_state_for_monthly_aggregation(self):
+        aggregation = mommy.make(
+            Aggregation,
+            timeseries_group=self.timeseries_group,
+            target_time_step="M",
+            method="sum",
+        )
+        aggregation.execute()
+        self.assertFalse(AggregationState.objects.filter(aggregation=aggregation))
+
+
+class AggregationSourceAggregationTestCase(TestCase):
+    def setUp(self):
+        self.timeseries_group = mommy.make(
+            TimeseriesGroup, gentity=mommy.make(Station), variable__descr="hello"
+        )
+        self.hourly = mommy.make(
+            Aggregation,
+            timeseries_group=self.timeseries_group,
+            target_time_step="H",
+            method="sum",
+        )
+
+    def _make_aggregation(self, target_time_step="D", method="sum", **kwargs):
+        return Aggregation(
+            timeseries_group=kwargs.pop("timeseries_group", self.timeseries_group),
+            target_time_step=target_time_step,
+            method=method,
+            source_aggregation=self.hourly,
+            **kwargs,
+        )
+
+    def test_daily_from_hourly(self):
+        self._make_aggregation().save()
+
+    def test_monthly_from_hourly(self):
+        self._make_aggregation(target_time_step="M").save()
+
+    def test_three_hourly_max_from_hourly_max(self):
+        self.hourly.method = "max"
+        self.hourly.save()
+        self._make_aggregation(target_time_step="3H", method="max").save()
+
+    def test_different_method(self):
+        with self.assertRaises(IntegrityError):
+            self._make_aggregation(method="max").save()
+
+    def test_mean(self):
+        self.hourly.method = "mean"
+        self.hourly.save()
+        with self.assertRaises(IntegrityError):
+            self._make_aggregation(method="mean").save()
+
+    def test_target_time_step_not_multiple_of_source(self):
+        with self.assertRaises(IntegrityError):
+            self._make_aggregation(target_time_step="90min").save()
+
+    def test_target_time_step_same_as_source(self):
+        with self.assertRaises(IntegrityError):
+            self._make_aggregation(target_time_step="H").save()
+
+    def test_source_time_step_does_not_divide_day(self):
+        self.hourly.target_time_step = "7H"
+        self.hourly.save()
+        with self.assertRaises(IntegrityError):
+            self._make_aggregation(target_time_step="14H").save()
+
+    def test_different_timeseries_group(self):
+        timeseries_group = mommy.make(
+            TimeseriesGroup, gentity=mommy.make(Station), variable__descr="hello"
+        )
+        with self.assertRaises(IntegrityError):
+            self._make_aggregation(timeseries_group=timeseries_group).save()
+
+    def test_itself(self):
+        self.hourly.source_aggregation = self.hourly
+        with self.assertRaises(IntegrityError):
+            self.hourly.save()
+
+    def test_cycle(self):
+        daily = self._make_aggregation()
+        daily.save()
+        self.hourly.target_time_step = "2D"
+        self.hourly.source_aggregation = daily
+        with self.assertRaisesRegex(IntegrityError, "cycle"):
+            self.hourly.save()
+
+    def test_checks_cascaded_aggregations_when_time_step_changes(self):
+        self._make_aggregation().save()
+        self.hourly.target_time_step = "2D"
+        with self.assertRaises(IntegrityError):
+            self.hourly.save()
+
+    def test_checks_cascaded_aggregations_when_method_changes(self):
+        self._make_aggregation().save()
+        self.hourly.method = "max"
+        with self.assertRaises(IntegrityError):
+            self.hourly.save()
+
+    def test_saving_deletes_state_of_cascaded_aggregations(self):
+        daily = self._make_aggregation()
+        daily.save()
+        monthly = self._make_aggregation(target_time_step="M")
+        monthly.source_aggregation = daily
+        monthly.save()
+        for aggregation in (daily, monthly):
+            mommy.make(
+                AggregationState,
+                aggregation=aggregation,
+                source_end_date=dt.datetime(2019, 5, 21, tzinfo=dt.timezone.utc),
+            )
+        self.hourly.save()
+        self.assertFalse(AggregationState.objects.exists())
+
+    def test_source_timeseries(self):
+        aggregation = self._make_aggregation()
+        aggregation.save()
+        self.assertEqual(
+            aggregation.source_timeseries.id, self.hourly.target_timeseries.id
+        )
+
+    def test_find_source_timeseries(self):
+        aggregation = self._make_aggregation()
+        aggregation.save()
+        timeseries_list = [
+            mommy.make(Timeseries, timeseries_group=self.timeseries_group, type=type)
+            for type in (Timeseries.INITIAL, Timeseries.CHECKED)
+        ]
+        self.assertIsNone(aggregation.find_source_timeseries(timeseries_list))
+        timeseries_list.append(self.hourly.target_timeseries)
+        self.assertEqual(
+            aggregation.find_source_timeseries(timeseries_list).id,
+            self.hourly.target_timeseries.id,
+        )
+
+
+class AggregationFromSourceAggregationTestCase(TestCase):
+    """Compare cascaded aggregation with aggregation of the ten-minute series.
+
+    The ten-minute time series goes from 00:10 to 06:00 and lacks the value at 03:30.
+    """
+
+    def setUp(self):
+        self.timeseries_group = mommy.make(
+            TimeseriesGroup, gentity=mommy.make(Station), variable__descr="hello"
+        )
+        mommy.make(
+            Timeseries,
+            timeseries_group=self.timeseries_group,
+            type=Timeseries.CHECKED,
+            time_step="10min",
+        )
+        values = np.arange(1.0, 37.0)
+        values[20] = np.nan
+        self.data = pd.DataFrame(
+            data={"value": values, "flags": ""},
+            columns=["value", "flags"],
+            index=pd.date_range(
+                "2019-05-21 00:10", periods=36, freq="10min", tz=dt.timezone.utc
+            ),
+        )
+
+    def _make_aggregation(self, max_missing, source_aggregation=None):
+        return mommy.make(
+            Aggregation,
+            timeseries_group=self.timeseries_group,
+            target_time_step=source_aggregation and "3H" or "H",
+            method="sum",
+            max_missing=max_missing,
+            resulting_timestamp_offset="1min",
+            source_aggregation=source_aggregation,
+        )
+
+    def _aggregate(self, aggregation, data, time_step):
+        aggregation._htimeseries = HTimeseries(data)
+        aggregation._htimeseries.time_step = time_step
+        return aggregation.process_timeseries().data
+
+    def _aggregate_directly(self, max_missing):
+        aggregation = self._make_aggregation(max_missing)
+        aggregation.target_time_step = "3H"
+        return self._aggregate(aggregation, self.data.copy(), "10min")
+
+    def _aggregate_in_cascade(self, source_max_missing, max_missing):
+        hourly = self._make_aggregation(source_max_missing)
+        hourly_data = self._aggregate(hourly, self.data.copy(), "10min")
+        aggregation = self._make_aggregation(max_missing, source_aggregation=hourly)
+        return self._aggregate(aggregation, hourly_data, "H")
+
+    def _assert_frame_equal(self, result, expected_result):
+        expected_result.index.name = result.index.name
+        expected_result.index.freq = result.index.freq
+        pd.testing.assert_frame_equal(result, expected_result)
+
+    def test_max_missing_zero(self):
+        result = self._aggregate_in_cascade(source_max_missing=0, max_missing=0)
+        self.assertEqual(list(result["value"]), [171.0])
+        self._assert_frame_equal(result, self._aggregate_directly(max_missing=0))
+
+    def test_max_missing_one(self):
+        result = self._aggregate_in_cascade(source_max_missing=1, max_missing=1)
+        self.assertEqual(list(result["value"]), [171.0, 474.0])
+        self.assertEqual(list(result["flags"]), ["", "MISS"])
+        self._assert_frame_equal(result, self._aggregate_directly(max_missing=1))
+
+    def test_omitted_source_record_counts_as_all_missing(self):
+        # The hourly record ending at 04:00 is omitted, and its six ten-minute
+        # records are considered missing, although only one is.
+        result = self._aggregate_in_cascade(source_max_missing=0, max_missing=1)
+        self.assertEqual(list(result["value"]), [171.0])
+        result = self._aggregate_in_cascade(source_max_missing=0, max_missing=6)
+        self.assertEqual(list(result["value"]), [171.0, 366.0])
+        self.assertEqual(list(result["flags"]), ["", "MISS"])
+
+
 class AggregationProcessTimeseriesWhenNoTimeStepTestCase(TestCase):
     """Check what's done when the source time series has no time step.
 
@@ -1084,6 +2340,52 @@ class AggregationProcessTimeseriesWhenNoTimeStepTestCase(TestCase):
         )
 
 
+class AggregationBatchTestCase(TestCase):
+    def setUp(self):
+        self.timeseries_group = mommy.make(
+            TimeseriesGroup, gentity=mommy.make(Station), variable__descr="hello"
+        )
+        self.aggregations = {
+            method: self._make_aggregation(method)
+            for method in ("sum", "max", "min", "mean")
+        }
+
+    def _make_aggregation(self, method):
+        aggregation = mommy.make(
+            Aggregation,
+            timeseries_group=self.timeseries_group,
+            target_time_step="H",
+            method=method,
+            max_missing=5,
+        )
+        aggregation._htimeseries = HTimeseries(
+            AggregationProcessTimeseriesTestCase.source_timeseries.copy()
+        )
+        aggregation._htimeseries.time_step = "10min"
+        return aggregation
+
+    def _process(self, methods):
+        results = {}
+        with mock.patch(
+            "enhydris_autoprocess.models.regularize", side_effect=regularize
+        ) as m:
+            with batch.batch():
+                for method in methods:
+                    aggregation = self.aggregations[method]
+                    results[method] = aggregation.process_timeseries().data
+        return m.call_count, results
+
+    def test_regularizes_once_per_mode(self):
+        call_count, results = self._process(["sum", "max", "min", "mean"])
+        self.assertEqual(call_count, 2)
+
+    def test_same_results_as_without_batch(self):
+        call_count, results = self._process(["sum", "max", "min", "mean"])
+        for method, result in results.items():
+            aggregation = self._make_aggregation(method)
+            pd.testing.assert_frame_equal(result, aggregation.process_timeseries().data)
+
+
 @mock.patch("enhydris_autoprocess.models.Aggregation._aggregate_time_series")
 @mock.patch("enhydris_autoprocess.models.regularize")
 class AggregationRegularizationModeTestCase(TestCase):
@@ -0,0 +1,149 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from model_mommy import mommy
+
+from enhydris.models import Station, Timeseries, TimeseriesGroup
+from enhydris_autoprocess import pipeline, tasks
+from enhydris_autoprocess.models import Aggregation, Checks, CurveInterpolation
+
+
+class PipelineTestCase(TestCase):
+    """Set up a graph of auto processes spanning two time series groups.
+
+    Group 1 (stage) has checks, an aggregation and a curve interpolation to group 2
+    (discharge); group 2 has checks and an aggregation.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.station = mommy.make(Station)
+        self.group1 = mommy.make(TimeseriesGroup, gentity=self.station)
+        self.group2 = mommy.make(TimeseriesGroup, gentity=self.station)
+        for group in (self.group1, self.group2):
+            for type in (Timeseries.INITIAL, Timeseries.CHECKED):
+                mommy.make(Timeseries, timeseries_group=group, type=type)
+        self.checks1 = mommy.make(Checks, timeseries_group=self.group1)
+        self.aggregation1 = mommy.make(
+            Aggregation,
+            timeseries_group=self.group1,
+            target_time_step="H",
+            method="sum",
+        )
+        self.curve_interpolation = mommy.make(
+            CurveInterpolation,
+            timeseries_group=self.group1,
+            target_timeseries_group=self.group2,
+        )
+        self.checks2 = mommy.make(Checks, timeseries_group=self.group2)
+        self.aggregation2 = mommy.make(
+            Aggregation,
+            timeseries_group=self.group2,
+            target_time_step="H",
+            method="sum",
+        )
+        self.executed = []
+
+    def _record_execution(self, auto_process):
+        self.executed.append(auto_process.id)
+
+    def _execute_pipeline(self, root, side_effect=None):
+        side_effect = side_effect or self._record_execution
+        with mock.patch(
+            "enhydris_autoprocess.models.AutoProcess.execute",
+            side_effect=side_effect,
+            autospec=True,
+        ):
+            pipeline.Pipeline(root).execute()
+
+    def test_executes_whole_downstream_subgraph(self):
+        self._execute_pipeline(self.checks1)
+        self.assertEqual(
+            set(self.executed),
+            {
+                self.checks1.id,
+                self.aggregation1.id,
+                self.curve_interpolation.id,
+                self.checks2.id,
+                self.aggregation2.id,
+            },
+        )
+
+    def test_executes_in_dependency_order(self):
+        self._execute_pipeline(self.checks1)
+        position = {id: i for i, id in enumerate(self.executed)}
+        self.assertEqual(position[self.checks1.id], 0)
+        self.assertLess(
+            position[self.curve_interpolation.id], position[self.checks2.id]
+        )
+        self.assertLess(position[self.checks2.id], position[self.aggregation2.id])
+
+    def test_executes_only_downstream(self):
+        self._execute_pipeline(self.checks2)
+        self.assertEqual(self.executed, [self.checks2.id, self.aggregation2.id])
+
+    def test_skips_dependants_of_failed_auto_process(self):
+        def side_effect(auto_process):
+            self.executed.append(auto_process.id)
+            if auto_process.id == self.curve_interpolation.id:
+                raise ValueError()
+
+        self._execute_pipeline(self.checks1, side_effect=side_effect)
+        self.assertNotIn(self.checks2.id, self.executed)
+        self.assertNotIn(self.aggregation2.id, self.executed)
+        self.assertIn(self.aggregation1.id, self.executed)
+
+    def test_root_failure_is_raised(self):
+        def side_effect(auto_process):
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            self._execute_pipeline(self.checks1, side_effect=side_effect)
+
+    @mock.patch("enhydris_autoprocess.tasks.execute_auto_process")
+    def test_enqueues_auto_process_already_running_elsewhere(self, m):
+        tasks.acquire_running_lock(self.checks2.id)
+        self._execute_pipeline(self.checks1)
+        self.assertNotIn(self.checks2.id, self.executed)
+        self.assertNotIn(self.aggregation2.id, self.executed)
+        m.delay.assert_called_once_with(self.checks2.id)
+
+    def test_auto_processes_are_scheduled_until_executed(self):
+        scheduled = []
+
+        def side_effect(auto_process):
+            scheduled.append(
+                (
+                    pipeline.is_scheduled(self.checks1.id),
+                    pipeline.is_scheduled(self.aggregation2.id),
+                )
+            )
+
+        self._execute_pipeline(self.checks1, side_effect=side_effect)
+        self.assertEqual(scheduled[0], (False, True))
+        self.assertEqual(scheduled[-1], (False, False))
+
+    def test_does_not_create_time_series(self):
+        # The aggregations' target time series don't exist
+        timeseries_count = Timeseries.objects.count()
+        self._execute_pipeline(self.checks1)
+        self.assertEqual(Timeseries.objects.count(), timeseries_count)
+
+    def test_nothing_is_scheduled_after_execution(self):
+        self._execute_pipeline(self.checks1)
+        self.assertFalse(pipeline.is_scheduled(self.aggregation2.id))
+
+    @mock.patch("enhydris_autoprocess.models.AutoProcess.hand_off_to", autospec=True)
+    def test_hands_off_data_to_consumers(self, mock_hand_off_to):
+        self._execute_pipeline(self.checks2)
+        mock_hand_off_to.assert_any_call(self.checks2, self.aggregation2)
+
+    @mock.patch("enhydris_autoprocess.models.AutoProcess.hand_off_to")
+    def test_does_not_hand_off_data_if_disabled(self, mock_hand_off_to):
+        with mock.patch(
+            "enhydris_autoprocess.models.AutoProcess.execute", autospec=True
+        ):
+            pipeline.Pipeline(self.checks2, hand_off=False).execute()
+        mock_hand_off_to.assert_not_called()
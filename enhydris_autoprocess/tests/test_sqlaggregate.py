@@ -0,0 +1,229 @@
+import itertools
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+import numpy as np
+import pandas as pd
+from model_mommy import mommy
+
+from enhydris.models import Station, Timeseries, TimeseriesGroup
+from enhydris.tests import ClearCacheMixin
+from enhydris.tests.test_models.test_timeseries import get_tzinfo
+from enhydris_autoprocess import pipeline, sqlaggregate
+from enhydris_autoprocess.datacache import data_cache
+from enhydris_autoprocess.models import (
+    Aggregation,
+    AggregationState,
+    Checks,
+    RangeCheck,
+)
+
+
+def _get_data():
+    # Ten-minute data in +02:00 with a few missing records and null values
+    index = pd.date_range(
+        "2019-05-21 00:10", periods=500, freq="10min", tz=get_tzinfo("Etc/GMT-2")
+    )
+    values = np.random.default_rng(42).normal(20, 5, 500).round(1)
+    values[[7, 100, 101, 102, 250]] = np.nan
+    data = pd.DataFrame(
+        {"value": values, "flags": ""}, columns=["value", "flags"], index=index
+    )
+    return data.drop(index[[30, 31, 300, 301, 302, 303, 304, 305, 306, 420]])
+
+
+class AggregationEngineTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        data_cache.clear()
+        station = mommy.make(Station, display_timezone="Etc/GMT-2")
+        self.timeseries_group = mommy.make(
+            TimeseriesGroup, gentity=station, variable__descr="h"
+        )
+        self.source_timeseries = mommy.make(
+            Timeseries,
+            timeseries_group=self.timeseries_group,
+            type=Timeseries.CHECKED,
+            time_step="10min",
+        )
+        self.source_timeseries.append_data(_get_data())
+
+    def _execute(self, target_time_step="H"):
+        aggregation = mommy.make(
+            Aggregation,
+            timeseries_group=self.timeseries_group,
+            target_time_step=target_time_step,
+            method="sum",
+        )
+        with mock.patch("enhydris_autoprocess.sqlaggregate.aggregate") as m, mock.patch(
+            "enhydris_autoprocess.sqlaggregate.is_available", return_value=True
+        ), mock.patch(
+            "enhydris_autoprocess.sqlaggregate.is_regular", return_value=True
+        ):
+            aggregation.execute()
+        return m
+
+    def test_uses_pandas_by_default(self):
+        self._execute().assert_not_called()
+
+    @override_settings(ENHYDRIS_AUTOPROCESS_AGGREGATION_ENGINE="timescaledb")
+    def test_uses_timescaledb_if_configured(self):
+        m = self._execute()
+        m.assert_called_once()
+        self.assertEqual(m.call_args.kwargs["expected_count"], 6)
+
+    @override_settings(ENHYDRIS_AUTOPROCESS_AGGREGATION_ENGINE="timescaledb")
+    def test_uses_pandas_for_monthly_aggregation(self):
+        self._execute(target_time_step="M").assert_not_called()
+
+    @override_settings(ENHYDRIS_AUTOPROCESS_AGGREGATION_ENGINE="timescaledb")
+    def test_uses_pandas_if_target_step_is_not_multiple_of_source_step(self):
+        self._execute(target_time_step="15min").assert_not_called()
+
+
+class AggregationEngineWithHandOffTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        data_cache.clear()
+        station = mommy.make(Station, display_timezone="Etc/GMT-2")
+        timeseries_group = mommy.make(
+            TimeseriesGroup, gentity=station, variable__descr="h"
+        )
+        initial_timeseries = mommy.make(
+            Timeseries,
+            timeseries_group=timeseries_group,
+            type=Timeseries.INITIAL,
+            time_step="10min",
+        )
+        initial_timeseries.append_data(_get_data())
+        mommy.make(
+            Timeseries,
+            timeseries_group=timeseries_group,
+            type=Timeseries.CHECKED,
+            time_step="10min",
+        )
+        self.checks = mommy.make(Checks, timeseries_group=timeseries_group)
+        mommy.make(
+            RangeCheck,
+            checks=self.checks,
+            lower_bound=-100,
+            upper_bound=100,
+            soft_lower_bound=None,
+            soft_upper_bound=None,
+        )
+        mommy.make(
+            Aggregation,
+            timeseries_group=timeseries_group,
+            target_time_step="H",
+            method="sum",
+        )
+
+    @override_settings(ENHYDRIS_AUTOPROCESS_AGGREGATION_ENGINE="timescaledb")
+    def test_uses_timescaledb_for_data_handed_off(self):
+        # The checks hand off the checked data to the aggregation (see Pipeline)
+        with mock.patch("enhydris_autoprocess.sqlaggregate.aggregate") as m, mock.patch(
+            "enhydris_autoprocess.sqlaggregate.is_available", return_value=True
+        ), mock.patch(
+            "enhydris_autoprocess.sqlaggregate.is_regular", return_value=True
+        ):
+            pipeline.Pipeline(self.checks).execute()
+        m.assert_called_once()
+        self.assertFalse(AggregationState.objects.exists())
+
+
+class AggregationEngineEquivalenceTestCase(ClearCacheMixin, TestCase):
+    """Check that the timescaledb engine gives the same results as pandas."""
+
+    def setUp(self):
+        super().setUp()
+        data_cache.clear()
+        if not sqlaggregate.is_available():
+            self.skipTest("The database doesn't have TimescaleDB")
+
+    def _make_aggregation(self, target_time_step, method, max_missing, offset):
+        station = mommy.make(Station, display_timezone="Etc/GMT-2")
+        timeseries_group = mommy.make(
+            TimeseriesGroup, gentity=station, variable__descr="h"
+        )
+        mommy.make(
+            Timeseries,
+            timeseries_group=timeseries_group,
+            type=Timeseries.CHECKED,
+            time_step="10min",
+        )
+        return mommy.make(
+            Aggregation,
+            timeseries_group=timeseries_group,
+            target_time_step=target_time_step,
+            method=method,
+            max_missing=max_missing,
+            resulting_timestamp_offset=offset,
+        )
+
+    def _execute(self, aggregation, data, engine, in_database=None):
+        if in_database is None:
+            in_database = engine == "timescaledb"
+        aggregation.source_timeseries.append_data(data)
+        aggregation = Aggregation.objects.get(id=aggregation.id)
+        with override_settings(ENHYDRIS_AUTOPROCESS_AGGREGATION_ENGINE=engine):
+            with mock.patch(
+                "enhydris_autoprocess.sqlaggregate.aggregate",
+                side_effect=sqlaggregate.aggregate,
+            ) as m:
+                aggregation.execute()
+        self.assertEqual(m.called, in_database)
+        return aggregation.target_timeseries.get_data().data
+
+    def _assert_equivalent(self, parts, **kwargs):
+        pandas_aggregation = self._make_aggregation(**kwargs)
+        timescaledb_aggregation = self._make_aggregation(**kwargs)
+        for part in parts:
+            expected = self._execute(pandas_aggregation, part, "pandas")
+            result = self._execute(timescaledb_aggregation, part, "timescaledb")
+            expected.index.freq = result.index.freq
+            pd.testing.assert_frame_equal(result, expected)
+
+    def test_equivalence(self):
+        data = _get_data()
+        for target_time_step, method, max_missing, offset in itertools.product(
+            ("H", "3H", "D"), ("sum", "mean", "max", "min"), (0, 2), ("", "1min")
+        ):
+            with self.subTest(
+                target_time_step=target_time_step,
+                method=method,
+                max_missing=max_missing,
+                offset=offset,
+            ):
+                self._assert_equivalent(
+                    [data],
+                    target_time_step=target_time_step,
+                    method=method,
+                    max_missing=max_missing,
+                    offset=offset,
+                )
+
+    def test_equivalence_of_subsequent_executions(self):
+        data = _get_data()
+        for max_missing in (0, 2):
+            with self.subTest(max_missing=max_missing):
+                self._assert_equivalent(
+                    [data.iloc[:205], data.iloc[205:333], data.iloc[333:]],
+                    target_time_step="H",
+                    method="sum",
+                    max_missing=max_missing,
+                    offset="1min",
+                )
+
+    def test_does_not_keep_state(self):
+        aggregation = self._make_aggregation("H", "sum", 0, "")
+        self._execute(aggregation, _get_data(), "timescaledb")
+        self.assertFalse(AggregationState.objects.exists())
+
+    def test_uses_pandas_if_source_is_irregular(self):
+        aggregation = self._make_aggregation("H", "sum", 0, "")
+        data = _get_data()
+        data = data.rename(
+            index={data.index[50]: data.index[50] + pd.Timedelta("1min")}
+        )
+        self._execute(aggregation, data, "timescaledb", in_database=False)
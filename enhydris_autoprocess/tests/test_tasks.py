@@ -0,0 +1,102 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from enhydris_autoprocess import tasks
+
+
+@mock.patch("enhydris_autoprocess.tasks.execute_auto_process")
+class EnqueueAutoProcessTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch(
+            "enhydris_autoprocess.tasks.cache_is_process_local", return_value=False
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_enqueues(self, m):
+        tasks.enqueue_auto_process(42)
+        m.delay.assert_called_once_with(42)
+
+    def test_coalesces_triggers_before_execution_starts(self, m):
+        tasks.enqueue_auto_process(42)
+        tasks.enqueue_auto_process(42)
+        tasks.enqueue_auto_process(42)
+        m.delay.assert_called_once_with(42)
+
+    def test_does_not_coalesce_different_auto_processes(self, m):
+        tasks.enqueue_auto_process(42)
+        tasks.enqueue_auto_process(43)
+        self.assertEqual(m.delay.call_count, 2)
+
+    def test_enqueues_again_after_execution_starts(self, m):
+        tasks.enqueue_auto_process(42)
+        cache.delete(tasks._get_pending_key(42))  # What the worker does on start
+        tasks.enqueue_auto_process(42)
+        self.assertEqual(m.delay.call_count, 2)
+
+
+@mock.patch("enhydris_autoprocess.tasks.execute_auto_process")
+class EnqueueAutoProcessWithProcessLocalCacheTestCase(TestCase):
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_does_not_coalesce(self, m):
+        tasks.enqueue_auto_process(42)
+        tasks.enqueue_auto_process(42)
+        self.assertEqual(m.delay.call_count, 2)
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+    )
+    def test_other_caches_are_not_process_local(self, m):
+        self.assertFalse(tasks.cache_is_process_local())
+
+
+@mock.patch("enhydris_autoprocess.pipeline.Pipeline")
+@mock.patch("enhydris_autoprocess.models.AutoProcess.objects")
+class ExecuteAutoProcessTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_executes_pipeline(self, mock_objects, mock_pipeline):
+        tasks.execute_auto_process(42)
+        mock_objects.get.assert_called_once_with(id=42)
+        auto_process = mock_objects.get.return_value.as_specific_instance
+        mock_pipeline.assert_called_once_with(auto_process)
+        mock_pipeline.return_value.execute.assert_called_once_with()
+
+    def test_removes_pending_marker(self, mock_objects, mock_pipeline):
+        cache.set(tasks._get_pending_key(42), True)
+        tasks.execute_auto_process(42)
+        self.assertIsNone(cache.get(tasks._get_pending_key(42)))
+
+    def test_removes_pending_marker_before_executing(self, mock_objects, mock_pipeline):
+        cache.set(tasks._get_pending_key(42), True)
+        mock_pipeline.return_value.execute.side_effect = lambda: self.assertIsNone(
+            cache.get(tasks._get_pending_key(42))
+        )
+        tasks.execute_auto_process(42)
+
+    def test_removes_running_marker(self, mock_objects, mock_pipeline):
+        tasks.execute_auto_process(42)
+        self.assertIsNone(cache.get(tasks._get_running_key(42)))
+
+    def test_removes_running_marker_on_error(self, mock_objects, mock_pipeline):
+        mock_pipeline.return_value.execute.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            tasks.execute_auto_process(42)
+        self.assertIsNone(cache.get(tasks._get_running_key(42)))
+
+    @mock.patch("enhydris_autoprocess.tasks.execute_auto_process.apply_async")
+    def test_postpones_if_already_running(
+        self, mock_apply_async, mock_objects, mock_pipeline
+    ):
+        tasks.acquire_running_lock(42)
+        tasks.execute_auto_process(42)
+        mock_objects.get.assert_not_called()
+        mock_apply_async.assert_called_once_with(
+            args=[42], countdown=tasks.POSTPONE_COUNTDOWN
+        )